@@ -7,6 +7,7 @@ and running fsl_anat on the structural image.
 from pathlib import Path
 from itertools import product
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 from fsl.wrappers.fsl_anat import fsl_anat
 from fsl.wrappers import fslmaths, LOAD, bet
@@ -21,7 +22,132 @@ from hcpasl.bias_estimation import bias_estimation, METHODS
 from hcpasl.utils import (create_dirs, linear_asl_reg, setup,
                          binarise, get_ventricular_csf_mask)
 from hcpasl.tissue_masks import (generate_tissue_mask, 
-                                 generate_tissue_mask_in_ref_space)
+                                 generate_tissue_masks_in_ref_space)
+
+def _process_calib(calib_name, results_dir, gdc_warp_reg, names_dict, 
+                   t1_name, t1_brain_name, wm_mask, fmap, fmapmag, 
+                   fmapmagbrain, rois, interpolation, ignore_dropouts, 
+                   force_refresh):
+    """
+    Distortion- and bias-correct a single calibration image and apply 
+    the tissue masks to it. This is the per-image part of 
+    `setup_mtestimation()`; it only writes within `results_dir`.
+    """
+    # apply gdc to the calibration image
+    calib_name_stem = calib_name.stem.split(".")[0]
+    gdc_calib_name = results_dir/f"{calib_name_stem}_gdc.nii.gz"
+    if not gdc_calib_name.exists() or force_refresh:
+        gdc_calib = gdc_warp_reg.apply_to_image(
+            str(calib_name), str(calib_name), order=interpolation
+        )
+        nb.save(gdc_calib, gdc_calib_name)
+    
+    # estimate initial registration via asl_reg
+    asl_lin_reg = results_dir/"asl_reg_linear"
+    asl_lin_reg.mkdir(exist_ok=True)
+    asl2struct_lin = asl_lin_reg/"asl2struct.mat"
+    if not asl2struct_lin.exists() or force_refresh:
+        linear_asl_reg(gdc_calib_name, asl_lin_reg, t1_name, t1_brain_name, wm_mask)
+    init_linear = rt.Registration.from_flirt(str(asl2struct_lin),
+                                             src=str(calib_name), ref=str(t1_name))
+    
+    # run bet - should I instead get mask from T1 here?
+    bet_results = results_dir/"bet"
+    bet_mask = results_dir/"bet_mask.nii.gz"
+    if not bet_mask.exists() or force_refresh:
+        betted_m0 = bet(str(gdc_calib_name), str(bet_results), g=0.2, f=0.2, m=True)
+    
+    # get epi distortion correction warps
+    asl_nonlin_reg = results_dir/"asl_reg_nonlinear"
+    asl_nonlin_reg.mkdir(exist_ok=True)
+    struct2asl, asl2struct_warp = [
+        asl_nonlin_reg/n for n in ("struct2asl.mat", "asl2struct_warp.nii.gz")
+    ]
+    if not all([f.exists() for f in (asl2struct_warp, struct2asl)]) or force_refresh:
+        distortion_correction.generate_epidc_warp(
+            str(gdc_calib_name), str(t1_name), t1_brain_name, bet_mask, wm_mask,
+            init_linear, fmap, fmapmag, fmapmagbrain, str(asl_nonlin_reg)
+        )
+    
+    # chain gradient and epi distortion correction warps together
+    asl2struct_warp_reg = rt.NonLinearRegistration.from_fnirt(
+        str(asl2struct_warp), src=str(calib_name), ref=str(t1_name),
+        intensity_correct=True, constrain_jac=(0.01, 100)
+    )
+    struct2asl_reg = rt.Registration.from_flirt(
+        str(struct2asl), src=str(t1_name), ref=str(calib_name)
+    )
+    dc_warp = rt.chain(gdc_warp_reg, asl2struct_warp_reg, struct2asl_reg)
+    dc_calib_name = results_dir/f"{calib_name_stem}_dc.nii.gz"
+    if not dc_calib_name.exists() or force_refresh:
+        dc_calib = dc_warp.apply_to_image(
+            str(calib_name), str(calib_name), order=interpolation
+        )
+        nb.save(dc_calib, dc_calib_name)
+    
+    # estimate the bias field
+    bias_name = results_dir/f"{calib_name_stem}_bias.nii.gz"
+    sebased_dir = results_dir/"sebased"
+    if not bias_name.exists() or force_refresh:
+        sebased_dir.mkdir(exist_ok=True)
+        bias_field = bias_estimation(
+            dc_calib_name, "sebased", results_dir=sebased_dir, t1_name=t1_name,
+            t1_brain_name=t1_brain_name, aparc_aseg=names_dict["aparc_aseg"], 
+            fmapmag=fmapmag, fmapmagbrain=fmapmagbrain, interpolation=interpolation,
+            force_refresh=force_refresh, wmseg_name=wm_mask, struct2asl=struct2asl
+        )
+        nb.save(bias_field, bias_name)
+    else:
+        bias_field = nb.load(bias_name)
+    
+    # bias correct the distortion-corrected calibration image
+    bc_calib_name = results_dir/f"{calib_name_stem}_restore.nii.gz"
+    if not bc_calib_name.exists() or force_refresh:
+        fslmaths(str(dc_calib_name)).div(bias_field).run(str(bc_calib_name))
+
+    # create mask directories
+    roi_dirs = [results_dir/"masks"/roi for roi in rois]
+    create_dirs(roi_dirs)
+    # load Dropouts
+    dropouts_inv = nb.load(sebased_dir/"Dropouts_inv.nii.gz")
+    # get the tissue masks needed by every roi in calibration image 
+    # space, all generated and resampled together
+    roi_tissues = {roi: ("gm", "wm") if roi=="combined" else (roi,) 
+                   for roi in rois}
+    roi_names = {roi: [roi_dir/f"{t}_mask.nii.gz" for t in roi_tissues[roi]] 
+                 for roi, roi_dir in zip(rois, roi_dirs)}
+    todo = [roi for roi in rois 
+            if not all(n.exists() for n in roi_names[roi]) or force_refresh]
+    # csf masks are eroded, so are distinct from other rois' masks
+    keys = list(dict.fromkeys((t, roi == "csf") for roi in todo 
+                              for t in roi_tissues[roi]))
+    if keys:
+        tissues, erode = zip(*keys)
+        generated = dict(zip(keys, generate_tissue_masks_in_ref_space(
+            names_dict["aparc_aseg"], bc_calib_name, tissues, 
+            struct2ref=struct2asl, order=0, erode=list(erode)
+        )))
+    for roi, roi_dir in zip(rois, roi_dirs):
+        tissues, names = roi_tissues[roi], roi_names[roi]
+        if roi in todo:
+            masks = [generated[(t, roi == "csf")] for t in tissues]
+            [nb.save(m, n) for m, n in zip(masks, names)]
+        else:
+            masks = [nb.load(n) for n in names]
+        if ignore_dropouts:
+            # ignore dropout voxels
+            masks = [nb.nifti1.Nifti1Image(
+                                    m.get_fdata()*dropouts_inv.get_fdata(), 
+                                    affine=dropouts_inv.affine)
+                        for m in masks]
+            # save
+            [nb.save(m, n) for m, n in zip(masks, names)]
+        # apply tissue masks to bias- and distortion- corrected images
+        calib_masked_names = [roi_dir/f"{calib_name_stem}_{t}_masked.nii.gz"
+                              for t in tissues]
+        if not all(c.exists() for c in calib_masked_names) or force_refresh:
+            [fslmaths(str(bc_calib_name)).mul(mask).run(str(name))
+                          for mask, name in zip(masks, calib_masked_names)]
 
 def setup_mtestimation(subject_dir, coeffs_path, rois=['wm',],  
                         interpolation=3, ignore_dropouts=False,
@@ -79,115 +205,14 @@ def setup_mtestimation(subject_dir, coeffs_path, rois=['wm',],
         str(gdc_warp), src=str(calib0_name), ref=str(calib0_name),
         intensity_correct=True, constrain_jac=(0.01, 100)
     )
-    # apply gdc and epidc to both calibration images
-    for calib_name, results_dir in zip((calib0_name, calib1_name), calib_distcorr_dirs):
-        # apply gdc to the calibration image
-        calib_name_stem = calib_name.stem.split(".")[0]
-        gdc_calib_name = results_dir/f"{calib_name_stem}_gdc.nii.gz"
-        if not gdc_calib_name.exists() or force_refresh:
-            gdc_calib = gdc_warp_reg.apply_to_image(
-                str(calib_name), str(calib_name), order=interpolation
-            )
-            nb.save(gdc_calib, gdc_calib_name)
-        
-        # estimate initial registration via asl_reg
-        asl_lin_reg = results_dir/"asl_reg_linear"
-        asl_lin_reg.mkdir(exist_ok=True)
-        asl2struct_lin = asl_lin_reg/"asl2struct.mat"
-        if not asl2struct_lin.exists() or force_refresh:
-            linear_asl_reg(gdc_calib_name, asl_lin_reg, t1_name, t1_brain_name, wm_mask)
-        init_linear = rt.Registration.from_flirt(str(asl2struct_lin),
-                                                 src=str(calib_name), ref=str(t1_name))
-        
-        # run bet - should I instead get mask from T1 here?
-        bet_results = results_dir/"bet"
-        bet_mask = results_dir/"bet_mask.nii.gz"
-        if not bet_mask.exists() or force_refresh:
-            betted_m0 = bet(str(gdc_calib_name), str(bet_results), g=0.2, f=0.2, m=True)
-        
-        # get epi distortion correction warps
-        asl_nonlin_reg = results_dir/"asl_reg_nonlinear"
-        asl_nonlin_reg.mkdir(exist_ok=True)
-        struct2asl, asl2struct_warp = [
-            asl_nonlin_reg/n for n in ("struct2asl.mat", "asl2struct_warp.nii.gz")
-        ]
-        if not all([f.exists() for f in (asl2struct_warp, struct2asl)]) or force_refresh:
-            distortion_correction.generate_epidc_warp(
-                str(gdc_calib_name), str(t1_name), t1_brain_name, bet_mask, wm_mask,
-                init_linear, fmap, fmapmag, fmapmagbrain, str(asl_nonlin_reg)
-            )
-        
-        # chain gradient and epi distortion correction warps together
-        asl2struct_warp_reg = rt.NonLinearRegistration.from_fnirt(
-            str(asl2struct_warp), src=str(calib_name), ref=str(t1_name),
-            intensity_correct=True, constrain_jac=(0.01, 100)
-        )
-        struct2asl_reg = rt.Registration.from_flirt(
-            str(struct2asl), src=str(t1_name), ref=str(calib_name)
-        )
-        dc_warp = rt.chain(gdc_warp_reg, asl2struct_warp_reg, struct2asl_reg)
-        dc_calib_name = results_dir/f"{calib_name_stem}_dc.nii.gz"
-        if not dc_calib_name.exists() or force_refresh:
-            dc_calib = dc_warp.apply_to_image(
-                str(calib_name), str(calib_name), order=interpolation
-            )
-            nb.save(dc_calib, dc_calib_name)
-        
-        # estimate the bias field
-        bias_name = results_dir/f"{calib_name_stem}_bias.nii.gz"
-        if not bias_name.exists() or force_refresh:
-            sebased_dir = results_dir/"sebased"
-            sebased_dir.mkdir(exist_ok=True)
-            bias_field = bias_estimation(
-                dc_calib_name, "sebased", results_dir=sebased_dir, t1_name=t1_name,
-                t1_brain_name=t1_brain_name, aparc_aseg=names_dict["aparc_aseg"], 
-                fmapmag=fmapmag, fmapmagbrain=fmapmagbrain, interpolation=interpolation,
-                force_refresh=force_refresh, wmseg_name=wm_mask, struct2asl=struct2asl
-            )
-            nb.save(bias_field, bias_name)
-        else:
-            bias_field = nb.load(bias_name)
-        
-        # bias correct the distortion-corrected calibration image
-        bc_calib_name = results_dir/f"{calib_name_stem}_restore.nii.gz"
-        if not bc_calib_name.exists() or force_refresh:
-            fslmaths(str(dc_calib_name)).div(bias_field).run(str(bc_calib_name))
-
-        # create mask directories
-        roi_dirs = [results_dir/"masks"/roi for roi in rois]
-        create_dirs(roi_dirs)
-        # load Dropouts
-        dropouts_inv = nb.load(sebased_dir/"Dropouts_inv.nii.gz")
-        for roi, roi_dir in zip(rois, roi_dirs):
-            # get tissue masks in calibration image space
-            base_mask_call = partial(
-                generate_tissue_mask_in_ref_space,
-                aparc_aseg=names_dict["aparc_aseg"],
-                ref_img=bc_calib_name,
-                struct2ref=struct2asl,
-                order=0
-            )
-            tissues = ("gm", "wm") if roi=="combined" else (roi,)
-            names = [roi_dir/f"{t}_mask.nii.gz" for t in tissues]
-            if not all(n.exists() for n in names) or force_refresh:
-                if roi == "csf":
-                    masks = [base_mask_call(tissue=t, erode=True) for t in tissues]
-                else:
-                    masks = [base_mask_call(tissue=t) for t in tissues]
-                [nb.save(m, n) for m, n in zip(masks, names)]
-            else:
-                masks = [nb.load(n) for n in names]
-            if ignore_dropouts:
-                # ignore dropout voxels
-                masks = [nb.nifti1.Nifti1Image(
-                                        m.get_fdata()*dropouts_inv.get_fdata(), 
-                                        affine=dropouts_inv.affine)
-                            for m in masks]
-                # save
-                [nb.save(m, n) for m, n in zip(masks, names)]
-            # apply tissue masks to bias- and distortion- corrected images
-            calib_masked_names = [roi_dir/f"{calib_name_stem}_{t}_masked.nii.gz"
-                                  for t in tissues]
-            if not all(c.exists() for c in calib_masked_names) or force_refresh:
-                [fslmaths(str(bc_calib_name)).mul(mask).run(str(name))
-                              for mask, name in zip(masks, calib_masked_names)]
+    # apply gdc and epidc to both calibration images concurrently
+    calib_worker = partial(
+        _process_calib, gdc_warp_reg=gdc_warp_reg, names_dict=names_dict,
+        t1_name=t1_name, t1_brain_name=t1_brain_name, wm_mask=wm_mask,
+        fmap=fmap, fmapmag=fmapmag, fmapmagbrain=fmapmagbrain, rois=rois,
+        interpolation=interpolation, ignore_dropouts=ignore_dropouts,
+        force_refresh=force_refresh
+    )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # consume the results so that exceptions in workers are raised
+        list(executor.map(calib_worker, (calib0_name, calib1_name), calib_distcorr_dirs))
@@ -3,11 +3,14 @@ from .m0_mt_correction import correct_M0, generate_asl2struct
 from .asl_correction import hcp_asl_moco
 from .extract_fs_pvs import extract_fs_pvs
 from .asl_differencing import tag_control_differencing
-from .asl_perfusion import run_oxford_asl
+from .asl_perfusion import run_oxford_asl, OxfordASLRun, run_quick_perfusion
 from .projection import project_to_surface
 from .extract_fs_pvs import extract_fs_pvs
 from .distortion_correction import *
 from .bias_estimation import bias_estimation, METHODS
 from .utils import *
 from .MTEstimation import estimate_mt, setup_mtestimation
-from .tissue_masks import *
\ No newline at end of file
+from .tissue_masks import *
+from .resampling import MaskProjector, LabelResampler, apply_to_images
+from .surface_mapping import RibbonMapper
+from .surface_smoothing import SurfaceSmoother
@@ -12,16 +12,140 @@ Chappell, M.J.P. van Osch
 
 from .initial_bookkeeping import create_dirs
 from .m0_mt_correction import load_json, update_json
-from fsl.data.image import Image
 from pathlib import Path
-import subprocess
+import tempfile
 import numpy as np
+import nibabel as nb
 
-def tag_control_differencing(series, subject_dir, target='structural', nobandingcorr=False, outdir="hcp_asl"):
+def difference_pairs(series, scaling_factors, mask=None, tag_first=True, 
+                     chunk_pairs=8, out_perf=None, out_baseline=None, 
+                     return_variance=False):
+    """
+    GLM tag-control differencing of a scaled ASL series.
+
+    Each tag-control pair is modelled as 
+    `Y = X_tc * S * B_perf + B_baseline`, with `X_tc` equal to -0.5 
+    for tags and 0.5 for controls, and `S` the scaling factors. The 
+    2x2 system for each pair is solved in closed form for every 
+    voxel in `mask`. The series is read and solved in chunks of 
+    `chunk_pairs` pairs, in float32.
+
+    Parameters
+    ----------
+    series : array-like
+        4D ASL series, Y. Anything which can be sliced along its last 
+        axis, e.g. a nibabel ArrayProxy, so only one chunk is read 
+        into memory at a time.
+    scaling_factors : array-like
+        4D scaling factors, S, of the same shape as `series`.
+    mask : np.array, optional
+        3D boolean mask of the voxels to solve for. Default is all 
+        voxels. Voxels outside the mask are set to 0.
+    tag_first : bool, optional
+        Whether the tag is the first volume of each pair. Default is 
+        True.
+    chunk_pairs : int, optional
+        Number of pairs processed at a time. Default is 8.
+    out_perf, out_baseline : np.array, optional
+        Float32 arrays of shape (X, Y, Z, npairs) in which to write 
+        the results, e.g. memory-mapped arrays. They are allocated 
+        if not provided.
+    return_variance : bool, optional
+        If True, also return the variance of `B_perf` across pairs 
+        for every voxel. Default is False.
+
+    Returns
+    -------
+    B_perf : np.array
+        Perfusion-weighted difference for each pair.
+    B_baseline : np.array
+        Baseline signal for each pair.
+    variance : np.array
+        3D variance of B_perf across pairs (ddof=1), only returned 
+        if `return_variance` is True.
+    """
+    shape = series.shape
+    if shape != scaling_factors.shape:
+        raise ValueError("ASL series and scaling factors must have the same shape.")
+    if shape[3] % 2:
+        raise ValueError(f"ASL series has an odd number of volumes ({shape[3]}).")
+    n_pairs = shape[3] // 2
+    mask = np.ones(shape[:3], dtype=bool) if mask is None else mask.astype(bool)
+
+    out_shape = (*shape[:3], n_pairs)
+    if out_perf is None:
+        out_perf = np.zeros(out_shape, dtype=np.float32)
+    if out_baseline is None:
+        out_baseline = np.zeros(out_shape, dtype=np.float32)
+    if return_variance:
+        sums = np.zeros(mask.sum(), dtype=np.float64)
+        sumsqs = np.zeros(mask.sum(), dtype=np.float64)
+
+    # X_tc for the first and second volume of each pair
+    x_first, x_second = (-0.5, 0.5) if tag_first else (0.5, -0.5)
+    for p0 in range(0, n_pairs, chunk_pairs):
+        p1 = min(p0 + chunk_pairs, n_pairs)
+        Y = np.asarray(series[..., 2*p0:2*p1], dtype=np.float32)[mask]
+        S = np.asarray(scaling_factors[..., 2*p0:2*p1], dtype=np.float32)[mask]
+        Y_first, Y_second = Y[:, 0::2], Y[:, 1::2]
+        X_first, X_second = x_first * S[:, 0::2], x_second * S[:, 1::2]
+        del Y, S
+
+        # closed-form solution of the 2x2 system for each pair
+        denom = X_second - X_first
+        with np.errstate(divide='ignore', invalid='ignore'):
+            B_perf = np.where(denom != 0, (Y_second - Y_first) / denom, 0)
+            B_baseline = np.where(
+                denom != 0, (X_second*Y_first - X_first*Y_second) / denom, 0
+            )
+        out_perf[mask, p0:p1] = B_perf
+        out_baseline[mask, p0:p1] = B_baseline
+        if return_variance:
+            sums += B_perf.sum(axis=1)
+            sumsqs += (B_perf.astype(np.float64)**2).sum(axis=1)
+
+    if not return_variance:
+        return out_perf, out_baseline
+    variance = np.zeros(shape[:3], dtype=np.float32)
+    if n_pairs > 1:
+        variance[mask] = np.maximum(sumsqs - sums**2 / n_pairs, 0) / (n_pairs - 1)
+    return out_perf, out_baseline, variance
+
+def signal_mask(series, chunk_volumes=16):
+    """
+    Mask of the voxels which are non-zero in any volume of a series.
+
+    Parameters
+    ----------
+    series : array-like
+        4D series. Anything which can be sliced along its last axis, 
+        e.g. a nibabel ArrayProxy, so only one chunk is read into 
+        memory at a time.
+    chunk_volumes : int, optional
+        Number of volumes read at a time. Default is 16.
+
+    Returns
+    -------
+    np.array
+        3D boolean mask.
+    """
+    mask = np.zeros(series.shape[:3], dtype=bool)
+    for v0 in range(0, series.shape[3], chunk_volumes):
+        chunk = np.asarray(series[..., v0:v0+chunk_volumes])
+        mask |= np.any(chunk != 0, axis=-1)
+    return mask
+
+def tag_control_differencing(series, subject_dir, target='structural', 
+                             nobandingcorr=False, outdir="hcp_asl", 
+                             tag_first=True, variance=False):
     """
     Perform tag-control differencing of a scaled ASL sequence.
 
-    The method follows that in [1]_.
+    The method follows that in [1]_. The differencing is done by 
+    `difference_pairs()` on the voxels with signal in any volume 
+    (all other voxels would give 0), and the outputs 
+    are written through memory-mapped buffers, so that only one 
+    copy of the series is held in memory.
 
     Parameters
     ----------
@@ -33,6 +157,12 @@ def tag_control_differencing(series, subject_dir, target='structural', nobanding
         Target space.
     outdir : str
         Name of the main results directory. Default is 'hcp_asl'.
+    tag_first : bool, optional
+        Whether the tag is the first volume of each pair. Default is 
+        True.
+    variance : bool, optional
+        If True, also save the variance of the perfusion-weighted 
+        differences across pairs, as beta_perf_var. Default is False.
 
     .. [1] Suzuki, Yuriko, et al. "A framework for motion 
        correction of background suppressed arterial spin labeling 
@@ -50,39 +180,45 @@ def tag_control_differencing(series, subject_dir, target='structural', nobanding
         distcorr_dir = Path(json_dict['TIs_dir']) / 'MoCo'
     else:
         distcorr_dir = Path(json_dict['TIs_dir']) / "STCorr2"
-    Y_moco = Image(str(series))
+    Y_moco = nb.load(str(series))
 
     # load registered scaling factors, S_st
     sfs_name = distcorr_dir / 'combined_scaling_factors.nii.gz'
-    S_st = Image(str(sfs_name))
-
-    # calculate X_perf = X_tc * S_st
-    X_tc = np.ones((1, 1, 1, 86)) * 0.5
-    X_tc[0, 0, 0, 0::2] =  -0.5
-    X_perf = X_tc * S_st.data
-
-    # split X_perf and Y_moco into even and odd indices
-    X_odd = X_perf[:, :, :, 1::2]
-    X_even = X_perf[:, :, :, 0::2]
-    Y_odd = Y_moco.data[:, :, :, 1::2]
-    Y_even = Y_moco.data[:, :, :, 0::2]
+    S_st = nb.load(str(sfs_name))
 
-    # calculate B_perf and B_baseline
-    B_perf = (Y_odd - Y_even) / (X_odd - X_even)
-    B_baseline = (X_odd*Y_even - X_even*Y_odd) / (X_odd - X_even)
+    # only solve in voxels with signal in any volume; after motion 
+    # correction, voxels at the edge of the FoV may only have signal 
+    # in some of them
+    mask = signal_mask(Y_moco.dataobj)
 
-    # save both images
+    # difference into memory-mapped buffers and save both images
     beta_dir_name = distcorr_dir.parent / 'Betas'
     create_dirs([beta_dir_name, ])
     B_perf_name = beta_dir_name / 'beta_perf.nii.gz'
-    B_perf_img = Image(B_perf, header=Y_moco.header)
-    B_perf_img.save(B_perf_name)
     B_baseline_name = beta_dir_name / 'beta_baseline.nii.gz'
-    B_baseline_img = Image(B_baseline, header=Y_moco.header)
-    B_baseline_img.save(B_baseline_name)
+    header = Y_moco.header.copy()
+    header.set_data_dtype(np.float32)
+    out_shape = (*Y_moco.shape[:3], Y_moco.shape[3] // 2)
+    with tempfile.TemporaryDirectory(dir=beta_dir_name) as td:
+        B_perf, B_baseline = [
+            np.memmap(Path(td)/name, dtype=np.float32, mode='w+', shape=out_shape)
+            for name in ('perf.dat', 'baseline.dat')
+        ]
+        results = difference_pairs(Y_moco.dataobj, S_st.dataobj, mask=mask, 
+                                   tag_first=tag_first, out_perf=B_perf, 
+                                   out_baseline=B_baseline, 
+                                   return_variance=variance)
+        for data, name in zip((B_perf, B_baseline), (B_perf_name, B_baseline_name)):
+            nb.save(nb.nifti1.Nifti1Image(data, Y_moco.affine, header), name)
+        variance_map = results[2] if variance else None
+        del results, B_perf, B_baseline, data
 
     # add B_perf_name to the json as will be needed in oxford_asl
     important_names = {
         'beta_perf': str(B_perf_name)
     }
+    if variance:
+        B_var_name = beta_dir_name / 'beta_perf_var.nii.gz'
+        nb.save(nb.nifti1.Nifti1Image(variance_map, Y_moco.affine, header), B_var_name)
+        important_names['beta_perf_var'] = str(B_var_name)
     update_json(important_names, json_dict)
\ No newline at end of file
@@ -1,98 +1,227 @@
 from .m0_mt_correction import load_json, update_json
 from .initial_bookkeeping import create_dirs
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import subprocess
 import numpy as np
+import nibabel as nb
 from fsl.data.image import Image
-from fsl.wrappers import fslmaths
+from fabber import Fabber
 
-def run_fabber_asl(subject_dir, target='structural'):
-    json_dict = load_json(subject_dir)
-    structasl_dir = Path(json_dict['structasl'])
-    brain_mask = structasl_dir / 'reg/ASL_grid_T1w_acpc_dc_restore_brain_mask.nii.gz'
-    timing_image = structasl_dir / 'timing_img.nii.gz'
+REPEATS = [6, 6, 6, 10, 15]
 
-    # take mean of data for first 2 iterations
-    beta_perf_name = structasl_dir / 'TIs/Betas/beta_perf.nii.gz'
-    beta_perf_mean_name = structasl_dir / 'TIs/Betas/beta_perf_mean.nii.gz'
-    repeats = [6, 6, 6, 10, 15]
-    mean_call = [
-        "asl_file",
-        f"--data={beta_perf_name}",
-        "--ntis=5",
-        "--ibf=tis",
-        "--rpts=6,6,6,10,15",
-        "--iaf=diff",
-        "--obf=tis",
-        f"--mean={beta_perf_mean_name}"
-    ]
-    subprocess.run(mean_call, check=True)
+def repeat_mean(data, repeats=REPEATS):
+    """
+    Mean over the repeats of each TI of a series in TI blocks, as in 
+    `asl_file --ibf=tis --obf=tis --mean`.
 
-    base_command = [
-        "fabber_asl",
-        "--model=aslrest",
-        "--method=vb",
-        "--casl",
-        f"--mask={brain_mask}",
-        "--save-mvn",
-        "--overwrite",
-        "--incart",
-        "--inctiss",
-        "--infertiss",
-        "--incbat",
-        "--inferbat",
-        "--noise=white",
-        "--save-mean",
-        "--tau=1.5",
-        "--bat=1.3",
-        "--batsd=1.0",
-        "--allow-bad-voxels",
-        "--convergence=trialmode",
-        "--data-order=singlefile",
-        "--disp=none",
-        "--exch=mix",
-        "--max-iterations=20",
-        "--max-trials=10",
-        f"--tiimg={timing_image}"
-    ]
-    # iteration-specific options
+    Parameters
+    ----------
+    data : np.array
+        4D series with the repeats of each TI grouped together.
+    repeats : list of ints, optional
+        Number of repeats at each TI. Default is REPEATS.
+
+    Returns
+    -------
+    np.array
+        4D array with one volume per TI.
+    """
+    if data.shape[-1] != sum(repeats):
+        raise ValueError(f"Series has {data.shape[-1]} volumes, expected {sum(repeats)}.")
+    starts = np.cumsum([0, *repeats[:-1]])
+    return np.add.reduceat(data, starts, axis=-1) / np.array(repeats)
+
+def _aslrest_iterations(options, beta_perf, beta_perf_mean, mask, timing):
+    """
+    Run the four chained aslrest iterations in-process with pyfab 
+    within `mask`, passing the MVN between iterations in memory. 
+    Returns the final run's output data and log.
+    """
+    fab = Fabber()
+    mvn = None
     for iteration in range(4):
-        it_command = base_command.copy()
+        it_options = dict(options, mask=mask, tiimg=timing)
         # data
         if iteration == 0 or iteration == 1:
-            data = beta_perf_mean_name
+            it_options["data"] = beta_perf_mean
         else:
-            data = beta_perf_name
-        it_command.append(f"--data={data}")
+            it_options["data"] = beta_perf
         # inferart
         if iteration==1 or iteration==3:
-            it_command.append("--inferart")
-        # output dir
-        out_dir = beta_perf_name.parent / f'fabber_{iteration}'
-        it_command.append(f"--output={out_dir}")
+            it_options["inferart"] = True
         # continue from mvn
-        if iteration != 0:
-            mvn = beta_perf_name.parent / f'fabber_{iteration - 1}/finalMVN.nii.gz'
-            it_command.append(f"--continue-from-mvn={mvn}")
+        if mvn is not None:
+            it_options["continue-from-mvn"] = mvn
         # repeats
         if iteration >= 2:
-            for n, repeat in enumerate(repeats):
-                it_command.append(f"--rpt{n+1}={repeat}")
+            for n, repeat in enumerate(REPEATS):
+                it_options[f"rpt{n+1}"] = repeat
         # run
-        subprocess.run(it_command, check=True)
-    # threshold last run's perfusion estimate
-    mean_ftiss = str(out_dir / 'mean_ftiss.nii.gz')
-    fslmaths(mean_ftiss).thr(0).run(mean_ftiss)
+        run = fab.run(it_options)
+        mvn = run.data["finalMVN"]
+    return run.data, run.log
+
+def run_fabber_asl(subject_dir, target='structural', cores=1):
+    """
+    Estimate perfusion with four chained fabber aslrest iterations, 
+    run in-process with pyfab.
+
+    The VB fit is independent in each voxel, so with `cores` > 1 the 
+    brain mask is split into `cores` disjoint chunks which are fitted 
+    in a process pool, each chaining its own MVN between iterations. 
+    Each worker is only sent the slab of the images containing its 
+    chunk. The chunks' outputs are zero outside their masks, so they 
+    are summed to give the same result as a serial run. The final 
+    iteration's outputs are saved to Betas/fabber_3.
+    """
+    json_dict = load_json(subject_dir)
+    structasl_dir = Path(json_dict['structasl'])
+    brain_mask = structasl_dir / 'reg/ASL_grid_T1w_acpc_dc_restore_brain_mask.nii.gz'
+    timing_image = structasl_dir / 'timing_img.nii.gz'
+
+    # load data, taking the mean of the repeats for the first 2 iterations
+    beta_perf_name = structasl_dir / 'TIs/Betas/beta_perf.nii.gz'
+    beta_perf_img = nb.load(str(beta_perf_name))
+    beta_perf = beta_perf_img.get_fdata(dtype=np.float32)
+    beta_perf_mean = repeat_mean(beta_perf).astype(np.float32)
+    mask = nb.load(str(brain_mask)).get_fdata() > 0
+    timing = nb.load(str(timing_image)).get_fdata(dtype=np.float32)
+
+    options = {
+        "model": "aslrest",
+        "method": "vb",
+        "casl": True,
+        "save-mvn": True,
+        "incart": True,
+        "inctiss": True,
+        "infertiss": True,
+        "incbat": True,
+        "inferbat": True,
+        "noise": "white",
+        "save-mean": True,
+        "tau": 1.5,
+        "bat": 1.3,
+        "batsd": 1.0,
+        "allow-bad-voxels": True,
+        "convergence": "trialmode",
+        "data-order": "singlefile",
+        "disp": "none",
+        "exch": "mix",
+        "max-iterations": 20,
+        "max-trials": 10,
+    }
+    if cores > 1:
+        # the chunks are runs of voxels in C order, so each lies within
+        # a slab of the first axis and only that slab is sent to its worker
+        voxels = [chunk for chunk in np.array_split(np.flatnonzero(mask), cores)
+                  if chunk.size]
+        slabs = []
+        for chunk in voxels:
+            first, last = np.unravel_index(chunk[[0, -1]], mask.shape)[0]
+            slabs.append(slice(first, last + 1))
+        with ProcessPoolExecutor(max_workers=cores) as executor:
+            jobs = []
+            for chunk, slab in zip(voxels, slabs):
+                chunk_mask = np.zeros(mask.shape, dtype=np.float32)
+                chunk_mask.ravel()[chunk] = 1
+                jobs.append(executor.submit(
+                    _aslrest_iterations, options, beta_perf[slab],
+                    beta_perf_mean[slab], chunk_mask[slab], timing[slab]
+                ))
+            results = [job.result() for job in jobs]
+        outputs = {}
+        for slab, (data, _) in zip(slabs, results):
+            for key, value in data.items():
+                value = np.asarray(value)
+                if key not in outputs:
+                    outputs[key] = np.zeros(mask.shape + value.shape[3:],
+                                            dtype=value.dtype)
+                outputs[key][slab] += value
+        log = results[0][1]
+    else:
+        outputs, log = _aslrest_iterations(options, beta_perf, beta_perf_mean, 
+                                           mask.astype(np.float32), timing)
+
+    # threshold last run's perfusion estimate and save outputs
+    outputs["mean_ftiss"] = np.maximum(outputs["mean_ftiss"], 0)
+    out_dir = beta_perf_name.parent / 'fabber_3'
+    create_dirs([out_dir, ])
+    for key, data in outputs.items():
+        nb.save(nb.nifti1.Nifti1Image(np.asarray(data, dtype=np.float32), 
+                                      beta_perf_img.affine), 
+                out_dir/f'{key}.nii.gz')
+    (out_dir/'logfile').write_text(log)
     # add oxford_asl directory to the json
     important_names = {
         "oxford_asl": str(out_dir)
     }
     update_json(important_names, json_dict)
 
+class OxfordASLRun:
+    """
+    Handle on an oxford_asl process started by `run_oxford_asl()`.
+
+    The subject's json is only updated with the oxford_asl output 
+    directory once the process has been waited on, so several runs 
+    can be in flight at once.
+    """
+    def __init__(self, process, json_dir, oxford_dir):
+        self.process = process
+        self.json_dir = json_dir
+        self.oxford_dir = oxford_dir
+
+    def done(self):
+        """
+        Whether the oxford_asl process has finished.
+        """
+        return self.process.poll() is not None
+
+    def wait(self, check=False):
+        """
+        Wait for oxford_asl to finish and add its output directory to 
+        the subject's json.
+
+        Parameters
+        ----------
+        check : bool, optional
+            If True, raise a CalledProcessError if oxford_asl failed, 
+            in which case the json isn't updated. Default is False.
+
+        Returns
+        -------
+        int
+            oxford_asl's return code.
+        """
+        returncode = self.process.wait()
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.process.args)
+        important_names = {
+            "oxford_asl": str(self.oxford_dir)
+        }
+        update_json(important_names, load_json(self.json_dir))
+        return returncode
+
+    def terminate(self):
+        """
+        Stop oxford_asl if it is still running, and wait for it to exit.
+        """
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+
 def run_oxford_asl(subject_dir, target='structural', use_t1=False, pvcorr=False, 
                    use_sebased=False, nobandingcorr=False, outdir="hcp_asl"):
     """
-    Run oxford_asl on the HCP's ASL data.
+    Start oxford_asl on the HCP's ASL data.
+
+    oxford_asl is started in the background; call `.wait()` on the 
+    returned handle to wait for it to finish.
+
+    Returns
+    -------
+    OxfordASLRun
+        Handle on the running oxford_asl process.
     """
     # load subject's json
     json_dict = load_json(subject_dir/outdir)
@@ -100,7 +229,7 @@ def run_oxford_asl(subject_dir, target='structural', use_t1=False, pvcorr=False,
     # base oxford_asl options common to both cases
     cmd = [
         "oxford_asl",
-        f"-i {json_dict['beta_perf']}",
+        "-i", json_dict['beta_perf'],
         "--casl",
         "--ibf=tis",
         "--iaf=diff",
@@ -117,15 +246,15 @@ def run_oxford_asl(subject_dir, target='structural', use_t1=False, pvcorr=False,
         oxford_dir = Path(json_dict['TIs_dir']) / 'OxfordASL'
         brain_mask = Path(json_dict['structasl']) / 'reg/asl_vol1_mask_init.nii.gz'
         extra_args = [
-            f"-o {str(oxford_dir)}",
-            f"-m {str(brain_mask)}",
+            "-o", str(oxford_dir),
+            "-m", str(brain_mask),
             "--tis=1.7,2.2,2.7,3.2,3.7",
             "--slicedt=0.059",
             "--sliceband=10"
         ]
         if use_t1:
             est_t1 = Path(json_dict['TIs_dir']) / 'SatRecov2/spatial/mean_T1t_filt.nii.gz'
-            extra_args.append(f"--t1im {str(est_t1)}")
+            extra_args += ["--t1im", str(est_t1)]
     else:
         structasl_dir = Path(json_dict['structasl'])
         oxford_dir = structasl_dir / 'TIs/OxfordASL'
@@ -142,25 +271,221 @@ def run_oxford_asl(subject_dir, target='structural', use_t1=False, pvcorr=False,
         brain_mask = structasl_dir / 'reg/ASL_grid_T1w_acpc_dc_restore_brain_mask.nii.gz'
         timing_image = structasl_dir / 'timing_img.nii.gz'
         extra_args = [
-            f"-o {str(oxford_dir)}",
+            "-o", str(oxford_dir),
             f"--pvgm={str(pvgm_name)}",
             f"--pvwm={str(pvwm_name)}",
             f"--csf={str(csf_mask_name)}",
-            f"-c {str(calib_name)}",
-            f"-m {str(brain_mask)}",
+            "-c", str(calib_name),
+            "-m", str(brain_mask),
             f"--tiimg={timing_image}"
         ]
         if use_t1:
             est_t1 = structasl_dir / 'reg/mean_T1t_filt.nii.gz'
-            extra_args.append(f"--t1im {str(est_t1)}")
+            extra_args += ["--t1im", str(est_t1)]
         if pvcorr:
             extra_args.append("--pvcorr")
     cmd = cmd + extra_args
     print(" ".join(cmd))
-    subprocess.run(" ".join(cmd), shell=True)
+    process = subprocess.Popen(cmd)
+    return OxfordASLRun(process, subject_dir/outdir, oxford_dir)
+
+def buxton_pcasl(ti, att, tau=1.5, t1=1.3, t1b=1.65):
+    """
+    Buxton general kinetic model for pCASL tissue signal, per unit 
+    perfusion (with M0a = 1 and inversion efficiency applied at 
+    calibration, as in fabber's aslrest model).
+
+    Parameters
+    ----------
+    ti : np.array
+        Time since the start of labelling (label duration plus 
+        post-labelling delay), in seconds.
+    att : np.array
+        Arterial transit time, in seconds. Broadcast against `ti`.
+    tau : float, optional
+        Label duration, in seconds. Default is 1.5.
+    t1 : float, optional
+        Tissue T1, in seconds. Default is 1.3.
+    t1b : float, optional
+        Blood T1, in seconds. Default is 1.65.
+
+    Returns
+    -------
+    np.array
+        Model signal.
+    """
+    scale = 2 * t1 * np.exp(-att / t1b)
+    during = scale * (1 - np.exp(-(ti - att) / t1))
+    after = scale * np.exp(-(ti - tau - att) / t1) * (1 - np.exp(-tau / t1))
+    return np.where(ti < att, 0., np.where(ti < att + tau, during, after))
+
+def fit_buxton_lut(data, ti, repeats=REPEATS, atts=np.arange(0., 3.005, 0.01), 
+                   tau=1.5, t1=1.3, t1b=1.65, bat=1.3, batsd=1.0, 
+                   chunk_size=4096):
+    """
+    Fit perfusion and arrival time for many voxels at once by 
+    searching a lookup table of arrival times.
+
+    For each candidate arrival time the model is linear in perfusion, 
+    so the least-squares perfusion and residual are closed form. The 
+    arrival time minimising the residual, plus a Gaussian prior on 
+    the arrival time as used by fabber, is kept for each voxel. The 
+    prior only matters where the data cannot identify the arrival 
+    time, e.g. when every TI falls after the bolus has fully arrived.
+
+    The model curves are evaluated once for each distinct row of 
+    TIs (in practice one per slice timing), so the search over all 
+    voxels reduces to matrix products.
+
+    Parameters
+    ----------
+    data : np.array
+        (nvoxels, nvolumes) perfusion-weighted differences, with the 
+        repeats of each TI grouped together.
+    ti : np.array
+        (nvoxels, nTIs) TI of each voxel for each TI block.
+    repeats : list of ints, optional
+        Number of repeats at each TI. Default is REPEATS.
+    atts : np.array, optional
+        Evenly spaced arrival times to search. Default is 0-3s in 
+        steps of 0.01s.
+    tau, t1, t1b : float, optional
+        Model constants, see `buxton_pcasl()`.
+    bat, batsd : float, optional
+        Mean and standard deviation of the prior on arrival time. 
+        Defaults are 1.3 and 1.0, as passed to fabber.
+    chunk_size : int, optional
+        Number of voxels searched at a time. Default is 4096.
+
+    Returns
+    -------
+    perfusion, arrival, perfusion_var, arrival_var : np.array
+        Estimates and approximate variances for each voxel.
+    """
+    repeats = np.asarray(repeats)
+    n_vox, n_vols = data.shape
+    wy = repeats * repeat_mean(data, repeats)
+    y_sumsq = (data.astype(np.float64)**2).sum(1)
+
+    # model curves and their weighted norms for each distinct TI row; 
+    # weighted sums over TIs are equivalent to sums over all volumes
+    ti_rows, row_index = np.unique(ti, axis=0, return_inverse=True)
+    row_index = row_index.reshape(-1)
+    curves = buxton_pcasl(ti_rows[:, None, :], atts[None, :, None], tau, t1, t1b)
+    norms = (repeats * curves**2).sum(2)
+    prior = ((atts - bat) / batsd)**2
+    step = atts[1] - atts[0]
+
+    perfusion, arrival, perfusion_var, arrival_var = [
+        np.zeros(n_vox) for _ in range(4)
+    ]
+    for start in range(0, n_vox, chunk_size):
+        chunk = slice(start, min(start + chunk_size, n_vox))
+        rows = row_index[chunk]
+        gg = norms[rows]
+        gy = np.empty_like(gg)
+        for row in np.unique(rows):
+            in_row = rows == row
+            gy[in_row] = wy[chunk][in_row] @ curves[row].T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rss = np.where(gg > 0, y_sumsq[chunk, None] - gy**2 / gg, 
+                           y_sumsq[chunk, None])
+        rss = np.maximum(rss, 0)
+
+        # cost in units of chi^2, with the noise variance taken from 
+        # the best unpenalised fit, floored at the rounding error of
+        # the residuals so that exact fits give a finite cost
+        sigma2 = rss.min(1) / (n_vols - 2)
+        eps = np.finfo(np.float64).eps
+        scale = np.maximum(sigma2, np.maximum(eps * y_sumsq[chunk] / n_vols,
+                                              np.finfo(np.float64).tiny))
+        cost = rss / scale[:, None] + prior
+
+        best = cost.argmin(1)
+        vox = np.arange(best.size)
+        gg_best, gy_best = gg[vox, best], gy[vox, best]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            perfusion[chunk] = np.where(gg_best > 0, gy_best / gg_best, 0)
+            perfusion_var[chunk] = np.where(gg_best > 0, sigma2 / gg_best, 0)
+        arrival[chunk] = atts[best]
+
+        # arrival variance from the curvature of the cost around the 
+        # minimum, var = 2 / (d^2 cost / d att^2), plus the grid 
+        # spacing's quantisation error
+        inner = np.clip(best, 1, len(atts) - 2)
+        curvature = (cost[vox, inner - 1] - 2 * cost[vox, inner] 
+                     + cost[vox, inner + 1]) / step**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            arrival_var[chunk] = (np.where(curvature > 0, 2 / curvature, batsd**2) 
+                                  + step**2 / 12)
+    return perfusion, arrival, perfusion_var, arrival_var
+
+def run_quick_perfusion(subject_dir, target='structural', outdir="hcp_asl", 
+                        alpha=0.85, pc=0.9):
+    """
+    Quick-look alternative to `run_oxford_asl()` for QC.
+
+    Fits the Buxton pCASL model to beta_perf in all brain voxels at 
+    once with `fit_buxton_lut()`, using the voxelwise timing image. 
+    Results are saved in oxford_asl's layout, 
+    OxfordASL/native_space/{perfusion,arrival}{,_var}.nii.gz, so the 
+    later stages can run on them unchanged. There are no partial 
+    volume corrected results, so only the uncorrected variants 
+    should be projected to the surface. In structural space, 
+    perfusion_calib and perfusion_var_calib are also saved, using 
+    voxelwise calibration with the distortion-corrected calib0.
+
+    Parameters
+    ----------
+    subject_dir : pathlib.Path
+        Path to the subject's base directory.
+    target : str, {'structural', 'asl'}
+        Target space.
+    outdir : str
+        Name of the main results directory. Default is 'hcp_asl'.
+    alpha : float, optional
+        Labelling efficiency used in calibration. Default is 0.85.
+    pc : float, optional
+        Brain/blood partition coefficient used in calibration. 
+        Default is 0.9.
+    """
+    json_dict = load_json(subject_dir/outdir)
+    if target == 'asl':
+        tis_dir = Path(json_dict['TIs_dir'])
+        oxford_dir = tis_dir / 'OxfordASL'
+        brain_mask = Path(json_dict['structasl']) / 'reg/asl_vol1_mask_init.nii.gz'
+        timing_image = tis_dir / 'timing_img.nii.gz'
+        calib_name = None
+    else:
+        structasl_dir = Path(json_dict['structasl'])
+        oxford_dir = structasl_dir / 'TIs/OxfordASL'
+        brain_mask = structasl_dir / 'reg/ASL_grid_T1w_acpc_dc_restore_brain_mask.nii.gz'
+        timing_image = structasl_dir / 'timing_img.nii.gz'
+        calib_name = structasl_dir / 'Calib/Calib0/DistCorr/calib0_dcorr.nii.gz'
+
+    beta_perf_img = nb.load(json_dict['beta_perf'])
+    mask = nb.load(str(brain_mask)).get_fdata() > 0
+    data = beta_perf_img.get_fdata(dtype=np.float32)[mask]
+    ti = nb.load(str(timing_image)).get_fdata(dtype=np.float32)[mask]
+    results = fit_buxton_lut(data, ti)
+
+    names = ['perfusion', 'arrival', 'perfusion_var', 'arrival_var']
+    if calib_name is not None:
+        m0 = nb.load(str(calib_name)).get_fdata()[mask]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(m0 > 0, 6000 * pc / (alpha * m0), 0)
+        results = (*results, results[0] * scale, results[2] * scale**2)
+        names += ['perfusion_calib', 'perfusion_var_calib']
+
+    native_dir = oxford_dir / 'native_space'
+    create_dirs([native_dir, ])
+    for name, result in zip(names, results):
+        out = np.zeros(mask.shape, dtype=np.float32)
+        out[mask] = result
+        nb.save(nb.nifti1.Nifti1Image(out, beta_perf_img.affine), 
+                native_dir/f'{name}.nii.gz')
 
-    # add oxford_asl directory to the json
     important_names = {
         "oxford_asl": str(oxford_dir)
     }
-    update_json(important_names, json_dict)
\ No newline at end of file
+    update_json(important_names, json_dict)
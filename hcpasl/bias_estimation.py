@@ -4,14 +4,15 @@ import regtricks as rt
 
 from hcpasl import distortion_correction
 from hcpasl.utils import binarise
-from hcpasl.tissue_masks import generate_tissue_mask_in_ref_space
+from hcpasl.tissue_masks import (generate_tissue_mask_in_ref_space, 
+                                 generate_gm_masks_from_luts)
+from hcpasl.filters import dilM, dilall, normalised_convolution
+from hcpasl.utils import BackgroundWriter
 
 import numpy as np
 
 from pathlib import Path
 
-import subprocess
-
 def bias_estimation_calib(calib_name):
     """
     Estimate the bias field from a calibration image using FAST.
@@ -71,6 +72,252 @@ def bias_estimation_t1(
     )
     return bias_field
 
+def sebased_bias_field(m0, sem, mask, tissue_mask, writer=None, cores=1):
+    """
+    Estimate the bias field of an M0 image using the HCP's SE-based 
+    approach, replicating ComputeSpinEchoBiasField.sh.
+
+    This works entirely on arrays in memory. Intermediate images, and 
+    the SE/M0 ratio's median, standard deviation and thresholds, are 
+    only saved if a `writer` is provided.
+
+    Parameters
+    ----------
+    m0 : np.array
+        Calibration (M0) image.
+    sem : np.array
+        Spin echo (fieldmap magnitude) mean image in the same space.
+    mask : np.array
+        Brain mask in the same space.
+    tissue_mask : np.array
+        Grey matter (or other tissue) mask in the same space.
+    writer : hcpasl.utils.BackgroundWriter, optional
+        If provided, intermediate images are saved with it.
+    cores : int, optional
+        Number of threads used for the masked smoothing. Default is 1.
+
+    Returns
+    -------
+    bias : np.array
+        The SE-based bias field, after two rounds of mean dilation 
+        (i.e. sebased_bias_dil).
+    dropouts : np.array
+        Map of the dropout voxels (1 in dropouts, 0 elsewhere).
+    """
+    save = writer.save if writer is not None else lambda *args: None
+    mask = mask != 0
+
+    # find ratio between SpinEchoMean and M0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        SEdivM0 = np.where(m0!=0, sem/m0, 0)
+    save(SEdivM0, 'SEdivM0')
+
+    # apply mask to ratio
+    SEdivM0_brain = SEdivM0 * mask
+    save(SEdivM0_brain, 'SEdivM0_brain')
+
+    # get summary stats for thresholding
+    median, std = np.median(SEdivM0_brain[mask]), np.std(SEdivM0_brain[mask])
+    lower, upper = [median - (std/3), median + (std/3)]
+    if writer is not None:
+        [np.savetxt(writer.outdir/f'ratio_{stat}.txt', [val]) 
+         for stat, val in zip(('median', 'std', 'lower', 'upper'), 
+                              (median, std, lower, upper))]
+
+    # apply thresholding
+    SEdivM0_brain_thr = np.where(
+        np.logical_and(SEdivM0_brain >= lower, SEdivM0_brain <= upper),
+        SEdivM0_brain,
+        0
+    )
+    save(SEdivM0_brain_thr, 'SEdivM0_brain_thr')
+
+    # set sigma for smoothing used in HCPPipeline
+    fwhm = 5
+    sigma = fwhm / np.sqrt(8*np.log(2))
+    # binarise and smooth the thresholded image
+    SEdivM0_brain_thr_roi = np.where(SEdivM0_brain_thr>0, 1, 0).astype(float)
+    SEdivM0_brain_thr_s5, SEdivM0_brain_thr_roi_s5 = normalised_convolution(
+        SEdivM0_brain_thr, SEdivM0_brain_thr_roi, sigma, cores=cores
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        SEdivM0_brain_bias = np.where(
+            np.logical_and(SEdivM0_brain_thr_roi_s5!=0, mask),
+            (SEdivM0_brain_thr_s5 / SEdivM0_brain_thr_roi_s5),
+            0
+        )
+    [save(array, f'SEdivM0_brain_{name}') for array, name in zip(
+        (SEdivM0_brain_thr_roi, SEdivM0_brain_thr_s5, SEdivM0_brain_thr_roi_s5, SEdivM0_brain_bias),
+        ('thr_roi', 'thr_s5', 'thr_roi_s5', 'bias')
+    )]
+
+    # correct the SEFM image
+    with np.errstate(divide='ignore', invalid='ignore'):
+        SpinEchoMean_brain_BC = np.where(
+            np.logical_and(mask, SEdivM0_brain_bias!=0), 
+            sem/SEdivM0_brain_bias, 
+            0
+        )
+    save(SpinEchoMean_brain_BC, 'SpinEchoMean_brain_BC')
+
+    # get ratio between bias-corrected FM and M0 image
+    with np.errstate(divide='ignore', invalid='ignore'):
+        SEBCdivM0_brain = np.where(
+            np.logical_and(mask, SpinEchoMean_brain_BC!=0), 
+            m0/SpinEchoMean_brain_BC, 
+            0
+        )
+    save(SEBCdivM0_brain, 'SEBCdivM0_brain')
+
+    # find dropouts
+    Dropouts = np.where(
+        np.logical_and(SEBCdivM0_brain>0, SEBCdivM0_brain<0.6), 1, 0)
+    Dropouts_inv = np.where(Dropouts==1, 0, 1)
+    save(Dropouts, 'Dropouts')
+    save(Dropouts_inv, 'Dropouts_inv')
+
+    # mask M0 image with both the tissue mask and Dropouts_inv mask
+    M0_grey = np.where(np.logical_and(tissue_mask==1, Dropouts_inv==1), m0, 0).astype(float)
+    M0_greyroi = np.where(M0_grey!=0, 1, 0).astype(float)
+    M0_grey_s5, M0_greyroi_s5 = normalised_convolution(
+        M0_grey, M0_greyroi, sigma, cores=cores
+    )
+    [save(array, f'M0_grey{part}') for array, part in zip(
+        (M0_grey, M0_greyroi, M0_grey_s5, M0_greyroi_s5), ('', 'roi', '_s5', 'roi_s5')
+    )]
+
+    # M0_bias_raw is filled with dilall and re-masked
+    with np.errstate(divide='ignore', invalid='ignore'):
+        M0_bias_raw = np.where(
+            np.logical_and(tissue_mask!=0, M0_greyroi_s5!=0), 
+            M0_grey_s5/M0_greyroi_s5, 
+            0
+        )
+    M0_bias_raw = dilall(M0_bias_raw) * mask
+    save(M0_bias_raw, 'M0_bias_raw')
+
+    # refine bias field
+    M0_bias_roi = np.where(M0_bias_raw>0, 1, 0).astype(float)
+    M0_bias_raw_s5, M0_bias_roi_s5 = normalised_convolution(
+        M0_bias_raw, M0_bias_roi, sigma, cores=cores
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        M0_bias = np.where(
+            np.logical_and(mask, M0_bias_roi_s5!=0), 
+            M0_bias_raw_s5/M0_bias_roi_s5, 
+            0
+        )
+    [save(array, f'M0_bias{part}') for array, part in zip(
+        (M0_bias_roi, M0_bias_raw_s5, M0_bias_roi_s5, M0_bias), ('roi', 'raw_s5', 'roi_s5', '')
+    )]
+
+    # get sebased bias - should get ref also but leaving for now
+    sebased_bias = M0_bias / M0_bias[mask].mean()
+    save(sebased_bias, 'sebased_bias')
+
+    # apply 2 rounds of dilation to sebased_bias
+    sebased_bias_dil = dilM(sebased_bias, iterations=2)
+    save(sebased_bias_dil, 'sebased_bias_dil')
+    return sebased_bias_dil, Dropouts
+
+def sebased_bias_correct(calib_name, fmapmag_name, mask_name, outdir, 
+                         asl_name=None, tissue_mask=None, wmparc=None, 
+                         ribbon=None, corticallut=None, subcorticallut=None, 
+                         struct2calib=None, debug=False, cores=1, 
+                         cache_dir=None):
+    """
+    Estimate the SE-based bias field of a calibration image and 
+    apply it to the calibration image and, optionally, an ASL series.
+
+    Saves `sebased_bias_dil.nii.gz` and `calib0_secorr.nii.gz` (and 
+    `tis_secorr.nii.gz` if `asl_name` is provided) in `outdir`.
+
+    Parameters
+    ----------
+    calib_name : pathlib.Path
+        Calibration image from which to estimate the bias field.
+    fmapmag_name : pathlib.Path
+        Fieldmap magnitude image in the same space.
+    mask_name : pathlib.Path
+        Brain mask in the same space.
+    outdir : pathlib.Path
+        Output directory.
+    asl_name : pathlib.Path, optional
+        ASL series to which the bias field should also be applied.
+    tissue_mask : pathlib.Path, optional
+        Tissue mask to use instead of a grey matter mask derived 
+        from `wmparc` and `ribbon`.
+    wmparc, ribbon, corticallut, subcorticallut : pathlib.Path, optional
+        FreeSurfer segmentations and label tables from which to 
+        derive the grey matter mask. Required if `tissue_mask` 
+        isn't provided.
+    struct2calib : regtricks.Registration, optional
+        Registration from the segmentations' space to the 
+        calibration image. Default is identity.
+    debug : bool, optional
+        If True, all intermediate images are saved. Default is 
+        False.
+    cores : int, optional
+        Number of threads used for the masked smoothing. Default is 1.
+    cache_dir : str or pathlib.Path, optional
+        Where to cache the segmentations downsampled to calibration 
+        space. See `hcpasl.utils.get_cache_dir()`.
+
+    Returns
+    -------
+    bias : np.array
+        The (dilated) SE-based bias field.
+    dropouts : np.array
+        Map of the dropout voxels.
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    m0_img, sem_img, mask_img = [nb.load(str(name)) 
+                                 for name in (calib_name, fmapmag_name, mask_name)]
+    writer = BackgroundWriter(outdir, m0_img) if debug else None
+    try:
+        if tissue_mask:
+            tissue_mask = rt.Registration.identity().apply_to_image(
+                str(tissue_mask), m0_img, order=0
+            ).get_fdata()
+            if writer is not None:
+                writer.save(tissue_mask, 'TissueMask')
+        else:
+            cgm, scgm = generate_gm_masks_from_luts(wmparc, ribbon, corticallut, 
+                                                    subcorticallut, m0_img, 
+                                                    struct2calib, cache_dir)
+            tissue_mask = np.where(np.logical_or(cgm==1, scgm==1), 1, 0)
+            if writer is not None:
+                writer.save(cgm, 'CorticalGreyMatter')
+                writer.save(scgm, 'SubcorticalGreyMatter')
+                writer.save(tissue_mask, 'AllGreyMatter')
+
+        m0 = m0_img.get_fdata()
+        bias, dropouts = sebased_bias_field(m0, sem_img.get_fdata(), 
+                                            mask_img.get_fdata(), tissue_mask, 
+                                            writer=writer, cores=cores)
+        if writer is None:
+            nb.save(nb.nifti1.Nifti1Image(bias, m0_img.affine, m0_img.header), 
+                    outdir/'sebased_bias_dil.nii.gz')
+
+        # apply bias field to calibration and ASL images
+        with np.errstate(divide='ignore', invalid='ignore'):
+            calib_bc = np.where(bias!=0, m0/bias, m0)
+        nb.save(nb.nifti1.Nifti1Image(calib_bc, m0_img.affine, m0_img.header), 
+                outdir/'calib0_secorr.nii.gz')
+        if asl_name:
+            asl_img = nb.load(str(asl_name))
+            asl = asl_img.get_fdata()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                asl_bc = np.where(bias[..., np.newaxis]!=0, 
+                                  asl/bias[..., np.newaxis], asl)
+            nb.save(nb.nifti1.Nifti1Image(asl_bc, asl_img.affine, asl_img.header), 
+                    outdir/'tis_secorr.nii.gz')
+    finally:
+        if writer is not None:
+            writer.close()
+    return bias, dropouts
+
 def bias_estimation_sebased(
     calib_name, struct2asl, wmseg_name, results_dir, t1_name,
     t1_brain_name, aparc_aseg,
@@ -150,16 +397,21 @@ def bias_estimation_sebased(
         nb.save(aslt1_mask, brain_mask)
     # get sebased bias
     bias_name = results_dir/"sebased_bias_dil.nii.gz"
-    if not bias_name.exists() or force_refresh:
-        sebased_cmd = [
-            "get_sebased_bias", "-i", calib_name, "-f", fmapmag_calib_name,
-            "-m", brain_mask, "-o", results_dir, "--tissue_mask", gm_seg_name, "--debug"
-        ]
-        subprocess.run(sebased_cmd, check=True)
+    dropouts_inv_name = results_dir/"Dropouts_inv.nii.gz"
+    calib_img = nb.load(calib_name)
+    if not all(n.exists() for n in (bias_name, dropouts_inv_name)) or force_refresh:
+        bias, dropouts = sebased_bias_field(
+            calib_img.get_fdata(), nb.load(fmapmag_calib_name).get_fdata(),
+            nb.load(brain_mask).get_fdata(), nb.load(gm_seg_name).get_fdata()
+        )
+        nb.save(nb.nifti1.Nifti1Image(bias, calib_img.affine), bias_name)
+        nb.save(nb.nifti1.Nifti1Image(np.where(dropouts==1, 0., 1.), calib_img.affine), 
+                dropouts_inv_name)
+    else:
+        bias = nb.load(bias_name).get_fdata()
     dilall_name = results_dir/"sebased_bias_dilall.nii.gz"
-    dilall_cmd = ["fslmaths", bias_name, "-dilall", dilall_name]
-    subprocess.run(dilall_cmd, check=True)
-    bias_field = nb.load(dilall_name)
+    bias_field = nb.nifti1.Nifti1Image(dilall(bias), calib_img.affine)
+    nb.save(bias_field, dilall_name)
     return bias_field
 
 METHODS = ("calib", "t1", "sebased")
@@ -0,0 +1,433 @@
+"""
+Projection of the perfusion results to the CIFTI grayordinates:
+ribbon-constrained mapping to the native surfaces, resampling to the
+32k_fs_LR mesh, surface smoothing, subcortical processing in MNI
+space and creation of the dense scalar files.
+
+This performs the same steps as PerfusionCIFTIProcessingPipeline.sh
+(and VolumetoSurface.sh, SurfaceSmooth.sh, SubcorticalProcessing.sh
+and CreateDenseScalar.sh), but products shared between the ASL
+variables are created once and the independent wb_command chains,
+one per variable, hemisphere and subcortical stream, are run
+concurrently. The surface smoothing of all variables can instead be
+done in-process (see `hcpasl.surface_smoothing`), though this has not
+yet been checked against wb_command on real surfaces, so it is off by
+default.
+"""
+
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from multiprocessing import cpu_count
+from pathlib import Path
+
+import numpy as np
+import nibabel as nb
+from nibabel import cifti2
+import regtricks as rt
+
+from .initial_bookkeeping import create_dirs
+from .resampling import apply_to_images
+from .surface_smoothing import SurfaceSmoother, fwhm_to_sigma
+
+ASL_VARIABLES = (("perfusion_calib", "perfusion_var_calib"),
+                 ("arrival", "arrival_var"))
+
+def make_asl_grid_mni(asl_name, mni_name, out_name):
+    """
+    Create the ASL-gridded MNI-space reference image, i.e. the MNI
+    template resampled to the voxel size of the ASL results.
+
+    Parameters
+    ----------
+    asl_name : pathlib.Path
+        An ASL-gridded (T1w-space) image whose voxel size is used.
+    mni_name : pathlib.Path
+        The MNI template.
+    out_name : pathlib.Path
+        Path for the ASL-gridded MNI image.
+    """
+    perfusion_spc = rt.ImageSpace(str(asl_name))
+    mni_spc = rt.ImageSpace(str(mni_name))
+    mni_asl_grid = mni_spc.resize_voxels(perfusion_spc.vox_size / mni_spc.vox_size)
+    nb.save(rt.Registration.identity().apply_to_image(str(mni_name), mni_asl_grid),
+            str(out_name))
+
+def results_to_mni(warp_name, asl_names, t1_name, mni_name, asl_grid_mni, 
+                   out_names, cores=1):
+    """
+    Warp ASL-gridded T1w-space ASL variables to ASL-gridded MNI space.
+
+    The warp is loaded once and all of the variables are resampled 
+    together as the channels of a single 4D array.
+
+    Parameters
+    ----------
+    warp_name : pathlib.Path
+        FNIRT coefficients of the T1w to MNI warp 
+        (acpc_dc2standard.nii.gz).
+    asl_names : list of pathlib.Path
+        ASL variables in ASL-gridded T1w space, all on the same grid.
+    t1_name : pathlib.Path
+        T1w image (T1w_acpc_dc_restore.nii.gz), the warp's source.
+    mni_name : pathlib.Path
+        MNI template, the warp's reference.
+    asl_grid_mni : pathlib.Path
+        ASL-gridded MNI-space reference. It is created with 
+        `make_asl_grid_mni()` if it doesn't exist.
+    out_names : list of pathlib.Path
+        Paths for the MNI-space variables, in the same order as 
+        `asl_names`.
+    cores : int, optional
+        Number of cores to use for the resampling. Default is 1.
+    """
+    if len(asl_names) != len(out_names):
+        raise ValueError("There must be one output name per ASL variable.")
+    if not Path(asl_grid_mni).exists():
+        make_asl_grid_mni(asl_names[0], mni_name, asl_grid_mni)
+    the_warp = rt.NonLinearRegistration.from_fnirt(str(warp_name), str(t1_name), 
+                                                   str(mni_name))
+    mni_imgs = apply_to_images(the_warp, asl_names, str(asl_grid_mni), cores=cores)
+    for mni_img, out_name in zip(mni_imgs, out_names):
+        nb.save(mni_img, str(out_name))
+
+def grayordinate_axis(left_roi, right_roi, subcortical):
+    """
+    Build the brain models of a dense CIFTI file: the cortical 
+    vertices of each hemisphere within its atlas ROI, followed by 
+    the subcortical voxels.
+
+    Parameters
+    ----------
+    left_roi, right_roi : pathlib.Path or np.array
+        Atlas ROI shapes (e.g. <subject>.L.atlasroi.32k_fs_LR.shape.gii) 
+        or their values; vertices where the ROI is positive are 
+        included.
+    subcortical : pathlib.Path or nibabel.cifti2.BrainModelAxis
+        A CIFTI file whose brain models (e.g. the atlas subcortical 
+        template made from Atlas_ROIs) give the subcortical voxels, 
+        or those brain models.
+
+    Returns
+    -------
+    nibabel.cifti2.BrainModelAxis
+    """
+    rois = [nb.load(str(roi)).agg_data() if isinstance(roi, (str, Path)) else roi
+            for roi in (left_roi, right_roi)]
+    if not isinstance(subcortical, cifti2.BrainModelAxis):
+        subcortical = nb.load(str(subcortical)).header.get_axis(1)
+    return (cifti2.BrainModelAxis.from_mask(np.asarray(rois[0]) > 0, name="CortexLeft")
+            + cifti2.BrainModelAxis.from_mask(np.asarray(rois[1]) > 0, name="CortexRight")
+            + subcortical)
+
+def save_dense_scalar(brain_models, left, right, subcortical, map_names, out_name):
+    """
+    Save one or more maps as a CIFTI dense scalar (.dscalar.nii) file.
+
+    Parameters
+    ----------
+    brain_models : nibabel.cifti2.BrainModelAxis
+        See `grayordinate_axis()`.
+    left, right : np.array
+        (nvertices,) or (nvertices, nmaps) values of each hemisphere on 
+        the full mesh; only the vertices in `brain_models` are kept.
+    subcortical : np.array
+        (nvoxels,) or (nvoxels, nmaps) values of the subcortical voxels, 
+        in the order of `brain_models`.
+    map_names : list of str
+        Name of each map.
+    out_name : pathlib.Path
+        Path for the dense scalar file.
+    """
+    parts = {}
+    for structure, values in (("CIFTI_STRUCTURE_CORTEX_LEFT", left), 
+                              ("CIFTI_STRUCTURE_CORTEX_RIGHT", right)):
+        parts[structure] = np.asarray(values, dtype=np.float32).reshape(
+            -1, len(map_names))
+    data = np.zeros((len(brain_models), len(map_names)), dtype=np.float32)
+    for name, slc, model in brain_models.iter_structures():
+        if name in parts:
+            data[slc] = parts[name][model.vertex]
+    surface = brain_models.surface_mask
+    data[~surface] = np.asarray(subcortical, dtype=np.float32).reshape(
+        -1, len(map_names))
+    header = cifti2.Cifti2Header.from_axes((cifti2.ScalarAxis(map_names), brain_models))
+    img = cifti2.Cifti2Image(data.T, header)
+    img.nifti_header.set_intent("ConnDenseScalar")
+    nb.save(img, str(out_name))
+
+def _run_chain(cmds, env):
+    """
+    Run a list of commands one after the other, raising a
+    CalledProcessError if any of them fails.
+    """
+    for cmd in cmds:
+        subprocess.run([str(c) for c in cmd], check=True, env=env)
+
+def _run_concurrently(executor, chains, env):
+    """
+    Run independent command chains in the pool and wait for all of
+    them, so that any failure is raised here.
+    """
+    jobs = [executor.submit(_run_chain, chain, env) for chain in chains]
+    [job.result() for job in jobs]
+
+def perfusion_cifti_processing(studydir, subid, outdir, wbdevdir,
+                               variables=ASL_VARIABLES, pvcorr=(False, True),
+                               lowresmesh="32", FinalASLRes="2.5", SmoothingFWHM="2",
+                               GreyOrdsRes="2", RegName="MSMSulc", cores=cpu_count(),
+                               inprocess_smoothing=False):
+    """
+    Project ASL variables to the cortical surface and generate their
+    CIFTI representation, which includes both the low res mesh
+    surfaces in `RegName` atlas space and the subcortical structures
+    in MNI voxel space.
+
+    Each (variable, pvcorr) combination gives a dense scalar file
+    `<variable>[_pvcorr]_Atlas.dscalar.nii` in the subject's
+    ASLMNI/Results/OutputtoCIFTI directory. The ASL-gridded MNI
+    reference, the subcortical ROIs at the ASL resolution and the
+    atlas subcortical template are created once for all variables.
+    The per-hemisphere and subcortical command chains of all
+    variables are then run on up to `cores` workers.
+
+    Parameters
+    ----------
+    studydir : pathlib.Path
+        Path to the study's base directory.
+    subid : str
+        Subject id for the subject of interest.
+    outdir : str
+        Name of the pipeline's output directory for the subject.
+    wbdevdir : str
+        Path to the directory containing wb_command.
+    variables : sequence of (str, str), optional
+        Names of the ASL variables and of their variances. Default is
+        perfusion_calib and arrival.
+    pvcorr : sequence of bool, optional
+        Whether to process the non-partial volume corrected and/or the
+        partial volume corrected results. Default is both; the partial
+        volume corrected results only exist if oxford_asl was run with
+        --pvcorr. A FileNotFoundError is raised before any processing
+        if any of the requested results are missing.
+    lowresmesh : str, optional
+        Low resolution mesh, in thousands of vertices. Default is "32".
+    FinalASLRes : str, optional
+        Resolution of the ASL results in mm. Default is "2.5".
+    SmoothingFWHM : str, optional
+        FWHM in mm of the surface and subcortical smoothing. Default
+        is "2".
+    GreyOrdsRes : str, optional
+        Resolution of the grayordinates in mm. Default is "2".
+    RegName : str, optional
+        Name of the surface registration. Default is "MSMSulc".
+    cores : int, optional
+        Number of cores shared between the concurrent commands and the
+        warp to MNI space. Default is the number of cores on the 
+        machine.
+    inprocess_smoothing : bool, optional
+        If True, the surface metrics are smoothed in-process with
+        `hcpasl.surface_smoothing.SurfaceSmoother`, an approximation
+        of `wb_command -metric-smoothing`, rather than with wb_command.
+        Default is False.
+    """
+    studydir = Path(studydir)
+    wb_command = Path(wbdevdir).resolve(strict=True)/"wb_command"
+    if "FSLDIR" not in os.environ:
+        raise RuntimeError("FSLDIR must be set for the CIFTI processing, "
+                           + "which uses FSL's MNI152_T1_2mm template.")
+    fsldir = Path(os.environ["FSLDIR"])
+    subject = f"{subid}_V1_MR"
+    sigma = fwhm_to_sigma(SmoothingFWHM)
+
+    # naming conventions
+    struct_dir = studydir/subid/f"{subject}/resources/Structural_preproc/files/{subject}"
+    atlas_dir = struct_dir/"MNINonLinear"
+    t1w_native_dir = struct_dir/"T1w/Native"
+    atlas_native_dir = atlas_dir/"Native"
+    downsample_dir = atlas_dir/f"fsaverage_LR{lowresmesh}k"
+    roi_dir = atlas_dir/"ROIs"
+    aslt1w_dir = studydir/subid/outdir/"ASLT1w"
+    t1w_results_dir = aslt1w_dir/"Results/OutputtoCIFTI"
+    atlas_results_dir = studydir/subid/outdir/"ASLMNI/Results/OutputtoCIFTI"
+    create_dirs([t1w_results_dir, atlas_results_dir])
+    mesh = f"{lowresmesh}k_fs_LR"
+
+    # the shell scripts' intermediate names only depend on the variable,
+    # so the pvcorr results get a suffix to keep the variants apart
+    variants = []
+    for corr, (variable, variance) in product(pvcorr, variables):
+        results_dir = aslt1w_dir/"TIs/OxfordASL/native_space"
+        if corr:
+            results_dir = results_dir/"pvcorr"
+        name = f"{variable}_pvcorr" if corr else variable
+        variants.append((results_dir/f"{variable}.nii.gz",
+                         results_dir/f"{variance}.nii.gz", name))
+    missing = [str(n) for variant in variants for n in variant[:2] if not n.exists()]
+    if missing:
+        raise FileNotFoundError("ASL results needed for the CIFTI processing are "
+                                + f"missing: {', '.join(missing)}")
+
+    # spread the cores between the concurrent wb_command processes, 
+    # the warp to MNI space taking one worker and the cores that the 
+    # others leave over
+    workers = max(min(cores, 3 * len(variants)), 1)
+    threads = max(cores // workers, 1)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+    mni_cores = max(cores - (workers - 1) * threads, 1)
+
+    # shared products: ASL-gridded MNI reference, ROIs at the ASL
+    # resolution and atlas subcortical template
+    asl_grid_mni = atlas_results_dir/"asl_grid_mni.nii.gz"
+    mni_name = fsldir/"data/standard/MNI152_T1_2mm.nii.gz"
+    if not asl_grid_mni.exists():
+        make_asl_grid_mni(variants[0][0], mni_name, asl_grid_mni)
+    subject_rois = roi_dir/f"ROIs.{GreyOrdsRes}.nii.gz"
+    atlas_rois = roi_dir/f"Atlas_ROIs.{GreyOrdsRes}.nii.gz"
+    template = atlas_results_dir/"temp_template.dlabel.nii"
+    shared = [[[wb_command, "-cifti-create-label", template,
+                "-volume", atlas_rois, atlas_rois]]]
+    if float(GreyOrdsRes) != float(FinalASLRes):
+        resampled_rois = atlas_results_dir/f"ROIs.{FinalASLRes}.nii.gz"
+        shared.append([[wb_command, "-volume-affine-resample", subject_rois,
+                        fsldir/"etc/flirtsch/ident.mat", asl_grid_mni,
+                        "ENCLOSING_VOXEL", resampled_rois]])
+        subject_rois = resampled_rois
+
+    # precision images for the precision-weighted surface mapping
+    for variable, variance, name in variants:
+        shared.append([[wb_command, "-volume-math", "1 / var",
+                        t1w_results_dir/f"{name}_precision.nii.gz",
+                        "-var", "var", variance]])
+
+    chains = []
+    for variable, variance, name in variants:
+        # ribbon-constrained volume to surface mapping, resampling to
+        # the atlas mesh and surface smoothing for each hemisphere
+        for side in ("L", "R"):
+            native = t1w_results_dir/f"{name}.{side}.native.func.gii"
+            atlasroi = atlas_results_dir/f"{name}.{side}.atlasroi.{mesh}.func.gii"
+            t1w_mid = t1w_native_dir/f"{subject}.{side}.midthickness.native.surf.gii"
+            atlas_mid = downsample_dir/f"{subject}.{side}.midthickness.{mesh}.surf.gii"
+            atlas_roi = downsample_dir/f"{subject}.{side}.atlasroi.{mesh}.shape.gii"
+            chain = [
+                [wb_command, "-volume-to-surface-mapping", variable, t1w_mid, native,
+                 "-ribbon-constrained",
+                 t1w_native_dir/f"{subject}.{side}.white.native.surf.gii",
+                 t1w_native_dir/f"{subject}.{side}.pial.native.surf.gii",
+                 "-volume-roi", t1w_results_dir/f"{name}_precision.nii.gz", "-weighted",
+                 "-bad-vertices-out",
+                 t1w_results_dir/f"{name}.{side}.badvert_ribbonroi.native.func.gii"],
+                [wb_command, "-metric-dilate", native, t1w_mid, "10", native, "-nearest"],
+                [wb_command, "-metric-resample", native,
+                 atlas_native_dir/f"{subject}.{side}.sphere.{RegName}.native.surf.gii",
+                 downsample_dir/f"{subject}.{side}.sphere.{mesh}.surf.gii",
+                 "ADAP_BARY_AREA", atlasroi,
+                 "-area-surfs",
+                 atlas_native_dir/f"{subject}.{side}.midthickness.native.surf.gii",
+                 atlas_mid,
+                 "-current-roi",
+                 atlas_native_dir/f"{subject}.{side}.roi.native.shape.gii"],
+                [wb_command, "-metric-dilate", atlasroi, atlas_mid, "30", atlasroi,
+                 "-nearest"],
+                [wb_command, "-metric-mask", atlasroi, atlas_roi, atlasroi],
+            ]
+            if not inprocess_smoothing:
+                chain.append(
+                    [wb_command, "-metric-smoothing", atlas_mid, atlasroi, sigma,
+                     atlas_results_dir/f"{name}_s{SmoothingFWHM}.atlasroi.{side}.{mesh}.func.gii",
+                     "-roi", atlas_roi]
+                )
+            chains.append(chain)
+
+        # subcortical processing in ASL-gridded MNI space
+        volume_mni = atlas_results_dir/f"{name}_MNI.nii.gz"
+        temp = atlas_results_dir/f"{name}_temp"
+        subject_dilate = f"{temp}_subject_dilate.dscalar.nii"
+        chain = [
+            [wb_command, "-cifti-create-dense-scalar", f"{temp}_subject.dscalar.nii",
+             "-volume", volume_mni, subject_rois],
+            [wb_command, "-cifti-dilate", f"{temp}_subject.dscalar.nii",
+             "COLUMN", "0", "10", subject_dilate],
+        ]
+        if sigma > 0:
+            chain += [
+                [wb_command, "-cifti-smoothing", subject_dilate, "0", sigma,
+                 "COLUMN", f"{temp}_subject_smooth.dscalar.nii", "-fix-zeros-volume"],
+                [wb_command, "-cifti-resample", f"{temp}_subject_smooth.dscalar.nii",
+                 "COLUMN", template, "COLUMN", "ADAP_BARY_AREA", "CUBIC",
+                 f"{temp}_atlas.dscalar.nii", "-volume-predilate", "10"],
+            ]
+        else:
+            chain.append(
+                [wb_command, "-cifti-resample", subject_dilate,
+                 "COLUMN", template, "COLUMN", "ADAP_BARY_AREA", "CUBIC",
+                 f"{temp}_atlas.dscalar.nii", "-volume-predilate", "10"]
+            )
+        chains.append(chain)
+
+    def smooth_side(side):
+        if not inprocess_smoothing:
+            return np.stack([
+                nb.load(str(atlas_results_dir/f"{name}_s{SmoothingFWHM}.atlasroi.{side}.{mesh}.func.gii")).agg_data()
+                for _, _, name in variants
+            ], axis=1)
+        # all of the variables are smoothed with one sparse product; the 
+        # kernel is specific to this subject's mesh so it isn't cached
+        atlas_mid = downsample_dir/f"{subject}.{side}.midthickness.{mesh}.surf.gii"
+        smoother = SurfaceSmoother(atlas_mid, float(SmoothingFWHM), cache_dir=False)
+        metrics = np.stack([
+            nb.load(str(atlas_results_dir/f"{name}.{side}.atlasroi.{mesh}.func.gii")).agg_data()
+            for _, _, name in variants
+        ], axis=1)
+        return smoother.smooth(metrics, roi=atlas_rois_surf[side])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # all of the variables are warped to MNI space in one pass, 
+        # alongside the shared wb_command jobs
+        mni_job = executor.submit(
+            results_to_mni, atlas_dir/"xfms/acpc_dc2standard.nii.gz", 
+            [variant[0] for variant in variants], 
+            struct_dir/"T1w/T1w_acpc_dc_restore.nii.gz", mni_name, asl_grid_mni, 
+            [atlas_results_dir/f"{variant[2]}_MNI.nii.gz" for variant in variants], 
+            cores=mni_cores
+        )
+        _run_concurrently(executor, shared, env)
+        mni_job.result()
+        _run_concurrently(executor, chains, env)
+        atlas_rois_surf = {
+            side: nb.load(str(downsample_dir/f"{subject}.{side}.atlasroi.{mesh}.shape.gii")).agg_data()
+            for side in ("L", "R")
+        }
+        jobs = {side: executor.submit(smooth_side, side) for side in ("L", "R")}
+        smoothed = {side: job.result() for side, job in jobs.items()}
+
+    # dense scalar combining both hemispheres and the subcortical 
+    # voxels, whose brain models are built once from the atlas ROIs
+    brain_models = grayordinate_axis(atlas_rois_surf["L"], atlas_rois_surf["R"], template)
+    for idx, (_, _, name) in enumerate(variants):
+        subcortical = nb.load(str(atlas_results_dir/f"{name}_temp_atlas.dscalar.nii"))
+        if subcortical.header.get_axis(1) != brain_models[brain_models.volume_mask]:
+            raise RuntimeError(f"Subcortical results for {name} don't match "
+                               + "the atlas subcortical template.")
+        save_dense_scalar(brain_models, smoothed["L"][:, idx], smoothed["R"][:, idx], 
+                          subcortical.get_fdata(dtype=np.float32)[0], [name], 
+                          atlas_results_dir/f"{name}_Atlas.dscalar.nii")
+
+    # clean up the intermediate files, as the shell scripts did
+    temporaries = [template, atlas_results_dir/f"ROIs.{FinalASLRes}.nii.gz"]
+    for variable, variance, name in variants:
+        stem = atlas_results_dir/name
+        temporaries += [
+            Path(f"{stem}_temp_{suffix}.dscalar.nii")
+            for suffix in ("subject", "subject_dilate", "subject_smooth", "atlas")
+        ]
+        for side in ("L", "R"):
+            temporaries += [
+                stem.parent/f"{name}.{side}.atlasroi.{mesh}.func.gii",
+                stem.parent/f"{name}_s{SmoothingFWHM}.atlasroi.{side}.{mesh}.func.gii"
+            ]
+    for temporary in temporaries:
+        if temporary.exists():
+            temporary.unlink()
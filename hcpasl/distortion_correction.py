@@ -7,6 +7,7 @@ import numpy as np
 from scipy.ndimage import binary_fill_holes
 import nibabel as nb
 from fsl.wrappers import bet
+from .resampling import MaskProjector, apply_to_images
 
 def generate_gdc_warp(vol, coeffs_path, distcorr_dir, interpolation=1):
     """
@@ -286,11 +287,12 @@ def generate_epidc_warp(asl_vol0_brain, struct, struct_brain, asl_mask,
     fmap_struct, fmapmag_struct, fmapmagbrain_struct = [
         op.join(fmap_struct_dir, f"fmap{ext}_struct.nii.gz") for ext in ("", "mag", "magbrain")
     ]
-    for fmap_name, fmapstruct_name in zip((fmap, fmapmag, fmapmagbrain),
-                                          (fmap_struct, fmapmag_struct, fmapmagbrain_struct)):
-        fmapstruct_img = bbr_fmap2struct.apply_to_image(
-            str(fmap_name), str(struct), order=interpolation
-        )
+    # the three fieldmap images share a grid so resample them jointly
+    fmapstruct_imgs = apply_to_images(bbr_fmap2struct, 
+                                      (str(fmap), str(fmapmag), str(fmapmagbrain)),
+                                      str(struct), order=interpolation, cores=3)
+    for fmapstruct_img, fmapstruct_name in zip(fmapstruct_imgs,
+                                               (fmap_struct, fmapmag_struct, fmapmagbrain_struct)):
         nb.save(fmapstruct_img, fmapstruct_name)
 
     # run asl_reg using pre-registered fieldmap images
@@ -315,7 +317,7 @@ def generate_asl_mask(struct_brain, asl, asl2struct):
         np.array, logical mask. 
     """
 
-    brain_mask = (nb.load(struct_brain).get_data() > 0).astype(np.float32)
-    asl_mask = asl2struct.inverse().apply_to_array(brain_mask, struct_brain, asl)
-    asl_mask = binary_fill_holes(asl_mask > 0.25)
+    brain_mask = nb.load(struct_brain).get_fdata() > 0
+    projector = MaskProjector(struct_brain, asl, asl2struct.inverse())
+    asl_mask = binary_fill_holes(projector.coverage(brain_mask) > 0.25)
     return asl_mask
\ No newline at end of file
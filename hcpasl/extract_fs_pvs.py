@@ -6,14 +6,19 @@ import argparse
 import multiprocessing as mp 
 import os.path as op
 import tempfile
+from functools import partial
 
 import numpy as np 
 import nibabel as nib
 
 import regtricks as rt 
-from regtricks.application_helpers import sum_array_blocks
+import toblerone
 from toblerone.pvestimation import cortex as estimate_cortex
 
+from hcpasl.tissue_masks import build_lookup, apply_lookup
+from hcpasl.resampling import MaskProjector
+from hcpasl.utils import get_cache_dir, hash_arrays, load_cache, save_cache
+
 # Labels taken from standard FS LUT, subcortex: 
 SUBCORT_LUT = {
     # Left hemisphere
@@ -72,8 +77,71 @@ def CTX_LUT(val):
     else: 
         return None 
 
+UNASSIGNED = ""
+
+def label_tissues(labels):
+    """
+    Tissue name for each of a set of aseg/aparc labels, using 
+    SUBCORT_LUT and then CTX_LUT. 
+
+    Args: 
+        labels: iterable of int labels 
+    Returns: 
+        np.array of tissue names, UNASSIGNED for unrecognised labels 
+    """
+    return np.array([SUBCORT_LUT.get(l) or CTX_LUT(l) or UNASSIGNED 
+                     for l in labels], dtype=object)
+
+def _load_pvs(name):
+    """Load cached cortical PVs, see estimate_cortex_pvs()."""
+    with np.load(name) as cached:
+        return cached["pvs"]
+
+def estimate_cortex_pvs(surf_dict, ref_spc, superfactor=1, 
+                        cores=mp.cpu_count(), cache_dir=None):
+    """
+    Estimate cortical PVs from the white and pial surfaces with 
+    toblerone, caching the result. 
+
+    The estimates are stored as a compressed .npz file keyed by the 
+    contents of the surface files, the reference space, the 
+    superfactor and the toblerone version, so re-running with the 
+    same inputs (e.g. re-running a subject) loads them instead. 
+    Args: 
+        surf_dict: dict with LWS/LPS/RWS/RPS keys, paths to those surfaces
+        ref_spc: regtricks ImageSpace in which to estimate 
+        superfactor: toblerone's supersampling factor 
+        cores: number CPU cores to use 
+        cache_dir: see hcpasl.utils.get_cache_dir(); False to disable 
+            caching 
+    Returns: 
+        np.array of cortical GM/WM/non-brain PVs, stacked in the last 
+        dimension 
+    """
+    key = hash_arrays(
+        *[np.fromfile(surf_dict[k], dtype=np.uint8) for k in sorted(surf_dict)], 
+        ref_spc.size, ref_spc.vox2world, superfactor, 
+        np.frombuffer(getattr(toblerone, '__version__', '').encode(), np.uint8)
+    )
+    cache_name = None
+    if cache_dir is not False:
+        cache_name = get_cache_dir(cache_dir)/f"cortex_pvs_{key}.npz"
+        cached = load_cache(_load_pvs, cache_name)
+        if cached is not None:
+            return cached
+
+    # FIXME: allow tob to accept imagespace directly here
+    with tempfile.TemporaryDirectory() as td:
+        ref_path = op.join(td, 'ref.nii.gz')
+        ref_spc.touch(ref_path)
+        cortex = estimate_cortex(ref=ref_path, struct2ref='I', 
+            superfactor=superfactor, cores=cores, **surf_dict)
+    if cache_name is not None:
+        save_cache(partial(np.savez_compressed, pvs=cortex), cache_name)
+    return cortex
+
 def extract_fs_pvs(aparcseg, surf_dict, ref_spc, superfactor=2, 
-                   cores=mp.cpu_count()): 
+                   cores=mp.cpu_count(), cache_dir=None): 
     """
     Extract and layer PVs according to tissue type, taken from a FS aparc+aseg. 
     Results are stored in ASL-gridded T1 space. 
@@ -81,72 +149,61 @@ def extract_fs_pvs(aparcseg, surf_dict, ref_spc, superfactor=2,
         aparcseg: path to aparc+aseg file
         surf_dict: dict with LWS/LPS/RWS/RPS keys, paths to those surfaces
         ref_spc: space in which to estimate (ie, ASL-gridded T1)
-        superfactor: supersampling factor for intermediate steps
+        superfactor: sub-voxels per aparc+aseg voxel along each dimension 
+            when computing the volumetric tissue fractions
         cores: number CPU cores to use 
+        cache_dir: where to cache the cortical PVs, see 
+            estimate_cortex_pvs() 
     Returns: 
         nibabel Nifti object 
     """
 
     ref_spc = rt.ImageSpace(ref_spc)
-    high_spc = ref_spc.resize_voxels(1/superfactor, 'ceil')
     aseg_spc = nib.load(aparcseg)
-    aseg = aseg_spc.dataobj
+    aseg = np.rint(np.asanyarray(aseg_spc.dataobj)).astype(np.int32)
     aseg_spc = rt.ImageSpace(aseg_spc)
 
     # Estimate cortical PVs 
-    # FIXME: allow tob to accept imagespace directly here
-    with tempfile.TemporaryDirectory() as td:
-        ref_path = op.join(td, 'ref.nii.gz')
-        ref_spc.touch(ref_path)
-        cortex = estimate_cortex(ref=ref_path, struct2ref='I', 
-            superfactor=1, cores=cores, **surf_dict)
+    cortex = estimate_cortex_pvs(surf_dict, ref_spc, cores=cores, 
+                                 cache_dir=cache_dir)
 
     # Extract PVs from aparcseg segmentation. Subcortical structures go into 
     # a dict keyed according to their name, whereas general WM/GM are 
-    # grouped into the vol_pvs array
-    to_stack = {}
-    vol_pvs = np.zeros((aseg_spc.size.prod(), 3), dtype=np.float32)
-    for label in np.unique(aseg):
-        tissue = SUBCORT_LUT.get(label)
-        if not tissue: 
-            tissue = CTX_LUT(label)
-        if tissue: 
-            mask = (aseg == label) 
-            if tissue == "WM":
-                vol_pvs[mask.flatten(),1] = 1
-            elif tissue == "GM":
-                vol_pvs[mask.flatten(),0] = 1 
-            elif tissue == "CSF":
-                pass 
-            else: 
-                to_stack[tissue] = mask.astype(np.float32)
-        elif label not in IGNORE: 
+    # grouped into the vol_pvs array. The segmentation is converted into a 
+    # map of tissue classes in a single lookup pass. CSF is not needed as 
+    # a class as it is later taken to be the remainder. 
+    present = np.flatnonzero(np.bincount(aseg.ravel()))
+    tissues = label_tissues(present)
+    for label in present[tissues == UNASSIGNED]:
+        if label not in IGNORE: 
             print("Did not assign aseg/aparc label:", label)
-
-    # Super-resolution resampling for the vol_pvs, a la applywarp. 
-    # We use an identity transform as we don't actually want to shift the data 
+    structures = list(dict.fromkeys(
+        t for t in tissues if t not in ("GM", "WM", "CSF", UNASSIGNED)))
+    classes = ["GM", "WM", *structures]
+    class_lut = build_lookup(
+        {l: classes.index(t) for l, t in zip(present, tissues) 
+         if t in classes}, default=-1, dtype=np.int8)
+    class_map = apply_lookup(aseg, class_lut, default=-1)
+
+    # The grids are aligned (the transform is an identity), so rather than 
+    # interpolating each class onto a supersampled grid, the fraction of 
+    # each ref voxel covered by each class is counted directly from the 
+    # ref voxel into which each aseg sub-voxel falls. 
     # 0: GM, 1: WM, 2: CSF, always in the LAST dimension of an array 
-    reg = rt.Registration.identity()
-    vol_pvs = reg.apply_to_array(vol_pvs.reshape(*aseg.shape, 3), 
-                                 aseg_spc, high_spc, order=1, cores=cores)
-    vol_pvs = (sum_array_blocks(vol_pvs, 3 * [superfactor] + [1]) 
-               / (superfactor ** 3))
-    vol_pvs = vol_pvs.reshape(-1,3)
+    projector = MaskProjector(aseg_spc, ref_spc, superfactor=superfactor)
+    fractions = projector.label_fractions(class_map, len(classes))
+    del projector, class_map
+
+    vol_pvs = np.zeros((fractions[...,0].size, 3), dtype=np.float32)
+    vol_pvs[:,:2] = fractions[...,:2].reshape(-1,2)
     vol_pvs[:,2] = np.maximum(0, 1 - vol_pvs[:,:2].sum(1))
     vol_pvs[vol_pvs[:,2] < 1e-2, 2] = 0 
     vol_pvs /= vol_pvs.sum(1)[:,None]
     vol_pvs = vol_pvs.reshape(*ref_spc.size, 3)
 
-    # Stack the subcortical structures into a big 4D volume to resample them
-    # all at once, then put them back into a dict 
-    keys, values = list(to_stack.keys()), list(to_stack.values())
-    del to_stack
-    subcorts = reg.apply_to_array(np.stack(values, axis=-1), 
-                                  aseg_spc, high_spc, order=1, cores=cores)
-    subcorts = (sum_array_blocks(subcorts, 3 * [superfactor] + [1]) 
-                                / (superfactor ** 3))
-    subcorts = np.moveaxis(subcorts, 3, 0)
-    to_stack = dict(zip(keys, subcorts))
+    to_stack = {
+        s: fractions[...,idx] for idx, s in enumerate(structures, start=2)
+    }
 
     # Add the cortical and vol PV estimates into the dict, stack them in 
     # a sneaky way (see the stack_images function)
@@ -191,24 +248,43 @@ def stack_images(images):
         # Add in subcortical GM for each structure, reducing CSF if required 
         # Set the remainder 1 - (GM+CSF) as WM in voxels that were updated 
 
-    # Pop out vol's estimates  
-    csf = images.pop('vol_CSF').flatten()
-    wm = images.pop('vol_WM').flatten()
-    gm = images.pop('vol_GM')
-    shape = (*gm.shape[0:3], 3)
-
-    # Pop the cortex estimates and initialise output as all CSF
-    ctxgm = images.pop('cortex_GM').flatten()
-    ctxwm = images.pop('cortex_WM').flatten()
-    ctxnon = images.pop('cortex_nonbrain').flatten()
-    shape = (*ctxgm.shape, 3)
-    ctx = np.vstack((ctxgm, ctxwm, ctxnon)).T
+    # Pop out vol's estimates. Everything below is computed only over 
+    # the voxels where some tissue is present (in the cortex estimates 
+    # or a subcortical structure); all other voxels are pure CSF in 
+    # the output. All intermediates are float32. 
+    csf = images.pop('vol_CSF').reshape(-1)
+    images.pop('vol_WM')
+    images.pop('vol_GM')
+
+    # Pop the cortex estimates 
+    ctx = [images.pop(k).reshape(-1) for k in 
+           ('cortex_GM', 'cortex_WM', 'cortex_nonbrain')]
+    n_vox = ctx[0].size
+
+    # Subcortical structures are summed into a single map with one 
+    # scatter over their non-zero voxels (in the order of the dict, as 
+    # the structures were previously added in turn) 
+    structures = [np.asarray(s).reshape(-1) for s in images.values()]
+    struct_idx = [np.flatnonzero(s > 0) for s in structures]
+    subcort = np.bincount(
+        np.concatenate([np.zeros(0, dtype=np.int64), *struct_idx]), 
+        np.concatenate([np.zeros(0), *[s[i] for s, i in zip(structures, struct_idx)]]), 
+        minlength=n_vox).astype(np.float32)
+    del structures, struct_idx
+
+    # Index of the voxels that contain either WM or GM (on the ctx image) 
+    # or any subcortical structure 
+    mask = np.logical_or(ctx[0], ctx[1])
+    brain = np.flatnonzero(mask | (subcort > 0))
+    mask = mask[brain]
+    ctx = np.stack([c[brain] for c in ctx], axis=1).astype(np.float32)
+    csf = csf[brain].astype(np.float32)
+    subcort = subcort[brain]
+
+    # Initialise output as all CSF, then write in cortex estimates from 
+    # all voxels that contain either WM or GM (on the ctx image)
     out = np.zeros_like(ctx)
     out[:,2] = 1
-
-    # Then write in cortex estimates from all voxels
-    # that contain either WM or GM (on the ctx image)
-    mask = np.logical_or(ctx[:,0], ctx[:,1])
     out[mask,:] = ctx[mask,:]
 
     # Layer in vol's CSF estimates (to get mid-brain and ventricular CSF). 
@@ -230,17 +306,15 @@ def stack_images(images):
     assert (out > -1e-6).all(), 'Negative PV found'
     assert (out < 1 + 1e-6).all(), 'Large PV found'
 
-
-    # For each subcortical structure, create a mask of the voxels which it 
-    # relates to. The following operations then apply only to those voxels 
-    # All subcortical structures interpreted as pure GM 
-    # Update CSF to ensure that GM + CSF in those voxels < 1 
-    # Finally, set WM as the remainder in those voxels.
-    for s in images.values():
-        smask = (s.flatten() > 0)
-        out[smask,0] = np.minimum(1, out[smask,0] + s.flatten()[smask])
-        out[smask,2] = np.minimum(out[smask,2], 1 - out[smask,0])
-        out[smask,1] = np.maximum(1 - (out[smask,0] + out[smask,2]), 0)
+    # Within the voxels of the subcortical structures: all subcortical 
+    # structures interpreted as pure GM. Update CSF to ensure that 
+    # GM + CSF in those voxels < 1. Finally, set WM as the remainder in 
+    # those voxels. Adding the structures one at a time, capping GM at 1 
+    # each time, is the same as adding their sum and capping once. 
+    smask = (subcort > 0)
+    out[smask,0] = np.minimum(1, out[smask,0] + subcort[smask])
+    out[smask,2] = np.minimum(out[smask,2], 1 - out[smask,0])
+    out[smask,1] = np.maximum(1 - (out[smask,0] + out[smask,2]), 0)
 
     # Final sanity check, then rescaling so all voxels sum to unity. 
     out[out < 0] = 0 
@@ -250,7 +324,11 @@ def stack_images(images):
     assert (out < 1 + 1e-6).all(), 'Large PV found'
     out = out / sums[:,None]
 
-    return out.reshape(shape)
+    # Scatter back into the full field of view, all other voxels CSF 
+    result = np.zeros((n_vox, 3), dtype=np.float32)
+    result[:,2] = 1
+    result[brain] = out
+    return result
 
 if __name__ == "__main__":
 
@@ -0,0 +1,164 @@
+"""
+In-process versions of the fslmaths filters used by the pipeline,
+so that they can be applied to arrays already in memory.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.ndimage import convolve, correlate1d
+
+def dilM(data, iterations=1):
+    """
+    Mean dilation of non-zero voxels, as in `fslmaths -dilM`.
+
+    Each zero voxel with at least one non-zero neighbour in its
+    3x3x3 neighbourhood is replaced by the mean of those non-zero
+    neighbours. Non-zero voxels are left unchanged.
+
+    Parameters
+    ----------
+    data : np.array
+        3D array to dilate.
+    iterations : int, optional
+        Number of times to apply the dilation. Default is 1.
+
+    Returns
+    -------
+    np.array
+        Dilated array.
+    """
+    kernel = np.ones((3, 3, 3))
+    out = np.asarray(data, dtype=np.float64)
+    for _ in range(iterations):
+        nonzero = (out != 0).astype(np.float64)
+        sums = convolve(out, kernel, mode='constant', cval=0.)
+        counts = convolve(nonzero, kernel, mode='constant', cval=0.)
+        fill = (out == 0) & (counts > 0)
+        out = out.copy()
+        out[fill] = sums[fill] / counts[fill]
+    return out
+
+def _dilall3d(data):
+    filled = data != 0
+    if filled.all() or not filled.any():
+        return data.copy()
+
+    # voxels are handled in a flat index, padded by one voxel so that 
+    # every voxel has 26 neighbours; the padding is never known, so it 
+    # is never used in a mean, nor filled
+    shape = np.array(data.shape) + 2
+    values = np.pad(data, 1).ravel()
+    known = np.pad(filled, 1).ravel()
+    inside = np.pad(np.ones(data.shape, dtype=bool), 1).ravel()
+    strides = np.array([shape[1] * shape[2], shape[2], 1])
+    shifts = np.stack(np.meshgrid(*3*[[-1, 0, 1]], indexing='ij'), -1).reshape(-1, 3)
+    offsets = shifts[np.any(shifts != 0, axis=1)] @ strides
+
+    # the first front is every zero voxel touching a non-zero one
+    touching = convolve(filled.astype(np.uint8), np.ones((3, 3, 3), np.uint8), 
+                        mode='constant') > 0
+    front = np.flatnonzero(np.pad(touching & ~filled, 1).ravel())
+    while front.size:
+        neighbours = front[:, None] + offsets
+        weights = known[neighbours]
+        values[front] = ((values[neighbours] * weights).sum(axis=1) 
+                         / weights.sum(axis=1))
+        known[front] = True
+        neighbours = neighbours[~known[neighbours] & inside[neighbours]]
+        front = np.unique(neighbours)
+
+    return values.reshape(shape)[1:-1, 1:-1, 1:-1]
+
+def dilall(data):
+    """
+    Fill all zero voxels by repeated mean dilation, as in 
+    `fslmaths -dilall`.
+
+    The zero voxels are filled in layers, starting from those with a 
+    non-zero neighbour in their 3x3x3 neighbourhood: every voxel in 
+    a layer is set at once to the mean of its non-zero (original or 
+    already filled) neighbours, and the next layer is the unfilled 
+    neighbours of the last. This is `fslmaths -dilM` repeated until 
+    no zero voxels remain. fslmaths -dilall instead fills the voxels 
+    of a layer one at a time, each also using the neighbours filled 
+    just before it, so the filled values differ from fslmaths', more 
+    so further from the non-zero voxels (by a median of 4% for a 
+    smooth bias field-like image). The non-zero voxels are unchanged. 
+    4D arrays are filled volume by volume.
+
+    Parameters
+    ----------
+    data : np.array
+        3D or 4D array to fill.
+
+    Returns
+    -------
+    np.array
+        Filled array.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 4:
+        return np.stack([_dilall3d(data[..., t]) 
+                         for t in range(data.shape[-1])], axis=-1)
+    return _dilall3d(data)
+
+def _gaussian_kernel(sigma, truncate=4.0):
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma)**2)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+def normalised_convolution(values, weights, sigma, truncate=4.0, cores=1):
+    """
+    Gaussian smoothing of a weighted image and its weights in a 
+    single pass, as used for masked smoothing (smoothing `data * roi` 
+    and `roi`, then dividing one by the other).
+
+    Values and weights are stacked and filtered together, one axis 
+    at a time, in float32. Each 1D pass is split into slabs which are 
+    filtered in parallel threads. The result matches 
+    `scipy.ndimage.gaussian_filter` (mode 'reflect') applied to 
+    `values` and `weights` separately, to float32 precision.
+
+    Parameters
+    ----------
+    values : np.array
+        3D array of values, already weighted (i.e. `data * roi`).
+    weights : np.array
+        3D array of weights (e.g. a binary ROI) of the same shape.
+    sigma : float
+        Standard deviation of the Gaussian kernel, in voxels.
+    truncate : float, optional
+        Truncate the kernel at this many standard deviations. 
+        Default is 4.0, as in scipy.
+    cores : int, optional
+        Number of threads to use. Default is 1.
+
+    Returns
+    -------
+    smoothed_values : np.array
+        Smoothed `values`, float32.
+    smoothed_weights : np.array
+        Smoothed `weights`, float32.
+    """
+    kernel = _gaussian_kernel(sigma, truncate)
+    data = np.empty((2, *np.shape(values)), dtype=np.float32)
+    data[0], data[1] = values, weights
+    out = np.empty_like(data)
+
+    with ThreadPoolExecutor(max_workers=cores) as executor:
+        for axis in (1, 2, 3):
+            # split along a spatial axis other than the one being filtered
+            split = 2 if axis == 1 else 1
+            bounds = np.linspace(0, data.shape[split], 
+                                 min(cores, data.shape[split]) + 1).astype(int)
+            slabs = [(slice(None),) * split + (slice(lo, hi),) 
+                     for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+            jobs = [executor.submit(correlate1d, data[s], kernel, axis=axis, 
+                                    output=out[s], mode='reflect')
+                    for s in slabs]
+            [job.result() for job in jobs]
+            data, out = out, data
+
+    return data[0], data[1]
@@ -5,16 +5,24 @@ Magnetisation Transfer effect visible in the HCP data.
 
 import json
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from fsl.wrappers import fslmaths, LOAD, bet, fast
 from fsl.data.image import Image
 import numpy as np
+from scipy.ndimage import binary_dilation, binary_erosion
 from .initial_bookkeeping import create_dirs
 from .tissue_masks import generate_tissue_mask
-from .distortion_correction import register_fmap, generate_asl_mask
+from .rigid_registration import rigid_register
+from .resampling import MaskProjector
+from .bias_estimation import sebased_bias_field
+from .tissue_masks import generate_gm_masks_from_luts
+from .filters import dilall
+from .utils import BackgroundWriter
 import subprocess
+import multiprocessing as mp
 import regtricks as rt
 import nibabel as nb
-import pandas as pd
 
 import os
 import os.path as op
@@ -36,23 +44,24 @@ def generate_asl2struct(asl_vol0, struct, fsdir, reg_dir):
         n/a, file 'asl2struct.mat' will be saved in reg_dir
     """
 
-    # We need to do some hacky stuff to get bbregister to work...
-    # Split the path to the FS directory into a fake $SUBJECTS_DIR
-    # and subject_id. We temporarily set the environment variable
-    # before making the call, and then revert back afterwards  
+    # bbregister needs the FS directory split into $SUBJECTS_DIR and a 
+    # subject_id. Rather than changing this process's environment and 
+    # working directory, give the subprocess its own copy of each so 
+    # that several registrations can safely run at the same time
     new_sd, sid = op.split(fsdir)
-    old_sd = os.environ.get('SUBJECTS_DIR')
-    pwd = os.getcwd()
+    env = dict(os.environ, SUBJECTS_DIR=new_sd)
     orig_mgz = op.join(fsdir, 'mri', 'orig.mgz')
 
     # Run inside the regdir. Save the output in fsl format, by default 
     # this targets the orig.mgz, NOT THE T1 IMAGE ITSELF! 
-    os.chdir(reg_dir)
     omat_path = op.join(reg_dir, "asl2struct.mat")
-    cmd = os.environ['SUBJECTS_DIR'] = new_sd
-    cmd = f"$FREESURFER_HOME/bin/bbregister --s {sid} --mov {asl_vol0} --t2 "
-    cmd += f"--reg asl2orig_mgz_initial_bbr.dat --fslmat {omat_path} --init-fsl"
-    subprocess.run(cmd, shell=True)
+    cmd = [
+        op.join(os.environ['FREESURFER_HOME'], 'bin', 'bbregister'),
+        "--s", sid, "--mov", op.abspath(asl_vol0), "--t2",
+        "--reg", "asl2orig_mgz_initial_bbr.dat", "--fslmat", omat_path, 
+        "--init-fsl"
+    ]
+    subprocess.run(cmd, cwd=reg_dir, env=env, check=True)
 
     try:
         asl2orig_fsl = rt.Registration.from_flirt(str(omat_path), str(asl_vol0), str(orig_mgz))
@@ -64,11 +73,7 @@ def generate_asl2struct(asl_vol0, struct, fsdir, reg_dir):
         np.savetxt(omat_path, arr, fmt='%.5f')
         asl2orig_fsl = rt.Registration.from_flirt(str(omat_path), str(asl_vol0), str(orig_mgz))
 
-    # Return to original working directory, and flip the FSL matrix to target
-    # asl -> T1, not orig.mgz. Save output. 
-    os.chdir(pwd)
-    if old_sd:
-        os.environ['SUBJECTS_DIR'] = old_sd
+    # Flip the FSL matrix to target asl -> T1, not orig.mgz. Save output. 
     asl2struct_fsl = asl2orig_fsl.to_flirt(str(asl_vol0), str(struct))
     np.savetxt(op.join(reg_dir, 'asl2struct.mat'), asl2struct_fsl)
 
@@ -118,28 +123,245 @@ def update_json(new_dict, old_dict):
     with open(Path(old_dict['json_name']), 'w') as fp:
         json.dump(old_dict, fp, sort_keys=True, indent=4)
 
-def parse_LUT(LUT_name):
+def _distcorr_calib(calib_name, gdc_warp, epi_dc_warp, mt_sfs, 
+                    interpolation=3, nobandingcorr=False):
     """
-    Parse a FreeSurfer Lookup-Table returning the desired label 
-    names.
+    Apply gradient and EPI distortion correction, and MT correction 
+    if requested, to a single calibration image.
+
+    Returns
+    -------
+    gdc_dc_calib_img : nibabel.Nifti1Image
+        Distortion-corrected calibration image.
+    gdc_dc_calib_name : pathlib.Path
+        Location of the saved distortion-corrected image.
+    calib_corr_name : pathlib.Path
+        Location of the fully corrected image to use for registration.
+    """
+    # get calib_dir and other info
+    calib_path = Path(calib_name)
+    calib_dir = calib_path.parent
+    calib_name_stem = calib_path.stem.split('.')[0]
+
+    # apply gdc and epidc to the calibration image
+    gdc_dc_warp = rt.chain(gdc_warp, epi_dc_warp)
+    gdc_dc_calib_img = gdc_dc_warp.apply_to_image(calib_name, calib_name, order=interpolation)
+    distcorr_dir = calib_dir/"DistCorr"
+    distcorr_dir.mkdir(exist_ok=True)
+    gdc_dc_calib_name = distcorr_dir/f"gdc_dc_{calib_name_stem}.nii.gz"
+    nb.save(gdc_dc_calib_img, gdc_dc_calib_name)
+
+    # apply mt scaling factors to the gradient distortion-corrected calibration image
+    if not nobandingcorr:
+        assert (len(mt_sfs) == gdc_dc_calib_img.shape[2])
+        mt_gdc_dc_calib_img = nb.nifti1.Nifti1Image(gdc_dc_calib_img.get_fdata()*mt_sfs, 
+                                                gdc_dc_calib_img.affine)
+        mtcorr_dir = calib_dir/"MTCorr"
+        mtcorr_dir.mkdir(exist_ok=True)
+        mt_gdc_dc_calib_name = mtcorr_dir/f"mtcorr_gdc_dc_{calib_name_stem}.nii.gz"
+        nb.save(mt_gdc_dc_calib_img, mt_gdc_dc_calib_name)
+        calib_corr_name = mt_gdc_dc_calib_name
+    else:
+        calib_corr_name = gdc_dc_calib_name
+    return gdc_dc_calib_img, gdc_dc_calib_name, calib_corr_name
+
+def _bbregister_calib(calib_corr_name, struct_name, fsdir, reg_dir):
+    """
+    Register a corrected calibration image to the structural image 
+    using bbregister, saving asl2struct.mat in reg_dir.
+
+    Returns
+    -------
+    regtricks.Registration
+        Registration from the calibration image to the structural.
+    """
+    generate_asl2struct(calib_corr_name, struct_name, fsdir, reg_dir)
+    asl2struct_reg = rt.Registration.from_flirt(src2ref=str(Path(reg_dir)/"asl2struct.mat"),
+                                                src=str(calib_corr_name),
+                                                ref=str(struct_name))
+    return asl2struct_reg
+
+def _boundary_contrast(calib_name, asl2struct_reg, struct_name, wm_mask, 
+                       width=2):
+    """
+    Grey/white contrast of a calibration image across the structural 
+    image's white matter boundary, after registration to it.
+
+    As in bbregister's cost, a well-registered calibration image 
+    (brighter in grey matter than white matter) has a sharp contrast 
+    across the boundary, which misregistration blurs.
 
     Parameters
     ----------
-    LUT_name : str
-        Path to the Lookup-Table
-    
+    calib_name : pathlib.Path
+        Calibration image.
+    asl2struct_reg : regtricks.Registration
+        Registration from the calibration image to the structural.
+    struct_name : str
+        Structural image, defining the grid of `wm_mask`.
+    wm_mask : np.array
+        Boolean white matter mask in structural space.
+    width : int, optional
+        Thickness, in structural voxels, of the shells sampled on 
+        either side of the boundary. Default is 2.
+
+    Returns
+    -------
+    float
+        Percent contrast, 100 * (g - w) / ((g + w) / 2), between the 
+        mean intensities in the grey (g) and white (w) shells.
+    """
+    calib_struct = asl2struct_reg.apply_to_image(str(calib_name), str(struct_name), 
+                                                 order=1, superfactor=False)
+    calib_struct = calib_struct.get_fdata()
+    inner = wm_mask & ~binary_erosion(wm_mask, iterations=width)
+    outer = binary_dilation(wm_mask, iterations=width) & ~wm_mask
+    g, w = calib_struct[outer].mean(), calib_struct[inner].mean()
+    return 200 * (g - w) / (g + w) if g + w > 0 else 0.
+
+def _chain_calib1(calib1_corr_name, calib0_corr_name, asl2struct0_reg, 
+                  struct_name, wmmask_name, fsdir, reg_dir, min_similarity=0.9, 
+                  min_contrast=0.8):
+    """
+    Get calib1's registration to the structural image by composing a 
+    rigid calib1 -> calib0 registration with calib0's asl2struct.
+
+    The two calibration images are acquired seconds apart so a quick 
+    in-process rigid registration between them is sufficient. The 
+    result is checked twice, falling back to running bbregister for 
+    calib1 if either check fails:
+
+    #. the NCC between the rigidly registered calibration images 
+       must be at least `min_similarity`;
+    #. calib1's grey/white contrast across the structural image's 
+       white matter boundary through the composed registration must 
+       be at least `min_contrast` times calib0's through bbregister's 
+       (see `_boundary_contrast()`).
+
     Returns
     -------
-    labels : list of ints
-        List of int labels from the LUT
+    regtricks.Registration
+        Registration from calib1 to the structural image.
     """
-    lut = pd.read_csv(LUT_name, header=None)
-    labels = [int(row[0].split(" ")[0]) for _, row in lut[1::2].iterrows()]
-    return labels
+    calib12calib0, similarity = rigid_register(str(calib1_corr_name), 
+                                               str(calib0_corr_name))
+    asl2struct_reg = rt.chain(calib12calib0, asl2struct0_reg)
+    if similarity >= min_similarity:
+        wm_mask = nb.load(str(wmmask_name)).get_fdata() > 0
+        contrast0, contrast1 = [
+            _boundary_contrast(name, reg, struct_name, wm_mask)
+            for name, reg in ((calib0_corr_name, asl2struct0_reg), 
+                              (calib1_corr_name, asl2struct_reg))
+        ]
+        passed = contrast0 > 0 and contrast1 >= min_contrast * contrast0
+    else:
+        passed = False
+    if not passed:
+        print("Chained calib1 registration failed its quality check, "
+              "running bbregister for calib1.")
+        return _bbregister_calib(calib1_corr_name, struct_name, fsdir, reg_dir)
+
+    np.savetxt(Path(reg_dir)/"asl2struct.mat", 
+               asl2struct_reg.to_flirt(str(calib1_corr_name), str(struct_name)))
+    return asl2struct_reg
+
+def _biascorr_calib(calib_name, gdc_dc_calib_img, gdc_dc_calib_name, 
+                    asl2struct_reg, json_dict, mt_sfs, bbr_fmap2struct, 
+                    fmapmag, struct_name, wmparc, ribbon, corticallut, 
+                    subcorticallut, interpolation=3, nobandingcorr=False, 
+                    debug=False, cores=1, cache_dir=None):
+    """
+    Estimate the SE-based bias field for a single distortion-corrected 
+    calibration image and apply bias and MT corrections to it, using 
+    `cores` threads for the bias estimation's smoothing. The GM masks' 
+    label resampling is cached in `cache_dir`.
+
+    Returns
+    -------
+    dict
+        Locations of the bias field and corrected calibration image, 
+        to be added to the json by the caller.
+    """
+    # get calib_dir and other info
+    calib_path = Path(calib_name)
+    calib_dir = calib_path.parent
+    calib_name_stem = calib_path.stem.split('.')[0]
+    distcorr_dir = calib_dir/"DistCorr"
+    mtcorr_dir = calib_dir/"MTCorr"
+
+    # invert for struct2calib registration
+    struct2calib_reg = asl2struct_reg.inverse()
+    struct2calib_name = distcorr_dir/"struct2asl.mat"
+    np.savetxt(struct2calib_name, struct2calib_reg.to_flirt(str(struct_name), str(calib_name)))
+    
+    # register fmapmag to calibration image space
+    fmap2calib_reg = rt.chain(bbr_fmap2struct, struct2calib_reg)
+    fmapmag_calibspc = fmap2calib_reg.apply_to_image(str(fmapmag),
+                                                     str(calib_name),
+                                                     order=interpolation)
+    biascorr_dir = calib_dir/"BiasCorr"
+    sebased_dir = biascorr_dir/"SEbased"
+    sebased_dir.mkdir(parents=True, exist_ok=True)
+    fmapmag_cspc_name = sebased_dir/f"fmapmag_{calib_name_stem}spc.nii.gz"
+    nb.save(fmapmag_calibspc, fmapmag_cspc_name)
+
+    # get brain mask in calibration image space
+    fs_brainmask = Path(json_dict["T1w_dir"])/"brainmask_fs.nii.gz"
+    aslfs_mask_name = calib_dir/"aslfs_mask.nii.gz"
+    projector = MaskProjector(str(fs_brainmask), str(calib_name), struct2calib_reg)
+    aslfs_mask = projector.coverage(nb.load(fs_brainmask).get_fdata() > 0)
+    aslfs_mask = nb.nifti1.Nifti1Image(np.where(aslfs_mask>0., 1., 0.),
+                                       affine=gdc_dc_calib_img.affine)
+    nb.save(aslfs_mask, aslfs_mask_name)
+
+    # get sebased bias estimate in-process, only saving the 
+    # intermediate images if requested
+    calib_data = gdc_dc_calib_img.get_fdata()
+    writer = BackgroundWriter(sebased_dir, gdc_dc_calib_img) if debug else None
+    try:
+        cgm, scgm = generate_gm_masks_from_luts(wmparc, ribbon, corticallut, 
+                                                subcorticallut, gdc_dc_calib_img, 
+                                                struct2calib_reg, 
+                                                cache_dir=cache_dir)
+        tissue_mask = np.where(np.logical_or(cgm==1, scgm==1), 1, 0)
+        bias, _ = sebased_bias_field(calib_data, fmapmag_calibspc.get_fdata(), 
+                                     aslfs_mask.get_fdata(), tissue_mask, 
+                                     writer=writer, cores=cores)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    # apply dilall to bias estimate
+    dilall_name = biascorr_dir/f"{calib_name_stem}_bias.nii.gz"
+    bias = dilall(bias)
+    nb.save(nb.nifti1.Nifti1Image(bias, gdc_dc_calib_img.affine), dilall_name)
+
+    # bias correct and mt correct the gdc_dc_calib image
+    bc_calib = nb.nifti1.Nifti1Image(calib_data / bias,
+                                     gdc_dc_calib_img.affine)
+    biascorr_name = biascorr_dir / f'{calib_name_stem}_restore.nii.gz'
+    nb.save(bc_calib, biascorr_name)
+
+    if not nobandingcorr:
+        mt_bc_calib = nb.nifti1.Nifti1Image(bc_calib.get_fdata()*mt_sfs,
+                                            bc_calib.affine)
+        mtcorr_name = mtcorr_dir / f'{calib_name_stem}_mtcorr.nii.gz'
+        nb.save(mt_bc_calib, mtcorr_name)
+        calib_corr_name = mtcorr_name
+    else:
+        calib_corr_name = biascorr_name
+    
+    # add locations of above files to the json
+    important_names = {
+        f'{calib_name_stem}_bias' : str(dilall_name),
+        f'{calib_name_stem}_corr' : str(calib_corr_name)
+    }
+    return important_names
 
 def correct_M0(subject_dir, mt_factors, wmparc, ribbon, 
                corticallut, subcorticallut, interpolation=3,
-               nobandingcorr=False, outdir="hcp_asl"):
+               nobandingcorr=False, outdir="hcp_asl", chain_calib1=False,
+               debug=False, cores=mp.cpu_count()):
     """
     Correct the M0 images.
     
@@ -148,6 +370,8 @@ def correct_M0(subject_dir, mt_factors, wmparc, ribbon,
     #. Use FAST on the brain-extracted image to obtain the bias-field;
     #. Perform bias correction;
     #. Multiply by the provided 'mt_factors' for MT-effect correction.
+
+    The two calibration images are processed concurrently.
     
     Parameters
     ----------
@@ -162,6 +386,21 @@ def correct_M0(subject_dir, mt_factors, wmparc, ribbon,
         banding corrections are applied by default).
     outdir : str
         Name of the main results directory. Default is 'hcp_asl'.
+    chain_calib1 : bool, optional
+        If this is True, calib1's registration to the structural 
+        image is obtained by composing a fast rigid calib1 -> calib0 
+        registration with calib0's bbregister result, rather than 
+        running bbregister again. bbregister is still run for 
+        calib1 if the composed registration fails its quality 
+        checks. 
+        Default is False.
+    debug : bool, optional
+        If True, the intermediate images from the SE-based bias 
+        estimation are saved. Default is False.
+    cores : int, optional
+        Number of cores to use, shared between the concurrent 
+        calibration images' SE-based bias estimation. Default is 
+        the number of cores available.
     """
     # load json containing info on where files are stored
     json_dict = load_json(subject_dir/outdir)
@@ -204,103 +443,45 @@ def correct_M0(subject_dir, mt_factors, wmparc, ribbon,
                                                  src=str(fmapmag), 
                                                  ref=str(struct_name)) 
 
-    for calib_name in calib_names:
-        # get calib_dir and other info
-        calib_path = Path(calib_name)
-        calib_dir = calib_path.parent
-        calib_name_stem = calib_path.stem.split('.')[0]
-
-        # apply gdc and epidc to the calibration image
-        gdc_dc_warp = rt.chain(gdc_warp, epi_dc_warp)
-        gdc_dc_calib_img = gdc_dc_warp.apply_to_image(calib_name, calib_name, order=interpolation)
-        distcorr_dir = calib_dir/"DistCorr"
-        distcorr_dir.mkdir(exist_ok=True)
-        gdc_dc_calib_name = distcorr_dir/f"gdc_dc_{calib_name_stem}.nii.gz"
-        nb.save(gdc_dc_calib_img, gdc_dc_calib_name)
-
-        # apply mt scaling factors to the gradient distortion-corrected calibration image
-        if not nobandingcorr:
-            mt_sfs = np.loadtxt(mt_factors)
-            assert (len(mt_sfs) == gdc_dc_calib_img.shape[2])
-            mt_gdc_dc_calib_img = nb.nifti1.Nifti1Image(gdc_dc_calib_img.get_fdata()*mt_sfs, 
-                                                    gdc_dc_calib_img.affine)
-            mtcorr_dir = calib_dir/"MTCorr"
-            mtcorr_dir.mkdir(exist_ok=True)
-            mt_gdc_dc_calib_name = mtcorr_dir/f"mtcorr_gdc_dc_{calib_name_stem}.nii.gz"
-            nb.save(mt_gdc_dc_calib_img, mt_gdc_dc_calib_name)
-            calib_corr_name = mt_gdc_dc_calib_name
-        else:
-            calib_corr_name = gdc_dc_calib_name
-
-        # get registration to structural
-        generate_asl2struct(calib_corr_name, struct_name, fsdir, distcorr_dir)
-        asl2struct_name = distcorr_dir/"asl2struct.mat"
-        asl2struct_reg = rt.Registration.from_flirt(src2ref=str(distcorr_dir/"asl2struct.mat"),
-                                                    src=str(calib_corr_name),
-                                                    ref=str(struct_name))
-        # invert for struct2calib registration
-        struct2calib_reg = asl2struct_reg.inverse()
-        struct2calib_name = distcorr_dir/"struct2asl.mat"
-        np.savetxt(struct2calib_name, struct2calib_reg.to_flirt(str(struct_name), str(calib_corr_name)))
-        
-        # register fmapmag to calibration image space
-        fmap2calib_reg = rt.chain(bbr_fmap2struct, struct2calib_reg)
-        fmapmag_calibspc = fmap2calib_reg.apply_to_image(str(fmapmag),
-                                                         str(calib_name),
-                                                         order=interpolation)
-        biascorr_dir = calib_dir/"BiasCorr"
-        sebased_dir = biascorr_dir/"SEbased"
-        sebased_dir.mkdir(parents=True, exist_ok=True)
-        fmapmag_cspc_name = sebased_dir/f"fmapmag_{calib_name_stem}spc.nii.gz"
-        nb.save(fmapmag_calibspc, fmapmag_cspc_name)
-
-        # get brain mask in calibration image space
-        fs_brainmask = Path(json_dict["T1w_dir"])/"brainmask_fs.nii.gz"
-        aslfs_mask_name = calib_dir/"aslfs_mask.nii.gz"
-        aslfs_mask = struct2calib_reg.apply_to_image(src=str(fs_brainmask), 
-                                                     ref=str(calib_name),
-                                                     order=0)
-        aslfs_mask = nb.nifti1.Nifti1Image(np.where(aslfs_mask.get_fdata()>0., 1., 0.),
-                                           affine=gdc_dc_calib_img.affine)
-        nb.save(aslfs_mask, aslfs_mask_name)
-
-        # get sebased bias estimate
-        sebased_cmd = [
-            "get_sebased_bias",
-            "-i", gdc_dc_calib_name, "-f", fmapmag_cspc_name,
-            "-m", aslfs_mask_name, "-o", sebased_dir, 
-            "--ribbon", ribbon, "--wmparc", wmparc,
-            "--corticallut", corticallut, "--subcorticallut", subcorticallut,
-            "--struct2calib", struct2calib_name, "--structural", struct_name, 
-            "--debug"
-        ]
-        subprocess.run(sebased_cmd, check=True)
-
-        # apply dilall to bias estimate
-        bias_name = sebased_dir/"sebased_bias_dil.nii.gz"
-        dilall_name = biascorr_dir/f"{calib_name_stem}_bias.nii.gz"
-        dilall_cmd = ["fslmaths", bias_name, "-dilall", dilall_name]
-        subprocess.run(dilall_cmd, check=True)
-
-        # bias correct and mt correct the gdc_dc_calib image
-        bias_img = nb.load(dilall_name)
-        bc_calib = nb.nifti1.Nifti1Image(gdc_dc_calib_img.get_fdata() / bias_img.get_fdata(),
-                                         gdc_dc_calib_img.affine)
-        biascorr_name = biascorr_dir / f'{calib_name_stem}_restore.nii.gz'
-        nb.save(bc_calib, biascorr_name)
-
-        if not nobandingcorr:
-            mt_bc_calib = nb.nifti1.Nifti1Image(bc_calib.get_fdata()*mt_sfs,
-                                                bc_calib.affine)
-            mtcorr_name = mtcorr_dir / f'{calib_name_stem}_mtcorr.nii.gz'
-            nb.save(mt_bc_calib, mtcorr_name)
-            calib_corr_name = mtcorr_name
+    # load mt scaling factors once, they are shared by both calibration images
+    mt_sfs = None if nobandingcorr else np.loadtxt(mt_factors)
+
+    # both calibration images are independent so process them concurrently, 
+    # splitting the cores between them, and update the json afterwards from 
+    # this thread only
+    calib_cores = max(cores // len(calib_names), 1)
+    distcorr_worker = partial(_distcorr_calib, gdc_warp=gdc_warp, 
+                              epi_dc_warp=epi_dc_warp, mt_sfs=mt_sfs, 
+                              interpolation=interpolation, 
+                              nobandingcorr=nobandingcorr)
+    biascorr_worker = partial(_biascorr_calib, json_dict=json_dict, mt_sfs=mt_sfs, 
+                              bbr_fmap2struct=bbr_fmap2struct, fmapmag=fmapmag, 
+                              struct_name=struct_name, wmparc=wmparc, 
+                              ribbon=ribbon, corticallut=corticallut, 
+                              subcorticallut=subcorticallut, 
+                              interpolation=interpolation, 
+                              nobandingcorr=nobandingcorr, debug=debug, 
+                              cores=calib_cores, 
+                              cache_dir=subject_dir/outdir/"cache")
+    reg_dirs = [Path(c).parent/"DistCorr" for c in calib_names]
+    with ThreadPoolExecutor(max_workers=len(calib_names)) as executor:
+        distcorr_results = list(executor.map(distcorr_worker, calib_names))
+        gdc_dc_calib_imgs, gdc_dc_calib_names, calib_corr_names = zip(*distcorr_results)
+
+        # get registrations to structural
+        if chain_calib1:
+            asl2struct0_reg = _bbregister_calib(calib_corr_names[0], struct_name, 
+                                                fsdir, reg_dirs[0])
+            asl2struct1_reg = _chain_calib1(calib_corr_names[1], calib_corr_names[0], 
+                                            asl2struct0_reg, struct_name, wmmask_name, 
+                                            fsdir, reg_dirs[1])
+            asl2struct_regs = [asl2struct0_reg, asl2struct1_reg]
         else:
-            calib_corr_name = biascorr_name
-        
-        # add locations of above files to the json
-        important_names = {
-            f'{calib_name_stem}_bias' : str(dilall_name),
-            f'{calib_name_stem}_corr' : str(calib_corr_name)
-        }
-        update_json(important_names, json_dict)
\ No newline at end of file
+            asl2struct_regs = list(executor.map(_bbregister_calib, calib_corr_names, 
+                                                [struct_name]*len(calib_names),
+                                                [fsdir]*len(calib_names), reg_dirs))
+
+        results = list(executor.map(biascorr_worker, calib_names, gdc_dc_calib_imgs, 
+                                    gdc_dc_calib_names, asl2struct_regs))
+    for important_names in results:
+        update_json(important_names, json_dict)
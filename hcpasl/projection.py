@@ -2,15 +2,31 @@ from .initial_bookkeeping import create_dirs
 from .m0_mt_correction import load_json, update_json
 from pathlib import Path
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from fsl.wrappers.flirt import applyxfm
 from itertools import product
+from .resampling import apply_to_images
+from .surface_mapping import RibbonMapper, save_metric
+import numpy as np
 import regtricks as rt
 import multiprocessing as mp
 import nibabel as nb
 
-def project_to_surface(subject_dir, target='structural', outdir="hcp_asl"):
+def project_to_surface(subject_dir, target='structural', outdir="hcp_asl", 
+                       cores=mp.cpu_count(), ribbon_mapper=False):
     """
     Project the results of the pipeline to the cortical surface.
+
+    If the results are in ASL space, perfusion and its variance are 
+    registered to T1w together in a single resampling. The 
+    `wb_command -volume-to-surface-mapping` calls for each image and 
+    hemisphere are then run concurrently on up to `cores` workers; 
+    if any of them fails its CalledProcessError is raised.
+
+    If `ribbon_mapper` is True, both images are instead mapped 
+    in-process with `hcpasl.surface_mapping.RibbonMapper`, an 
+    approximation of wb_command's ribbon-constrained mapping, with 
+    the two hemispheres processed concurrently.
     """
     # load subject's json
     json_dict = load_json(subject_dir/outdir)
@@ -29,20 +45,10 @@ def project_to_surface(subject_dir, target='structural', outdir="hcp_asl"):
             src=str(pc_name),
             ref=str(asl_t1_name)
         )
-        t1_pc = asl2struct.apply_to_image(
-            src=str(pc_name),
-            ref=str(ref),
-            order=3,
-            cores=mp.cpu_count()
-        )
+        t1_pc, t1_vc = apply_to_images(asl2struct, [pc_name, vc_name], 
+                                       ref, order=3, cores=cores)
         pc_name = pc_name.parent/"asl_t1_perfusion.nii.gz"
         nb.save(t1_pc, str(pc_name))
-        t1_vc = asl2struct.apply_to_image(
-            src=str(vc_name),
-            ref=str(ref),
-            order=3,
-            cores=mp.cpu_count()
-        )
         vc_name = vc_name.parent/"asl_t1_perfusion_var.nii.gz"
         nb.save(t1_vc, str(vc_name))
 
@@ -53,6 +59,12 @@ def project_to_surface(subject_dir, target='structural', outdir="hcp_asl"):
     create_dirs([projection_dir, ])
     sides = ('L', 'R')
 
+    if ribbon_mapper:
+        _map_with_ribbon_mapper(json_dict, names, projection_dir, 
+                                subject_dir/outdir/'cache', cores)
+        return
+
+    cmds = []
     for name, side in product(names, sides):
         # surface file names
         mid_name = json_dict[f'{side}_mid']
@@ -64,7 +76,7 @@ def project_to_surface(subject_dir, target='structural', outdir="hcp_asl"):
 
         # save name
         savename = projection_dir / f'{side}_{stem}.func.gii'
-        cmd = [
+        cmds.append([
             "wb_command",
             "-volume-to-surface-mapping",
             name,
@@ -73,5 +85,34 @@ def project_to_surface(subject_dir, target='structural', outdir="hcp_asl"):
             "-ribbon-constrained",
             white_name,
             pial_name
-        ]
-        subprocess.run(cmd)
\ No newline at end of file
+        ])
+    with ThreadPoolExecutor(max_workers=max(min(cores, len(cmds)), 1)) as executor:
+        jobs = [executor.submit(subprocess.run, cmd, check=True) for cmd in cmds]
+        [job.result() for job in jobs]
+
+def _map_with_ribbon_mapper(json_dict, names, projection_dir, cache_dir, cores):
+    """
+    Map volumes onto both hemispheres with `RibbonMapper`, saving 
+    them as `project_to_surface()` names them.
+    """
+    sides = ('L', 'R')
+    structures = {'L': 'CortexLeft', 'R': 'CortexRight'}
+    volumes = [nb.load(str(name)) for name in names]
+
+    def map_side(side):
+        # the ribbon weights are built once per hemisphere (and cached), 
+        # then each volume is a single sparse product
+        mapper = RibbonMapper(json_dict[f'{side}_white'], json_dict[f'{side}_pial'], 
+                              volumes[0], cache_dir=cache_dir)
+        for name, volume in zip(names, volumes):
+            # get stem name
+            stem = name.stem.strip('.nii')
+
+            # save name
+            savename = projection_dir / f'{side}_{stem}.func.gii'
+            values, _ = mapper.map(volume.get_fdata(dtype=np.float32))
+            save_metric(values, savename, structures[side])
+
+    with ThreadPoolExecutor(max_workers=max(min(cores, len(sides)), 1)) as executor:
+        jobs = [executor.submit(map_side, side) for side in sides]
+        [job.result() for job in jobs]
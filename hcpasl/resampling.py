@@ -0,0 +1,749 @@
+"""
+Fast resampling helpers for moving data between the structural
+and ASL voxel grids.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+
+import numpy as np
+from scipy import sparse
+from scipy.ndimage import map_coordinates, binary_closing, binary_fill_holes
+import regtricks as rt
+from regtricks.application_helpers import sum_array_blocks
+import nibabel as nb
+
+from .utils import get_cache_dir, hash_arrays, load_cache, save_cache
+
+class MaskProjector:
+    """
+    Project binary masks from a fine voxel grid (e.g. T1w) onto a
+    coarser one (e.g. ASL) as fractional coverage.
+
+    For a given pair of spaces and affine registration, the index of
+    the reference voxel into which each source voxel (or sub-voxel,
+    if `superfactor` > 1) falls is computed for the voxels of each 
+    mask. The coverage of any number of masks can then be obtained 
+    with a single `np.bincount`, which is much cheaper than resampling
+    each mask with spline interpolation.
+
+    When the two grids are aligned (the src voxel axes map onto the 
+    ref voxel axes, as for an identity transform between a space and 
+    a resized copy of it) the mapping is separable, so it is stored 
+    as one small table per axis rather than per voxel.
+
+    Parameters
+    ----------
+    src : str, pathlib.Path, nibabel image or regtricks.ImageSpace
+        Space of the masks to be projected.
+    ref : str, pathlib.Path, nibabel image or regtricks.ImageSpace
+        Space onto which the masks will be projected.
+    src2ref : regtricks.Registration, optional
+        Linear registration from src to ref. Default is identity.
+    superfactor : int, optional
+        Number of sub-voxels per src voxel along each dimension.
+        Default is 1.
+    chunk_size : int, optional
+        Number of src voxels processed at a time, to limit memory use. 
+        Default is 1000000.
+    """
+
+    def __init__(self, src, ref, src2ref=None, superfactor=1, chunk_size=1000000):
+        if not isinstance(src, rt.ImageSpace):
+            src = rt.ImageSpace(src)
+        if not isinstance(ref, rt.ImageSpace):
+            ref = rt.ImageSpace(ref)
+        if src2ref is None:
+            src2ref = rt.Registration.identity()
+        self.src_spc, self.ref_spc = src, ref
+        self.superfactor = int(superfactor)
+        self.chunk_size = int(chunk_size)
+
+        # src voxel -> ref voxel transformation
+        self._src_vox2ref_vox = ref.world2vox @ src2ref.src2ref @ src.vox2world
+        linear = self._src_vox2ref_vox[:3, :3]
+        self._aligned = np.allclose(linear, np.diag(np.diag(linear)))
+
+        # offsets of sub-voxel centres from the src voxel centre
+        sf = self.superfactor
+        self._steps = (np.arange(sf) + 0.5) / sf - 0.5
+        self._offsets = np.stack(np.meshgrid(*(3 * [self._steps]), indexing='ij'),
+                                 axis=-1).reshape(-1, 3)
+
+        # ref voxel index of each sub-voxel along each axis, if the 
+        # grids are aligned; -1 marks sub-voxels outside ref
+        if self._aligned:
+            self._axis_index = []
+            for axis in range(3):
+                pos = np.rint(
+                    (np.arange(src.size[axis])[:, None] + self._steps) 
+                    * linear[axis, axis] + self._src_vox2ref_vox[axis, 3]
+                ).astype(np.int64)
+                valid = (pos >= 0) & (pos < ref.size[axis])
+                self._axis_index.append(np.where(valid, pos, -1))
+        self._counts = None
+
+    @property
+    def counts(self):
+        """
+        Number of sub-voxels falling within each ref voxel, as a flat 
+        float32 array. Computed on first use.
+        """
+        if self._counts is None:
+            ref_size = self.ref_spc.size
+            n_ref = int(np.prod(ref_size))
+            if self._aligned:
+                axis_counts = [np.bincount(table[table >= 0], minlength=size)
+                               for table, size in zip(self._axis_index, ref_size)]
+                counts = np.einsum('i,j,k->ijk', *axis_counts).reshape(-1)
+            else:
+                n_src = int(np.prod(self.src_spc.size))
+                counts = np.zeros(n_ref, dtype=np.int64)
+                for start in range(0, n_src, self.chunk_size):
+                    idx = self._ref_index(np.arange(start, min(start + self.chunk_size, 
+                                                               n_src)))
+                    counts += np.bincount(idx[idx >= 0], minlength=n_ref)
+            self._counts = counts.astype(np.float32)
+        return self._counts
+
+    def _ref_index(self, voxels):
+        """
+        Flat ref voxel index of each sub-voxel of the given flat src 
+        voxel indices, as an (nvoxels, superfactor**3) array; -1 marks 
+        sub-voxels outside ref.
+        """
+        ijk = np.unravel_index(voxels, self.src_spc.size)
+        if self._aligned:
+            sf = self.superfactor
+            ix, iy, iz = (table[i] for table, i in zip(self._axis_index, ijk))
+            valid = ((ix >= 0)[:, :, None, None] & (iy >= 0)[:, None, :, None] 
+                     & (iz >= 0)[:, None, None, :])
+            flat = ((ix[:, :, None, None] * self.ref_spc.size[1] 
+                     + iy[:, None, :, None]) * self.ref_spc.size[2] 
+                    + iz[:, None, None, :])
+            return np.where(valid, flat, -1).reshape(-1, sf ** 3)
+        ijk = np.stack(ijk, axis=-1)[:, None, :] + self._offsets[None]
+        ref_vox = np.rint(ijk @ self._src_vox2ref_vox[:3, :3].T
+                          + self._src_vox2ref_vox[:3, 3]).astype(np.int64)
+        valid = np.all((ref_vox >= 0) & (ref_vox < self.ref_spc.size), axis=-1)
+        flat = np.ravel_multi_index(tuple(np.moveaxis(ref_vox, -1, 0)),
+                                    self.ref_spc.size, mode='clip')
+        return np.where(valid, flat, -1)
+
+    def _flat(self, array):
+        """
+        Flatten a src space array, checking its size.
+        """
+        array = np.asarray(array)
+        if array.size != np.prod(self.src_spc.size):
+            raise ValueError("Array does not match the projector's src space.")
+        return array.reshape(-1)
+
+    def _unflat(self, values):
+        """
+        Reshape flat ref values (with any trailing dimensions) into 
+        the ref space.
+        """
+        return values.reshape(*self.ref_spc.size, *values.shape[1:])
+
+    def coverage(self, *masks):
+        """
+        Fractional coverage of each ref voxel by the given masks.
+
+        Parameters
+        ----------
+        *masks : np.array
+            Boolean (or 0/1) arrays in src space.
+
+        Returns
+        -------
+        np.array or list of np.array
+            Coverage fraction in [0, 1] for each mask in ref space.
+            Ref voxels that receive no src sub-voxels are 0. If a
+            single mask is given its coverage is returned directly.
+        """
+        n_masks = len(masks)
+        n_ref = int(np.prod(self.ref_spc.size))
+        hits = np.zeros(n_ref * n_masks, dtype=np.int64)
+        for k, mask in enumerate(masks):
+            voxels = np.flatnonzero(self._flat(mask).astype(bool))
+            for start in range(0, voxels.size, self.chunk_size):
+                idx = self._ref_index(voxels[start:start + self.chunk_size])
+                hits += np.bincount(idx[idx >= 0] * n_masks + k, 
+                                    minlength=n_ref * n_masks)
+        hits = hits.reshape(n_ref, n_masks)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = np.where(self.counts[:, None] > 0,
+                           hits / self.counts[:, None], 0.).astype(np.float32)
+        cov = [self._unflat(cov[:, k]) for k in range(n_masks)]
+        return cov[0] if n_masks == 1 else cov
+
+    def label_fractions(self, labels, n_labels=None):
+        """
+        Fraction of each ref voxel covered by each label of a
+        segmentation, in a single `np.bincount` over all labels.
+
+        Parameters
+        ----------
+        labels : np.array
+            Integer array in src space of label indices 0, 1, ...;
+            negative values mark voxels which belong to no label.
+        n_labels : int, optional
+            Number of labels. Default is the largest label + 1.
+
+        Returns
+        -------
+        np.array
+            float32 array of the ref space's size with a last
+            dimension of length `n_labels`, giving the coverage
+            fraction of each label.
+        """
+        labels = self._flat(labels)
+        if n_labels is None:
+            n_labels = int(labels.max()) + 1
+        n_ref = int(np.prod(self.ref_spc.size))
+
+        # only voxels with a label contribute; they are processed in 
+        # chunks to limit the size of the sub-voxel index arrays
+        labelled = np.flatnonzero(labels >= 0)
+        hits = np.zeros(n_ref * n_labels, dtype=np.int64)
+        for start in range(0, labelled.size, self.chunk_size):
+            voxels = labelled[start:start + self.chunk_size]
+            idx = self._ref_index(voxels)
+            keys = idx * n_labels + labels[voxels, None].astype(np.int64)
+            hits += np.bincount(keys[idx >= 0], minlength=n_ref * n_labels)
+        hits = hits.reshape(n_ref, n_labels)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fracs = np.where(self.counts[:, None] > 0,
+                             hits / self.counts[:, None], 0.).astype(np.float32)
+        return self._unflat(fracs)
+
+class LabelResampler:
+    """
+    Downsample a segmentation (e.g. FreeSurfer's wmparc or ribbon) 
+    from a fine voxel grid onto a coarser one by majority vote.
+
+    Every src voxel (or sub-voxel, if `superfactor` > 1) is assigned 
+    to the ref voxel into which it falls, as in `MaskProjector`, and 
+    the histogram of labels within each ref voxel is accumulated 
+    in a single vectorised pass over chunks of voxels. The histogram 
+    is stored sparsely, as each ref voxel only contains a few of the 
+    labels. From it both the majority label of each ref voxel and 
+    the fraction of it covered by any label can be obtained, which 
+    is much less noisy than nearest neighbour resampling.
+
+    The histogram is cached on disk, keyed by the segmentation, the 
+    two spaces, the registration and the superfactor, so repeated 
+    runs for the same subject reuse it.
+
+    Parameters
+    ----------
+    src : str, pathlib.Path or nibabel image
+        Segmentation to be downsampled.
+    ref : str, pathlib.Path, nibabel image or regtricks.ImageSpace
+        Space onto which the segmentation will be downsampled.
+    src2ref : regtricks.Registration, optional
+        Linear registration from src to ref. Default is identity.
+    superfactor : int, optional
+        Number of sub-voxels per src voxel along each dimension. 
+        Default is 1, which is sufficient when the src voxels are 
+        much smaller than the ref voxels.
+    cache_dir : str or pathlib.Path, optional
+        Where to cache the histogram. See `hcpasl.utils.get_cache_dir()`. 
+        If False, the histogram will not be cached.
+    chunk_size : int, optional
+        Passed on to `MaskProjector`.
+    """
+
+    def __init__(self, src, ref, src2ref=None, superfactor=1, cache_dir=None, 
+                 chunk_size=1000000):
+        if isinstance(src, nb.Nifti1Image):
+            src_img, src_key = src, None
+        else:
+            src_img = nb.load(str(src))
+            with open(src, "rb") as f:
+                src_key = np.frombuffer(f.read(), dtype=np.uint8)
+        if not isinstance(ref, rt.ImageSpace):
+            ref = rt.ImageSpace(ref)
+        if src2ref is None:
+            src2ref = rt.Registration.identity()
+        src_spc = rt.ImageSpace(src_img)
+        self.ref_spc = ref
+
+        cache_name = None
+        if cache_dir is not False:
+            if src_key is None:
+                src_key = np.asanyarray(src_img.dataobj)
+            key = hash_arrays(src_key, src_spc.size, src_spc.vox2world, ref.size, 
+                              ref.vox2world, src2ref.src2ref, superfactor)
+            cache_name = get_cache_dir(cache_dir)/f"labels_{key}.npz"
+        cached = None
+        if cache_name is not None:
+            cached = load_cache(_load_npz, cache_name)
+        if cached is not None:
+            self.labels = cached["labels"]
+            self.histogram = sparse.csr_matrix(
+                (cached["data"], cached["indices"], cached["indptr"]),
+                shape=(int(np.prod(ref.size)), self.labels.size)
+            )
+        else:
+            projector = MaskProjector(src_spc, ref, src2ref, superfactor, 
+                                      chunk_size=chunk_size)
+            self._build(projector, np.asanyarray(src_img.dataobj))
+            if cache_name is not None:
+                save_cache(partial(np.savez, labels=self.labels, 
+                                   data=self.histogram.data,
+                                   indices=self.histogram.indices, 
+                                   indptr=self.histogram.indptr), 
+                           cache_name)
+        self.counts = np.asarray(self.histogram.sum(axis=1)).reshape(-1)
+
+    def _build(self, projector, seg):
+        if not np.issubdtype(seg.dtype, np.integer):
+            seg = np.rint(seg)
+        self.labels, inverse = np.unique(seg.astype(np.int32), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        n_labels = self.labels.size
+        n_ref = int(np.prod(self.ref_spc.size))
+        n_src = inverse.size
+
+        # a dense (ref voxels x labels) histogram would be too large for 
+        # wmparc's many labels, so each chunk's (ref voxel, label) pairs 
+        # are counted separately and the counts summed when they are 
+        # combined into a sparse matrix
+        keys, counts = [], []
+        for start in range(0, n_src, projector.chunk_size):
+            voxels = np.arange(start, min(start + projector.chunk_size, n_src))
+            idx = projector._ref_index(voxels)
+            chunk_keys = (idx * n_labels + inverse[voxels, None])[idx >= 0]
+            chunk_keys, chunk_counts = np.unique(chunk_keys, return_counts=True)
+            keys.append(chunk_keys)
+            counts.append(chunk_counts)
+        keys, counts = np.concatenate(keys), np.concatenate(counts)
+        rows, cols = np.divmod(keys, n_labels)
+        self.histogram = sparse.csr_matrix(
+            (counts.astype(np.int32), (rows, cols)), shape=(n_ref, n_labels)
+        )
+
+    def majority(self, fill=0):
+        """
+        Most frequent label in each ref voxel. Ties are broken in 
+        favour of the smallest label.
+
+        Parameters
+        ----------
+        fill : int, optional
+            Label for ref voxels which receive no src sub-voxels. 
+            Default is 0.
+
+        Returns
+        -------
+        np.array
+            int32 label map in ref space.
+        """
+        hist = self.histogram
+        starts, lengths = hist.indptr[:-1], np.diff(hist.indptr)
+        rows = np.repeat(np.arange(lengths.size), lengths)
+        # sort each row's entries by decreasing count then by label, 
+        # so that the winner is the first entry of each row
+        order = np.lexsort((hist.indices, -hist.data, rows))
+        labels = np.full(lengths.size, fill, dtype=np.int32)
+        filled = lengths > 0
+        labels[filled] = self.labels[hist.indices[order[starts[filled]]]]
+        return labels.reshape(self.ref_spc.size)
+
+    def fractions(self, labels=None):
+        """
+        Fraction of each ref voxel covered by each of the given labels.
+
+        Parameters
+        ----------
+        labels : iterable of ints, optional
+            Labels of interest. Default is all of the labels present 
+            in the segmentation (see `self.labels`). Labels which are 
+            not present have zero coverage.
+
+        Returns
+        -------
+        np.array
+            float32 array of the ref space's size with a last 
+            dimension of one entry per label.
+        """
+        if labels is None:
+            labels = self.labels
+        labels = np.asarray(labels).reshape(-1)
+        cols = np.searchsorted(self.labels, labels).clip(max=self.labels.size - 1)
+        present = self.labels[cols] == labels
+        fracs = np.zeros((self.counts.size, labels.size), dtype=np.float32)
+        fracs[:, present] = self.histogram[:, cols[present]].toarray()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fracs = np.where(self.counts[:, None] > 0, 
+                             fracs / self.counts[:, None], 0.).astype(np.float32)
+        return fracs.reshape(*self.ref_spc.size, labels.size)
+
+class SparseResampler:
+    """
+    A linear registration between two spaces, precomputed as a sparse 
+    interpolation matrix so that it can be applied cheaply to many 
+    3D or 4D arrays.
+
+    This reproduces `regtricks.Registration.apply_to_array` for 
+    nearest neighbour (order=0) and trilinear (order=1) interpolation 
+    with `mask=False`: the src data is edge-padded by one voxel, 
+    samples falling outside it are 0 and, if supersampling, the 
+    output is block-averaged back down to the ref grid.
+
+    The matrix is cached on disk, keyed by the two spaces, the 
+    transformation, the order and the superfactor, so it only needs 
+    to be built once per subject.
+
+    Parameters
+    ----------
+    src : str, pathlib.Path, nibabel image or regtricks.ImageSpace
+        Space of the data to be resampled.
+    ref : str, pathlib.Path, nibabel image or regtricks.ImageSpace
+        Space into which the data will be resampled.
+    src2ref : regtricks.Registration, optional
+        Linear registration from src to ref. Default is identity.
+    order : int, optional
+        Interpolation order, 0 or 1. Default is 1.
+    superfactor : bool or int or iterable, optional
+        Supersampling of the ref grid, as in regtricks. Default is 
+        True, the ratio of ref to src voxel sizes.
+    cache_dir : str or pathlib.Path, optional
+        Where to cache the matrix. See `hcpasl.utils.get_cache_dir()`. 
+        If False, the matrix will not be cached.
+    slab_size : int, optional
+        Number of ref slices processed at a time when building the 
+        matrix, to limit memory use. Default is 8.
+    """
+
+    def __init__(self, src, ref, src2ref=None, order=1, superfactor=True, 
+                 cache_dir=None, slab_size=8):
+        if order not in (0, 1):
+            raise ValueError("SparseResampler only supports order 0 or 1.")
+        if not isinstance(src, rt.ImageSpace):
+            src = rt.ImageSpace(src)
+        if not isinstance(ref, rt.ImageSpace):
+            ref = rt.ImageSpace(ref)
+        if src2ref is None:
+            src2ref = rt.Registration.identity()
+        self.src_spc, self.ref_spc, self.order = src, ref, order
+
+        # supersampling factor, chosen as in regtricks
+        if superfactor is True:
+            sfactor = np.maximum(np.floor(ref.vox_size / src.vox_size), 1)
+        elif superfactor is False:
+            sfactor = np.ones(3)
+        else:
+            sfactor = np.ones(3) * np.asanyarray(superfactor)
+        self.superfactor = sfactor.astype(int)
+
+        key = hash_arrays(src.size, src.vox2world, ref.size, ref.vox2world,
+                          src2ref.src2ref, order, self.superfactor)
+        cache_name = None
+        if cache_dir is not False:
+            cache_name = get_cache_dir(cache_dir)/f"resampler_{key}.npz"
+        self.matrix = None
+        if cache_name is not None:
+            self.matrix = load_cache(sparse.load_npz, cache_name)
+        if self.matrix is None:
+            self.matrix = self._build(src2ref, slab_size)
+            if cache_name is not None:
+                save_cache(partial(sparse.save_npz, matrix=self.matrix), cache_name)
+
+    def _build(self, src2ref, slab_size):
+        src, ref, sf = self.src_spc, self.ref_spc, self.superfactor
+        if (sf > 1).any():
+            super_ref = ref.resize_voxels(1 / sf, "ceil")
+        else:
+            super_ref = ref
+
+        # coordinates are computed in the edge-padded src space, as in 
+        # regtricks, so that the boundary behaviour is identical
+        pad_spc = src.resize([-1, -1, -1], src.size + 2)
+        super2pad = pad_spc.world2vox @ src2ref.ref2src @ super_ref.vox2world
+        pad_size = pad_spc.size
+
+        if self.order == 0:
+            corners = np.zeros((1, 3), dtype=int)
+        else:
+            corners = np.stack(np.meshgrid([0, 1], [0, 1], [0, 1], indexing='ij'),
+                               axis=-1).reshape(-1, 3)
+
+        nx, ny, nz = super_ref.size
+        slabs = []
+        for start in range(0, nz, slab_size * sf[2]):
+            ks = np.arange(start, min(start + slab_size * sf[2], nz))
+            ijk = np.stack(np.meshgrid(np.arange(nx), np.arange(ny), ks, 
+                                       indexing='ij'), axis=-1).reshape(-1, 3)
+            coords = ijk @ super2pad[:3, :3].T + super2pad[:3, 3]
+
+            # scipy's map_coordinates with mode='constant' returns cval 
+            # for any sample outside [0, N-1] of the (padded) input
+            valid = np.all((coords >= 0) & (coords <= pad_size - 1), axis=-1)
+            ijk, coords = ijk[valid], coords[valid]
+            rows = np.ravel_multi_index(tuple((ijk // sf).T), ref.size)
+
+            if self.order == 0:
+                base = np.floor(coords + 0.5).astype(int)
+                frac = np.zeros_like(coords)
+            else:
+                base = np.floor(coords).astype(int)
+                frac = coords - base
+
+            slab_rows, slab_cols, slab_vals = [], [], []
+            for corner in corners:
+                weight = np.prod(np.where(corner, frac, 1 - frac), axis=-1)
+                # map padded indices back onto the unpadded data 
+                src_ijk = np.clip(base + corner - 1, 0, src.size - 1)
+                slab_rows.append(rows)
+                slab_cols.append(np.ravel_multi_index(tuple(src_ijk.T), src.size))
+                slab_vals.append(weight)
+            slab = sparse.coo_matrix(
+                (np.concatenate(slab_vals) / np.prod(sf), 
+                 (np.concatenate(slab_rows), np.concatenate(slab_cols))),
+                shape=(int(np.prod(ref.size)), int(np.prod(src.size)))
+            ).tocsr()
+            slab.eliminate_zeros()
+            slabs.append(slab.tocoo())
+
+        # slabs cover disjoint sets of rows so can be combined directly
+        shape = slabs[0].shape
+        rows, cols, vals = [np.concatenate([getattr(m, a) for m in slabs])
+                            for a in ("row", "col", "data")]
+        return sparse.csr_matrix((vals.astype(np.float32), (rows, cols)), 
+                                 shape=shape)
+
+    def apply_to_array(self, data):
+        """
+        Resample a 3D or 4D array from src to ref.
+
+        Parameters
+        ----------
+        data : np.array
+            3D or 4D array in src space. For 4D data, the same 
+            transformation is applied to every volume.
+
+        Returns
+        -------
+        np.array
+            float32 array in the ref voxel grid.
+        """
+        if not np.array_equal(data.shape[:3], self.src_spc.size):
+            raise ValueError(f"Data shape {data.shape} does not match source "
+                             + f"space {self.src_spc.size}.")
+        n_vols = data.shape[3:]
+        flat = np.asarray(data, dtype=np.float32).reshape(
+            int(np.prod(self.src_spc.size)), -1)
+        out = self.matrix @ flat
+        return out.reshape(*self.ref_spc.size, *n_vols)
+
+    def apply_to_image(self, src):
+        """
+        Resample an image from src to ref.
+
+        Parameters
+        ----------
+        src : str, pathlib.Path or nibabel image
+            Image in src space.
+
+        Returns
+        -------
+        nibabel.Nifti1Image
+            Resampled image in ref space.
+        """
+        if not isinstance(src, nb.Nifti1Image):
+            src = nb.load(str(src))
+        resamp = self.apply_to_array(src.get_fdata(dtype=np.float32))
+        return nb.nifti1.Nifti1Image(resamp, self.ref_spc.vox2world, 
+                                     self.ref_spc.header)
+
+def apply_registration(reg, src, ref, order=3, cache_dir=None, **kwargs):
+    """
+    Apply a registration to an image.
+
+    For a single linear registration with order 0 this uses a 
+    (cached) `SparseResampler`, otherwise it falls back to the 
+    registration's own `apply_to_image()`. Higher orders are left to 
+    regtricks because it masks their output to the src image's 
+    field of view, which `SparseResampler` doesn't.
+
+    Parameters
+    ----------
+    reg : regtricks.Transform
+        Registration from src to ref.
+    src : str, pathlib.Path or nibabel image
+        Image to be resampled.
+    ref : str, pathlib.Path, nibabel image or regtricks.ImageSpace
+        Space into which the image will be resampled.
+    order : int, optional
+        Interpolation order. Default is 3.
+    cache_dir : str or pathlib.Path, optional
+        Passed on to `SparseResampler`.
+    **kwargs
+        Passed on to `apply_to_image()` when falling back.
+
+    Returns
+    -------
+    nibabel.Nifti1Image
+        Resampled image in ref space.
+    """
+    if type(reg) is rt.Registration and order == 0:
+        if not isinstance(src, nb.Nifti1Image):
+            src = nb.load(str(src))
+        resampler = SparseResampler(src, ref, reg, order=order, cache_dir=cache_dir)
+        return resampler.apply_to_image(src)
+    return reg.apply_to_image(src=src, ref=ref, order=order, **kwargs)
+
+def _load_npz(name):
+    """Load every array in an .npz archive, so a truncated file fails here."""
+    with np.load(name) as archive:
+        return {key: archive[key] for key in archive.files}
+
+def _auto_superfactor(src_spc, ref_spc):
+    """
+    Supersampling factor chosen automatically by regtricks.
+    """
+    return np.maximum(np.floor(ref_spc.vox_size / src_spc.vox_size), 1).astype(int)
+
+def _linear_coords(reg, pad_spc, ref_spc, sfactor):
+    """
+    Coordinates, in the voxel grid of the padded src space, at which 
+    to sample the data for a linear registration. Also returns the 
+    (possibly supersampled) reference space.
+    """
+    super_ref = ref_spc.resize_voxels(1 / sfactor, "ceil") if (sfactor > 1).any() else ref_spc
+    ref2src_vox = pad_spc.world2vox @ reg.ref2src @ super_ref.vox2world
+    ijk = super_ref.ijk_grid('ij').reshape(-1, 3)
+    coords = (ijk @ ref2src_vox[:3, :3].T + ref2src_vox[:3, 3]).T
+    return coords, super_ref
+
+# the most recently used sampling grids, shared between calls to 
+# `apply_to_images()` for the same spaces and registration
+_COORDS_CACHE_SIZE = 2
+_coords_cache = OrderedDict()
+_coords_lock = Lock()
+
+def _cached_linear_coords(reg, pad_spc, ref_spc, sfactor):
+    """
+    As `_linear_coords()`, but keeping the last few grids in memory 
+    so that repeated resamplings between the same pair of spaces 
+    don't recompute them. The returned coordinates must not be 
+    modified in place.
+    """
+    key = hash_arrays(pad_spc.size, pad_spc.vox2world, ref_spc.size, 
+                      ref_spc.vox2world, reg.src2ref, sfactor)
+    with _coords_lock:
+        if key in _coords_cache:
+            _coords_cache.move_to_end(key)
+            return _coords_cache[key]
+    grid = _linear_coords(reg, pad_spc, ref_spc, sfactor)
+    with _coords_lock:
+        _coords_cache[key] = grid
+        while len(_coords_cache) > _COORDS_CACHE_SIZE:
+            _coords_cache.popitem(last=False)
+    return grid
+
+def _sample(data, coords, super_ref, sfactor, order, cval):
+    """
+    Interpolate a single padded volume at the given coordinates, 
+    replicating regtricks' clipping and block averaging.
+    """
+    interp = map_coordinates(data, coords, order=order, mode="constant", 
+                             cval=cval, prefilter=True)
+    interp = np.clip(interp, min(data.min(), cval), max(data.max(), cval))
+    interp = interp.reshape(super_ref.size)
+    if (sfactor > 1).any():
+        interp = sum_array_blocks(interp, sfactor) / np.prod(sfactor)
+    return interp
+
+def _fill_and_close(mask):
+    return binary_closing(binary_fill_holes(mask), iterations=3, border_value=1)
+
+def apply_to_images(reg, srcs, ref, order=3, superfactor=True, mask=True, 
+                    cval=0., cores=1):
+    """
+    Apply a registration to several images which share a voxel grid.
+
+    The images are treated as channels of a single 4D array. For a 
+    linear registration the sampling coordinates on the reference grid 
+    are computed once and shared by all channels, which are then 
+    interpolated in parallel threads; the output is the same as 
+    calling `apply_to_image()` on each image in turn. The last few 
+    sampling grids are kept in memory, so later calls between the 
+    same spaces with the same registration reuse them. Other 
+    transformations are applied to the stacked 4D array in a single 
+    `apply_to_array()` call.
+
+    Parameters
+    ----------
+    reg : regtricks.Transform
+        Transformation from the images' space to ref.
+    srcs : list of str, pathlib.Path or nibabel images
+        3D images to resample, all in the same space.
+    ref : str, pathlib.Path, nibabel image or regtricks.ImageSpace
+        Space into which the images will be resampled.
+    order, superfactor, mask, cval
+        As for `regtricks.Transform.apply_to_image()`.
+    cores : int, optional
+        Number of channels to process at the same time. Default is 1.
+
+    Returns
+    -------
+    list of nibabel.Nifti1Image
+        Resampled images in ref space, in the same order as srcs.
+    """
+    srcs = [src if isinstance(src, nb.Nifti1Image) else nb.load(str(src))
+            for src in srcs]
+    src_spc = rt.ImageSpace(srcs[0])
+    if not all(rt.ImageSpace(src) == src_spc for src in srcs[1:]):
+        raise ValueError("All images must share the same voxel grid.")
+    if not isinstance(ref, rt.ImageSpace):
+        ref = rt.ImageSpace(ref)
+    data = np.stack([src.get_fdata(dtype=np.float32) for src in srcs], axis=-1)
+
+    if type(reg) is not rt.Registration:
+        resamp = reg.apply_to_array(data, src_spc, ref, order=order, 
+                                    superfactor=superfactor, mask=mask, 
+                                    cval=cval, cores=cores)
+        return [nb.nifti1.Nifti1Image(resamp[..., idx], ref.vox2world, ref.header)
+                for idx in range(len(srcs))]
+
+    # pad each channel by one voxel, as regtricks does, to avoid losing 
+    # slices at the edge of the FoV
+    data = np.pad(data, [(1, 1)] * 3 + [(0, 0)], mode="edge")
+    pad_spc = src_spc.resize([-1, -1, -1], data.shape[:3])
+    auto_sf = _auto_superfactor(pad_spc, ref)
+    if superfactor is True:
+        sfactor = auto_sf
+    elif superfactor is False:
+        sfactor = np.ones(3, dtype=int)
+    else:
+        sfactor = (np.ones(3) * np.asanyarray(superfactor)).astype(int)
+    coords, super_ref = _cached_linear_coords(reg, pad_spc, ref, sfactor)
+
+    # regtricks resamples the spline artefact mask with the automatic 
+    # superfactor and trilinear interpolation, padding it a second time
+    use_mask = mask and order > 0
+    if use_mask:
+        if np.array_equal(sfactor, auto_sf):
+            mask_coords, mask_ref = coords + 1, super_ref
+        else:
+            mask_coords, mask_ref = _cached_linear_coords(reg, pad_spc, ref, auto_sf)
+            mask_coords = mask_coords + 1
+
+    def worker(idx):
+        vol = data[..., idx]
+        resamp = _sample(vol, coords, super_ref, sfactor, order, cval)
+        if use_mask:
+            mvol = _fill_and_close(vol != cval).astype(np.float32)
+            mvol = np.pad(mvol, 1, mode="edge")
+            mres = _sample(mvol, mask_coords, mask_ref, auto_sf, 1, 0.)
+            resamp[~_fill_and_close(mres.astype(bool))] = cval
+        return nb.nifti1.Nifti1Image(resamp, ref.vox2world, ref.header)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(cores, len(srcs)))) as executor:
+        return list(executor.map(worker, range(len(srcs))))
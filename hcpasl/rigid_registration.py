@@ -0,0 +1,91 @@
+"""
+Fast, in-process rigid registration between two volumes of the
+same contrast, e.g. the subject's two calibration images.
+"""
+
+import numpy as np
+from scipy.ndimage import gaussian_filter, map_coordinates
+from scipy.optimize import minimize
+from scipy.spatial.transform import Rotation
+import regtricks as rt
+import nibabel as nb
+
+def _params_to_matrix(params, centre):
+    """
+    Build a 4x4 world-space rigid transformation from 3 rotations
+    (degrees, about `centre`) and 3 translations (mm).
+    """
+    rot = Rotation.from_euler("xyz", params[:3], degrees=True).as_matrix()
+    mat = np.eye(4)
+    mat[:3, :3] = rot
+    mat[:3, 3] = centre - rot @ centre + params[3:]
+    return mat
+
+def ncc(a, b):
+    """
+    Normalised cross-correlation between two arrays of equal shape.
+    """
+    a = a - a.mean()
+    b = b - b.mean()
+    denom = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / denom) if denom > 0 else 0.
+
+def rigid_register(src, ref, mask=None, sigma=1., max_iter=2000):
+    """
+    Estimate a 6 degree-of-freedom registration from `src` to `ref`.
+
+    The cost function is 1 - NCC between the reference image and
+    the src image resampled (trilinear) onto the reference voxels
+    within `mask`. Both images are lightly smoothed before the
+    optimisation, which uses Powell's method.
+
+    Parameters
+    ----------
+    src : str or pathlib.Path or nibabel.Nifti1Image
+        Image to be registered.
+    ref : str or pathlib.Path or nibabel.Nifti1Image
+        Reference image.
+    mask : np.array, optional
+        Boolean mask in reference space of the voxels to use in
+        the cost function. Default is all voxels brighter than
+        10% of the reference's 99th percentile intensity.
+    sigma : float, optional
+        Standard deviation, in voxels, of the Gaussian smoothing
+        applied to both images. Default is 1.
+    max_iter : int, optional
+        Maximum number of iterations for the optimiser.
+
+    Returns
+    -------
+    src2ref : regtricks.Registration
+        Rigid registration from src to ref.
+    similarity : float
+        NCC between the registered images within `mask`.
+    """
+    src, ref = [nb.load(str(img)) if not isinstance(img, nb.Nifti1Image) else img
+                for img in (src, ref)]
+    src_spc, ref_spc = rt.ImageSpace(src), rt.ImageSpace(ref)
+    src_data = gaussian_filter(src.get_fdata(dtype=np.float32), sigma)
+    ref_data = gaussian_filter(ref.get_fdata(dtype=np.float32), sigma)
+    if mask is None:
+        mask = ref_data > 0.1 * np.percentile(ref_data, 99)
+    ref_vals = ref_data[mask]
+
+    # world coordinates of the reference voxels used in the cost function
+    ijk = np.stack(np.nonzero(mask), axis=0)
+    ref_world = ref_spc.vox2world[:3, :3] @ ijk + ref_spc.vox2world[:3, 3:]
+    centre = ref_world.mean(axis=1)
+    ref_world = np.concatenate((ref_world, np.ones((1, ijk.shape[1]))))
+
+    def cost(params):
+        ref2src = _params_to_matrix(params, centre)
+        src_vox = (src_spc.world2vox @ ref2src @ ref_world)[:3]
+        src_vals = map_coordinates(src_data, src_vox, order=1,
+                                   mode='constant', cval=0.)
+        return 1. - ncc(ref_vals, src_vals)
+
+    res = minimize(cost, np.zeros(6), method='Powell',
+                   options={'xtol': 1e-3, 'ftol': 1e-6, 'maxiter': max_iter})
+    ref2src = _params_to_matrix(res.x, centre)
+    src2ref = rt.Registration(np.linalg.inv(ref2src))
+    return src2ref, 1. - res.fun
@@ -0,0 +1,211 @@
+"""
+Geodesic Gaussian smoothing of surface metrics, approximating
+`wb_command -metric-smoothing` (GEO_GAUSS_AREA), with the kernel
+precomputed as a sparse matrix.
+
+The geodesic distances are approximate, so the results agree with
+wb_command's only to within the tolerances checked in
+tests/test_surface_smoothing.py.
+"""
+
+from functools import partial
+
+import numpy as np
+from scipy import sparse
+
+from .surface_mapping import load_surface
+from .utils import get_cache_dir, hash_arrays, load_cache, save_cache
+
+def fwhm_to_sigma(fwhm):
+    """
+    Convert a Gaussian kernel's FWHM to its standard deviation.
+    """
+    return float(fwhm) / (2 * np.sqrt(2 * np.log(2)))
+
+def vertex_areas(coords, triangles):
+    """
+    Area associated with each vertex of a surface: a third of the
+    total area of the triangles it belongs to.
+    """
+    tri = coords[triangles]
+    tri_areas = 0.5 * np.linalg.norm(
+        np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0]), axis=1
+    )
+    return np.bincount(triangles.reshape(-1), np.repeat(tri_areas, 3) / 3,
+                       minlength=coords.shape[0])
+
+def _distance_graph(coords, triangles):
+    """
+    Sparse graph of the distances along the surface's edges and, for
+    each pair of triangles sharing an edge, across the pair between
+    their opposite vertices, so that shortest paths through the graph
+    approximate geodesic distances more closely than the edges alone.
+    """
+    edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]],
+                            triangles[:, [2, 0]]])
+    opposite = np.concatenate([triangles[:, 2], triangles[:, 0], triangles[:, 1]])
+
+    # pair up the two triangles on either side of each edge
+    key = np.sort(edges, axis=1)
+    order = np.lexsort((key[:, 1], key[:, 0]))
+    key, opposite = key[order], opposite[order]
+    shared = np.all(key[1:] == key[:-1], axis=1)
+    pairs = np.stack((opposite[:-1][shared], opposite[1:][shared]), axis=1)
+
+    links = np.concatenate((key, pairs))
+    dists = np.linalg.norm(coords[links[:, 0]] - coords[links[:, 1]], axis=1)
+    n = coords.shape[0]
+    graph = sparse.coo_matrix((dists, (links[:, 0], links[:, 1])), shape=(n, n))
+    return _symmetric_min(graph)
+
+def _symmetric_min(graph):
+    """
+    Symmetrise a sparse distance graph, keeping the shortest link
+    between each pair of vertices.
+    """
+    graph = graph.tocoo()
+    rows = np.concatenate((graph.row, graph.col))
+    cols = np.concatenate((graph.col, graph.row))
+    vals = np.concatenate((graph.data, graph.data))
+    order = np.lexsort((vals, cols, rows))
+    rows, cols, vals = rows[order], cols[order], vals[order]
+    first = np.ones(rows.size, dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    return sparse.csr_matrix((vals[first], (rows[first], cols[first])),
+                             shape=graph.shape)
+
+def _local_distances(graph, limit):
+    """
+    Shortest path distances through a sparse distance graph between 
+    all pairs of vertices no more than `limit` apart.
+
+    Paths are grown one link at a time from every vertex at once 
+    (a bounded Bellman-Ford), only extending the pairs whose distance 
+    changed in the last step, so the cost scales with the number of 
+    pairs within `limit` rather than with the square of the number 
+    of vertices.
+
+    Returns
+    -------
+    rows, cols, dists : np.array
+        The pairs of vertices and their distances.
+    """
+    graph = graph.tocsr()
+    n = graph.shape[0]
+    # pairs are encoded as row * n + col
+    key = np.arange(n, dtype=np.int64) * (n + 1)
+    dist = np.zeros(n)
+    front_key, front_dist = key, dist
+    while front_key.size:
+        rows, cols = np.divmod(front_key, n)
+        starts = graph.indptr[cols]
+        counts = graph.indptr[cols + 1] - starts
+        idx = (np.repeat(starts - np.cumsum(counts) + counts, counts) 
+               + np.arange(counts.sum()))
+        new_key = np.repeat(rows, counts) * n + graph.indices[idx]
+        new_dist = np.repeat(front_dist, counts) + graph.data[idx]
+        keep = new_dist <= limit
+        new_key, new_dist = new_key[keep], new_dist[keep]
+
+        # keep the shortest distance for each pair; on a tie the existing 
+        # entry wins, so only pairs which improved are extended again
+        all_key = np.concatenate((key, new_key))
+        all_dist = np.concatenate((dist, new_dist))
+        is_new = np.repeat([False, True], [key.size, new_key.size])
+        order = np.lexsort((is_new, all_dist, all_key))
+        all_key, all_dist, is_new = all_key[order], all_dist[order], is_new[order]
+        first = np.ones(all_key.size, dtype=bool)
+        first[1:] = all_key[1:] != all_key[:-1]
+        key, dist, is_new = all_key[first], all_dist[first], is_new[first]
+        front_key, front_dist = key[is_new], dist[is_new]
+    rows, cols = np.divmod(key, n)
+    return rows, cols, dist
+
+class SurfaceSmoother:
+    """
+    Geodesic Gaussian smoothing kernel for a surface mesh.
+
+    The weight of vertex j in the smoothed value at vertex i is
+    exp(-d_ij^2 / (2 sigma^2)) times the area of vertex j, normalised
+    over the vertices used, where d_ij is the geodesic distance
+    between them (the shortest path through the mesh, see
+    `_distance_graph()`) and vertices further than `truncate` sigmas
+    apart are ignored.
+
+    The kernel depends only on the mesh and the FWHM, so it is cached
+    on disk keyed by both and every metric smoothed with it then
+    costs one sparse matrix product. Caching only pays off for meshes
+    which are reused, e.g. a template sphere; subjects' own surfaces
+    each give a different kernel, so pass `cache_dir=False` for them.
+
+    Parameters
+    ----------
+    surf : str, pathlib.Path or nibabel.gifti.GiftiImage
+        Surface on which the geodesic distances are measured, e.g.
+        the 32k_fs_LR midthickness.
+    fwhm : float
+        FWHM of the Gaussian kernel, in mm.
+    truncate : float, optional
+        Truncate the kernel at this many standard deviations. Default
+        is 4.0.
+    cache_dir : str or pathlib.Path, optional
+        Where to cache the kernel. See `hcpasl.utils.get_cache_dir()`.
+        If False, the kernel will not be cached.
+    """
+
+    def __init__(self, surf, fwhm, truncate=4.0, cache_dir=None):
+        coords, triangles = load_surface(surf)
+        self.n_vertices = coords.shape[0]
+        self.sigma = fwhm_to_sigma(fwhm)
+
+        key = hash_arrays(coords, triangles, self.sigma, truncate)
+        cache_name = None
+        if cache_dir is not False:
+            cache_name = get_cache_dir(cache_dir)/f"geo_smooth_{key}.npz"
+        self.kernel = None
+        if cache_name is not None:
+            self.kernel = load_cache(sparse.load_npz, cache_name)
+        if self.kernel is None:
+            self.kernel = self._build(coords, triangles, truncate)
+            if cache_name is not None:
+                save_cache(partial(sparse.save_npz, matrix=self.kernel), cache_name)
+
+    def _build(self, coords, triangles, truncate):
+        n = self.n_vertices
+        if self.sigma <= 0:
+            return sparse.identity(n, dtype=np.float32, format="csr")
+        rows, cols, dists = _local_distances(_distance_graph(coords, triangles),
+                                             truncate * self.sigma)
+        vals = np.exp(-dists**2 / (2 * self.sigma**2)) * vertex_areas(coords, triangles)[cols]
+        return sparse.csr_matrix((vals.astype(np.float32), (rows, cols)), shape=(n, n))
+
+    def smooth(self, data, roi=None):
+        """
+        Smooth one or more metrics.
+
+        Parameters
+        ----------
+        data : np.array
+            (nvertices,) or (nvertices, nmetrics) array of values.
+        roi : np.array, optional
+            Only vertices where `roi` is positive are used and
+            smoothed; the output is 0 elsewhere (as for wb_command's
+            -roi option).
+
+        Returns
+        -------
+        np.array
+            float32 smoothed values, with the shape of `data`.
+        """
+        data = np.asarray(data, dtype=np.float32)
+        values = data.reshape(self.n_vertices, -1)
+        if roi is None:
+            weights = np.ones(self.n_vertices, dtype=np.float32)
+        else:
+            weights = (np.asarray(roi).reshape(-1) > 0).astype(np.float32)
+        sums = self.kernel @ (values * weights[:, None])
+        totals = self.kernel @ weights
+        valid = (totals > 0) & (weights > 0)
+        smoothed = np.zeros_like(values)
+        smoothed[valid] = sums[valid] / totals[valid, None]
+        return smoothed.reshape(data.shape)
@@ -1,8 +1,13 @@
+import os
+from functools import lru_cache
+
 import regtricks as rt
 import nibabel as nb
 
 import numpy as np
-import scipy
+from scipy.ndimage import binary_erosion
+
+from .resampling import apply_to_images, LabelResampler
 
 TISSUE_LABELS = {
     "wm": (2, 41),
@@ -11,10 +16,15 @@ TISSUE_LABELS = {
     "allvent": (4, 43, 5, 14, 44, 15, 72, 31, 63, 0, 24)
 }
 
+@lru_cache(maxsize=None)
+def _read_LUT(LUT_name):
+    with open(LUT_name) as f:
+        return tuple(int(l.split(" ")[0]) for l in f.readlines()[1::2])
+
 def parse_LUT(LUT_name):
     """
     Parse a FreeSurfer Lookup-Table returning the desired label 
-    names.
+    names. Each table is only read from disk once per process.
 
     Parameters
     ----------
@@ -26,9 +36,137 @@ def parse_LUT(LUT_name):
     labels : list of ints
         List of int labels from the LUT
     """
-    with open(LUT_name) as f:
-        labels = [int(l.split(" ")[0]) for l in f.readlines()[1::2]]
-    return labels
+    return list(_read_LUT(str(LUT_name)))
+
+def build_lookup(label_values, default=0, dtype=np.float32, size=None):
+    """
+    Build a dense lookup array indexed by label value.
+
+    Parameters
+    ----------
+    label_values : dict or iterable of ints
+        Either a dict mapping label to output value, or an iterable 
+        of labels which will all be mapped to 1.
+    default : scalar, optional
+        Value for labels not in `label_values`. Default is 0.
+    dtype : np.dtype, optional
+        dtype of the lookup array. Default is np.float32.
+    size : int, optional
+        Length of the lookup array. Default is one more than the 
+        largest label given.
+
+    Returns
+    -------
+    lut : np.array
+        1D array such that `lut[label]` is the value for `label`.
+    """
+    if not isinstance(label_values, dict):
+        label_values = dict.fromkeys(label_values, 1)
+    labels = np.fromiter(label_values.keys(), dtype=np.int64)
+    values = np.fromiter(label_values.values(), dtype=dtype, 
+                         count=labels.size)
+    if size is None:
+        size = labels.max() + 1 if labels.size else 1
+    lut = np.full(size, default, dtype=dtype)
+    lut[labels] = values
+    return lut
+
+def apply_lookup(seg, lut, default=0):
+    """
+    Map every voxel of a segmentation through a lookup array in a 
+    single vectorised pass.
+
+    Parameters
+    ----------
+    seg : np.array
+        Integer-valued segmentation, e.g. aparc+aseg or wmparc. 
+        Float arrays are rounded to the nearest integer.
+    lut : np.array
+        Lookup array, as returned by `build_lookup`. Further 
+        dimensions (e.g. one column per tissue, see 
+        `generate_tissue_masks()`) are appended to the output.
+    default : scalar or np.array, optional
+        Value for voxels whose label lies outside the lookup array, 
+        which may vary along the lookup's further dimensions. 
+        Default is 0.
+
+    Returns
+    -------
+    np.array
+        Array of the same shape as `seg`, followed by any further 
+        dimensions of `lut`, and of the same dtype as `lut`.
+    """
+    seg = np.asanyarray(seg)
+    if not np.issubdtype(seg.dtype, np.integer):
+        seg = np.rint(seg).astype(np.intp)
+    lo, hi = int(seg.min()), int(seg.max())
+    if lo < 0 or hi >= len(lut):
+        # pad the lookup with the default so every label is in range
+        offset = max(-lo, 0)
+        padded = np.full((offset + max(hi + 1, len(lut)), *lut.shape[1:]), 
+                         default, dtype=lut.dtype)
+        padded[offset:offset+len(lut)] = lut
+        return padded[seg + offset]
+    return lut[seg]
+
+def _tissue_labels(tissue):
+    """
+    Labels which define a tissue, and whether the tissue is every 
+    voxel *except* those labels (as for gm).
+    """
+    if tissue == "gm":
+        return (*TISSUE_LABELS["allwm"], *TISSUE_LABELS["allvent"]), True
+    return TISSUE_LABELS[tissue], False
+
+def generate_tissue_masks(aparc_aseg, tissues, erode=False):
+    """
+    Generate several tissue masks from FreeSurfer's aparc+aseg.
+
+    The segmentation is loaded once and all of the masks are 
+    obtained from a single pass through a lookup table with one 
+    column per tissue.
+
+    Parameters
+    ----------
+    aparc_aseg: Path to FS's T1-space aparac_aseg output.
+    tissues: iterable of str, tissues of interest (wm, allwm, csf, 
+             allvent, gm).
+    erode: bool or iterable of bool, whether to erode the initial 
+           masks or not, either for all tissues or for each one. 
+           Default is False.
+
+    Returns
+    -------
+    masks: list of nibabel.Nifti1Image float32 logical masks of the 
+           tissues of interest, in the order given
+    """
+    tissues = list(tissues)
+    if isinstance(erode, bool):
+        erode = [erode] * len(tissues)
+    if len(erode) != len(tissues):
+        raise ValueError("erode must be a bool or have one value per tissue.")
+
+    # load aparc_aseg
+    aseg = nb.load(aparc_aseg)
+    aseg_data = np.asanyarray(aseg.dataobj)
+
+    # one lookup column per tissue; gm is the complement of its labels
+    labels, inverted = zip(*(_tissue_labels(t) for t in tissues))
+    size = max(max(l) for l in labels) + 1
+    defaults = np.array(inverted, dtype=np.float32)
+    lut = np.stack([
+        build_lookup(dict.fromkeys(l, 1. - inv), default=inv, size=size)
+        for l, inv in zip(labels, defaults)
+    ], axis=-1)
+    masks = apply_lookup(aseg_data, lut, default=defaults)
+
+    # potential round of eroding
+    for idx in np.flatnonzero(erode):
+        masks[..., idx] = binary_erosion(masks[..., idx])
+
+    # create and return Nifti1Images
+    return [nb.nifti1.Nifti1Image(masks[..., idx], affine=aseg.affine)
+            for idx in range(len(tissues))]
 
 def generate_tissue_mask(aparc_aseg, tissue, erode=False):
     """
@@ -45,34 +183,97 @@ def generate_tissue_mask(aparc_aseg, tissue, erode=False):
     -------
     mask: nibabel.Nifti1Image logical mask of tissue of interest
     """
-    # load aparc_aseg
-    aseg = nb.load(aparc_aseg)
-    aseg_data = aseg.get_fdata()
+    return generate_tissue_masks(aparc_aseg, [tissue], erode=erode)[0]
 
-    # create mask
-    mask = np.zeros_like(aseg_data)
+@lru_cache(maxsize=None)
+def _read_flirt(mat, src, ref, mtimes):
+    return rt.Registration.from_flirt(mat, src=src, ref=ref)
 
-    # get appropriate labels
-    if tissue == "gm":
-        labels = (*TISSUE_LABELS["allwm"], *TISSUE_LABELS["allvent"])
-    else:
-        labels = TISSUE_LABELS[tissue]
+def load_struct2ref(struct2ref, src, ref):
+    """
+    Load a FLIRT registration from structural to reference space.
 
-    # iterate through labels
-    for label in labels:
-        mask = np.where(aseg_data==label, 1., mask)
-    
-    # invert mask if tissue==gm
-    if tissue == "gm":
-        mask = np.where(mask==0., 1., 0.)
+    Registrations are only read once per process for each set of 
+    files (unless any of them has been modified since), so that 
+    they can be shared between calls.
 
-    # potential round of eroding
-    if erode:
-        mask = scipy.ndimage.morphology.binary_erosion(mask).astype(np.float)
+    Parameters
+    ----------
+    struct2ref : str, pathlib.Path or regtricks.Registration
+        Path to the FLIRT matrix, or a registration which is 
+        returned as is. If None, the identity is returned.
+    src : str or pathlib.Path
+        Image in structural space.
+    ref : str or pathlib.Path
+        Image in the reference space.
+
+    Returns
+    -------
+    regtricks.Registration
+    """
+    if struct2ref is None:
+        return rt.Registration.identity()
+    if isinstance(struct2ref, rt.Registration):
+        return struct2ref
+    names = tuple(str(n) for n in (struct2ref, src, ref))
+    return _read_flirt(*names, tuple(os.stat(n).st_mtime_ns for n in names))
+
+def generate_tissue_masks_in_ref_space(aparc_aseg, 
+                                       ref_img,
+                                       tissues, 
+                                       struct2ref=None, 
+                                       superfactor=True, 
+                                       order=3, 
+                                       threshold=0.8,
+                                       erode=False,
+                                       cores=1):
+    """
+    Generate several tissue masks from FreeSurfer's aparc+aseg in 
+    the space of the given reference image.
+
+    The masks are generated together (see `generate_tissue_masks()`) 
+    and resampled as the channels of a single image with 
+    `hcpasl.resampling.apply_to_images()`, so the registration and 
+    the supersampled reference grid are computed once for all of 
+    them, and are also reused by later calls between the same spaces.
+
+    Parameters
+    ----------
+    aparc_aseg: Path to FS's T1-space aparc_aseg output.
+    ref_img: Path to the reference space image.
+    tissues: iterable of str, which tissue masks we would like, 
+             (wm, allwm, csf, allvent, gm).
+    struct2ref: Path to the registration from structural to 
+                the reference space, or a regtricks.Registration, 
+                default is None (assumes the reference image is 
+                already in the desired space).
+    order: Order of interpolation to be used when applying 
+           registration, default is 3.
+    threshold: Threshold to use to re-binarise the tissue 
+               segmentations after registration, default is 0.8.
+    erode: bool or iterable of bool, whether to erode the initial 
+           masks (in original structural space) or not, either for 
+           all tissues or for each one, default is False.
+    cores: Number of masks to resample at the same time, default 
+           is 1.
     
-    # create and return Nifti1Image
-    mask = nb.nifti1.Nifti1Image(mask, affine=aseg.affine)
-    return mask
+    Returns
+    -------
+    masks: list of Nifti1Image, in the order of `tissues`
+    """
+
+    # get T1 space tissue masks
+    masks = generate_tissue_masks(aparc_aseg, tissues, erode=erode)
+
+    # resample to reference image
+    reg = load_struct2ref(struct2ref, aparc_aseg, ref_img)
+    masks = apply_to_images(reg, masks, str(ref_img), order=order, 
+                            superfactor=superfactor, cores=cores)
+
+    # re-binarise
+    return [nb.Nifti1Image(np.where(m.get_fdata()>=threshold, 1., 0.),
+                           affine=m.affine)
+            for m in masks]
 
 def generate_tissue_mask_in_ref_space(aparc_aseg, 
                                       ref_img,
@@ -84,7 +285,9 @@ def generate_tissue_mask_in_ref_space(aparc_aseg,
                                       erode=False):
     """
     Generate a tissue mask from FreeSurfer's aparc+aseg in the 
-    space of the given reference image.
+    space of the given reference image. See 
+    `generate_tissue_masks_in_ref_space()` to generate several 
+    masks at once.
 
     Parameters
     ----------
@@ -107,25 +310,57 @@ def generate_tissue_mask_in_ref_space(aparc_aseg,
     -------
     mask: Nifti1Image
     """
+    return generate_tissue_masks_in_ref_space(
+        aparc_aseg, ref_img, [tissue], struct2ref=struct2ref, 
+        superfactor=superfactor, order=order, threshold=threshold, 
+        erode=erode
+    )[0]
 
-    # get T1 space tissue mask
-    mask = generate_tissue_mask(aparc_aseg, tissue, erode=erode)
+def generate_gm_masks_from_luts(wmparc, ribbon, corticallut, subcorticallut, 
+                                ref_img, struct2ref=None, cache_dir=None):
+    """
+    Generate cortical and subcortical grey matter masks in the space 
+    of the given reference image, as used by the SE-based bias 
+    estimation.
 
-    # resample to reference image
-    if struct2ref:
-        reg = rt.Registration.from_flirt(str(struct2ref),
-                                         src=str(aparc_aseg),
-                                         ref=str(ref_img))
-    else:
-        reg = rt.Registration.identity()
-    mask = reg.apply_to_image(
-        src=mask, ref=str(ref_img), 
-        superfactor=superfactor, order=order
-    )
+    Cortical grey matter is taken from the labels in `ribbon` listed 
+    in the cortical LUT; subcortical grey matter from the labels in 
+    `wmparc` listed in the subcortical LUT. Both segmentations are 
+    downsampled to the reference space by majority vote first (see 
+    `hcpasl.resampling.LabelResampler`), which is cached so repeated 
+    runs for the same subject reuse it.
 
-    # re-binarise
-    mask = nb.Nifti1Image(
-        np.where(mask.get_fdata()>=threshold, 1., 0.),
-        affine=mask.affine
-    )
-    return mask
+    Parameters
+    ----------
+    wmparc : str or pathlib.Path
+        FreeSurfer's wmparc in structural space.
+    ribbon : str or pathlib.Path
+        FreeSurfer's ribbon in structural space.
+    corticallut : str or pathlib.Path
+        FreeSurfer cortical label table.
+    subcorticallut : str or pathlib.Path
+        FreeSurfer subcortical label table.
+    ref_img : str or pathlib.Path or nibabel.Nifti1Image
+        Image in the space in which the masks are required.
+    struct2ref : regtricks.Registration, optional
+        Registration from structural space to the reference space. 
+        Default is None, in which case identity is used.
+    cache_dir : str or pathlib.Path, optional
+        Where to cache the downsampled segmentations. See 
+        `hcpasl.utils.get_cache_dir()`. If False, they will not be 
+        cached.
+
+    Returns
+    -------
+    cgm, scgm : np.array
+        Cortical and subcortical grey matter masks.
+    """
+    wmparc_ref, ribbon_ref = [
+        LabelResampler(name, ref_img, struct2ref, cache_dir=cache_dir).majority()
+        for name in (wmparc, ribbon)
+    ]
+    c_lut, sc_lut = [build_lookup(parse_LUT(lut)) 
+                     for lut in (corticallut, subcorticallut)]
+    cgm = apply_lookup(ribbon_ref, c_lut)
+    scgm = apply_lookup(wmparc_ref, sc_lut)
+    return cgm, scgm
@@ -8,6 +8,12 @@ import nibabel as nb
 import numpy as np
 
 import subprocess
+import hashlib
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 def create_dirs(dir_list, parents=True, exist_ok=True):
     """
@@ -166,3 +172,138 @@ def get_ventricular_csf_mask(fslanatdir, interpolation=3):
     vent_t1_img = applywarp(vent_img, str(t1_brain), LOAD, warp=mni2struct)['out']
     vent_t1_img = fslmaths(vent_t1_img).thr(0.9).bin().run(LOAD)
     return vent_t1_img
+
+def get_cache_dir(cache_dir=None):
+    """
+    Get (and create) the directory used to cache precomputed 
+    operators such as sparse resampling matrices.
+
+    Parameters
+    ----------
+    cache_dir : str or pathlib.Path, optional
+        Directory to use. If not provided, $HCPASL_CACHE_DIR is 
+        used if set, otherwise ~/.cache/hcpasl.
+
+    Returns
+    -------
+    pathlib.Path
+        The cache directory.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("HCPASL_CACHE_DIR", 
+                                   Path.home()/".cache"/"hcpasl")
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+def hash_arrays(*arrays):
+    """
+    Get a hex digest identifying the contents of some arrays 
+    (or other objects which can be converted to arrays), for 
+    use as a cache key.
+    """
+    h = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str((arr.dtype, arr.shape)).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+def save_cache(save, cache_name):
+    """
+    Write a cache file atomically, so that concurrent readers never 
+    see it partly written.
+
+    Parameters
+    ----------
+    save : callable
+        Called with the path of a temporary file in the same 
+        directory as `cache_name` (with the same suffix), to which 
+        it should write the cached data.
+    cache_name : pathlib.Path
+        Final location of the cache file, which the temporary file 
+        then replaces.
+    """
+    cache_name = Path(cache_name)
+    fd, temp_name = tempfile.mkstemp(dir=cache_name.parent, suffix=cache_name.suffix)
+    os.close(fd)
+    try:
+        save(temp_name)
+        os.replace(temp_name, cache_name)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+def load_cache(load, cache_name):
+    """
+    Load a cache file, treating a missing or unreadable (e.g. 
+    truncated) file as a cache miss.
+
+    Parameters
+    ----------
+    load : callable
+        Called with `cache_name`; it should read all of the data it 
+        needs before returning.
+    cache_name : pathlib.Path
+        Location of the cache file.
+
+    Returns
+    -------
+    The result of `load`, or None on a cache miss.
+    """
+    if not Path(cache_name).exists():
+        return None
+    try:
+        return load(cache_name)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return None
+
+class BackgroundWriter:
+    """
+    Save arrays as NIfTI images on a background thread.
+
+    Used for optional intermediate (debug) outputs so that writing 
+    and compressing them doesn't hold up the computation. Use as a 
+    context manager, or call `close()`, to wait for all pending 
+    writes to finish.
+
+    Parameters
+    ----------
+    outdir : pathlib.Path
+        Directory in which the images will be saved.
+    ref : nibabel.Nifti1Image
+        Image whose affine and header are used for the outputs.
+    """
+
+    def __init__(self, outdir, ref):
+        self.outdir = Path(outdir)
+        self.outdir.mkdir(parents=True, exist_ok=True)
+        self.affine, self.header = ref.affine, ref.header
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
+
+    def save(self, array, name):
+        """
+        Queue `array` to be saved as `outdir/<name>.nii.gz`.
+        """
+        img = nb.nifti1.Nifti1Image(np.array(array, dtype=np.float32), 
+                                    self.affine, self.header)
+        self._futures.append(
+            self._executor.submit(nb.save, img, self.outdir/f"{name}.nii.gz")
+        )
+
+    def close(self):
+        """
+        Wait for all queued images to be written, re-raising any 
+        error which occurred while writing.
+        """
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
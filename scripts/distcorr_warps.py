@@ -21,24 +21,7 @@ from hcpasl.distortion_correction import (
     generate_epidc_warp, register_fmap
 )
 from hcpasl.m0_mt_correction import generate_asl2struct
-
-def generate_asl_mask(struct_brain, asl, asl2struct):
-    """
-    Generate brain mask in ASL space 
-
-    Args: 
-        struct_brain: path to T1 brain-extracted, ac_dc_restore_brain
-        asl: path to ASL image 
-        asl2struct: regtricks.Registration for asl to structural 
-
-    Returns: 
-        np.array, logical mask. 
-    """
-
-    brain_mask = (nb.load(struct_brain).get_data() > 0).astype(np.float32)
-    asl_mask = asl2struct.inverse().apply_to_array(brain_mask, struct_brain, asl)
-    asl_mask = binary_fill_holes(asl_mask > 0.25)
-    return asl_mask
+from hcpasl.resampling import MaskProjector, apply_registration
 
 def binarise_image(image, threshold=0):
     """
@@ -234,9 +217,11 @@ def main():
     asl_dir = op.join(sub_base, args.outdir, "ASL", "TIs", "STCorr2") if not args.nobandingcorr else op.join(sub_base, args.outdir, "ASL", "TIs", "MoCo")
     asl_out_dir = op.join(t1_asl_dir, "TIs", "DistCorr")
     calib_out_dir = op.join(t1_asl_dir, "Calib", "Calib0", "DistCorr") if target=='structural' else op.join(sub_base, args.outdir, "ASL", "Calib", "Calib0", "DistCorr")
+    # precomputed resampling matrices are cached per subject
+    cache_dir = op.join(sub_base, args.outdir, "cache")
     [ os.makedirs(d, exist_ok=True) 
         for d in [pvs_dir, t1_asl_dir, distcorr_dir, reg_dir, 
-                  asl_out_dir, calib_out_dir] ]
+                  asl_out_dir, calib_out_dir, cache_dir] ]
         
     # Images required for processing 
     asl = op.join(asl_dir, "tis_stcorr.nii.gz")if not args.nobandingcorr else op.join(asl_dir, "reg_gdc_dc_tis_biascorr.nii.gz")
@@ -267,11 +252,8 @@ def main():
         asl_spc = rt.ImageSpace(asl)
         t1_spc = rt.ImageSpace(struct_brain)
         t1_asl_grid_spc = t1_spc.resize_voxels(asl_spc.vox_size / t1_spc.vox_size)
-        t1_mask = nb.load(struct_brain_mask).get_fdata()
-        t1_mask_asl_grid = rt.Registration.identity().apply_to_array(t1_mask, 
-                                                                     t1_spc, 
-                                                                     t1_asl_grid_spc, 
-                                                                     order=0)
+        t1_mask = nb.load(struct_brain_mask).get_fdata() > 0
+        t1_mask_asl_grid = MaskProjector(t1_spc, t1_asl_grid_spc).coverage(t1_mask)
         # Re-binarise downsampled mask and save
         t1_asl_grid_mask_array = binary_fill_holes(t1_mask_asl_grid>0.25).astype(np.float32)
         t1_asl_grid_spc.save_image(t1_asl_grid_mask_array, t1_asl_grid_mask) 
@@ -337,12 +319,11 @@ def main():
     # Get brain mask in asl space for use with oxford_asl later
     mask_name = op.join(reg_dir, "asl_vol1_mask_init.nii.gz")
     if (not op.exists(mask_name) or force_refresh) and target=="asl":
-        asl_mask = asl2struct_reg.inverse().apply_to_image(struct_brain_mask,
-                                                               unreg_img, 
-                                                               order=0)
-        asl_mask = nb.nifti1.Nifti1Image(np.where(asl_mask.get_fdata()>0.25, 1., 0.),
-                                         affine=asl_mask.affine)
-        nb.save(asl_mask, mask_name)
+        projector = MaskProjector(struct_brain_mask, unreg_img, 
+                                  asl2struct_reg.inverse())
+        asl_mask = projector.coverage(nb.load(struct_brain_mask).get_fdata() > 0)
+        rt.ImageSpace(unreg_img).save_image(np.where(asl_mask>0.25, 1., 0.), 
+                                            mask_name)
 
     # Final ASL transforms: moco, grad dc, 
     # epi dc (incorporating asl->struct reg)
@@ -384,9 +365,11 @@ def main():
     if (not op.exists(reg_est_t1_name) or force_refresh) and target=='structural' and use_t1:
         est_t1_name = op.join(sub_base, args.outdir, "ASL", "TIs", "SatRecov2", 
                                 "spatial", "mean_T1t_filt.nii.gz")
-        reg_est_t1 = asl2struct_reg.apply_to_image(src=est_t1_name,
-                                                   ref=reference,
-                                                   order=args.interpolation)
+        reg_est_t1 = apply_registration(asl2struct_reg, 
+                                        src=est_t1_name,
+                                        ref=reference,
+                                        order=args.interpolation,
+                                        cache_dir=cache_dir)
         nb.save(reg_est_t1, reg_est_t1_name)
 
     # create ti image in asl space
@@ -400,9 +383,11 @@ def main():
     # transform ti image into t1 space
     ti_t1 = op.join(t1_asl_dir, "timing_img.nii.gz")
     if (not op.exists(ti_t1) or force_refresh) and target=='structural':
-        ti_t1_img = asl2struct_reg.apply_to_image(src=ti_asl,
-                                                  ref=reference,
-                                                  order=0)
+        ti_t1_img = apply_registration(asl2struct_reg,
+                                       src=ti_asl,
+                                       ref=reference,
+                                       order=0,
+                                       cache_dir=cache_dir)
         nb.save(ti_t1_img, ti_t1)
 
     # register scaling factors to ASL-gridded T1 space
@@ -416,9 +401,11 @@ def main():
             mt_img = nb.nifti1.Nifti1Image(np.tile(mt_sfs, (86, 86, 1)),
                                         affine=calib_img.affine)
             calib2struct = rt.chain(calib2asl0, asl2struct_reg)
-            mt_calibstruct_img = calib2struct.apply_to_image(src=mt_img,
-                                                            ref=reference,
-                                                            order=args.interpolation)
+            mt_calibstruct_img = apply_registration(calib2struct,
+                                                    src=mt_img,
+                                                    ref=reference,
+                                                    order=args.interpolation,
+                                                    cache_dir=cache_dir)
             nb.save(mt_calibstruct_img, mt_sfs_calib_name)
 
     # Final scaling factors transforms: moco, grad dc, 
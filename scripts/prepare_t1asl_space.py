@@ -39,7 +39,7 @@ def generate_ventricle_mask(aparc_aseg, t1_asl):
     return output 
 
 
-def estimate_pvs(t1_dir, t1_asl, cores=mp.cpu_count()):
+def estimate_pvs(t1_dir, t1_asl, cores=mp.cpu_count(), cache_dir=None):
     """
     Generate partial volume estimates from freesurfer segmentations of the cortex
     and subcortical structures.
@@ -51,6 +51,8 @@ def estimate_pvs(t1_dir, t1_asl, cores=mp.cpu_count()):
         fileroot: path basename for output, will add suffix GM/WM/CSF
         cores: integer number of cores to use, default is the number of 
             cores on your machine
+        cache_dir: where to cache the cortical PV estimates, see 
+            hcpasl.utils.get_cache_dir()
     """    
 
     # Load the t1 image, aparc+aseg and surfaces from their expected 
@@ -69,7 +71,7 @@ def estimate_pvs(t1_dir, t1_asl, cores=mp.cpu_count()):
 
     # Generate a single 4D volume of PV estimates, stacked GM/WM/CSF
     pvs_stacked = extract_fs_pvs(aparc_aseg, surf_dict, t1_asl, 
-        superfactor=2, cores=cores)
+        superfactor=2, cores=cores, cache_dir=cache_dir)
 
     return pvs_stacked
 
@@ -141,7 +143,8 @@ def main():
     pv_gm = op.join(sub_base, args.outdir, "T1w", "ASL", "PVEs", "pve_GM.nii.gz")
     if not op.exists(pv_gm) or force_refresh:
         aparc_seg = op.join(t1_dir, "aparc+aseg.nii.gz")
-        pvs_stacked = estimate_pvs(t1_dir, t1_asl_grid)
+        pvs_stacked = estimate_pvs(t1_dir, t1_asl_grid, cache_dir=op.join(
+            sub_base, args.outdir, "cache"))
 
         # Save output with tissue suffix 
         fileroot = op.join(sub_base, args.outdir, "ASLT1w", "PVEs", "pve")
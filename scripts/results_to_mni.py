@@ -1,36 +1,82 @@
 """
 Prepare ASL-gridded MNI-space (if needed)
-Warp ASL-gridded T1w-space ASL variable to ASL-gridded MNI-space
+Warp ASL-gridded T1w-space ASL variables to ASL-gridded MNI-space
+
+The original single-variable form, with six positional arguments
+    results_to_mni warp input t1 mni asl_grid_mni output
+is still accepted and is equivalent to
+    results_to_mni warp t1 mni asl_grid_mni -i input -o output
 """
 
-import regtricks as rt
-import os.path as op
-import nibabel as nb
+from hcpasl.cifti_processing import results_to_mni
+import argparse
 import sys
+from multiprocessing import cpu_count
+
+def _legacy_args(argv):
+    """
+    Translate the original six positional arguments, with the input 
+    second and the output last, into the -i/-o form.
+    """
+    if len(argv) == 6 and not any(arg.startswith("-") for arg in argv):
+        warp, asl, t1, mni, asl_grid_mni, out = argv
+        return [warp, t1, mni, asl_grid_mni, "-i", asl, "-o", out]
+    return argv
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Warp ASL-gridded T1w-space ASL variables to "
+                    + "ASL-gridded MNI-space. The warp is loaded once and "
+                    + "all of the variables are resampled together."
+    )
+    parser.add_argument(
+        "warp",
+        help="{StudyDir}/{SubjectID}/MNINonLinear/xfms/acpc_dc2standard.nii.gz"
+    )
+    parser.add_argument(
+        "t1",
+        help="{StudyDir}/{SubjectID}/T1w/T1w_acpc_dc_restore.nii.gz"
+    )
+    parser.add_argument(
+        "mni",
+        help="MNI template, e.g. $FSLDIR/data/standard/MNI152_T1_2mm.nii.gz"
+    )
+    parser.add_argument(
+        "asl_grid_mni",
+        help="ASL-grid MNI-space image, which is created if it doesn't "
+            + "exist, e.g. {StudyDir}/{SubjectID}/MNINonLinear/ASL/Results/"
+            + "OutputtoCIFTI/asl_grid_mni.nii.gz"
+    )
+    parser.add_argument(
+        "-i",
+        "--inputs",
+        help="T1w-space ASL variables, e.g. {StudyDir}/{SubjectID}/T1w/ASL/"
+            + "TIs/OxfordASL/native_space/perfusion_calib.nii.gz",
+        nargs="+",
+        required=True
+    )
+    parser.add_argument(
+        "-o",
+        "--outputs",
+        help="Output MNI-space ASL variables, one per input.",
+        nargs="+",
+        required=True
+    )
+    parser.add_argument(
+        "--cores",
+        help="Number of cores to use. Default is the number of cores "
+            + "on the machine.",
+        type=int,
+        default=cpu_count()
+    )
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(_legacy_args(list(argv)))
+    if len(args.inputs) != len(args.outputs):
+        parser.error("There must be one output per input.")
 
-def main():
-    path_warp = sys.argv[1] # {StudyDir}/{SubjectID}/MNINonLinear/xfms/acpc_dc2standard.nii.gz
-    path_to_T1_space_ASL_variable = sys.argv[2] # {StudyDir}/{SubjectID}/T1w/ASL/TIs/OxfordASL/native_space/perfusion_calib.nii.gz
-    path_T1 = sys.argv[3] # {StudyDir}/{SubjectID}/T1w/T1w_acpc_dc_restore.nii.gz
-    path_MNI = sys.argv[4] # /usr/local/fsl/data/standard/MNI152_T1_2mm.nii.gz
-    path_to_lowres_MNI = sys.argv[5] # {StudyDir}/{SubjectID}/MNINonLinear/ASL/OutputtoCIFTI/asl_grid_mni.nii.gz
-    path_to_MNI_space_ASL_variable = sys.argv[6] # {StudyDir}/{SubjectID}/MNINonLinear/ASL/Results/OutputtoCIFTI/perfusion_calib_MNI
-    
-    # Make the ASL-grid MNI space target image for registration (if needed)
-    if not op.isfile(path_to_lowres_MNI):
-        print("Creating ASL-grid MNI-space MNI image")
-        perfusion_spc = rt.ImageSpace(path_to_T1_space_ASL_variable)
-        mni_spc = rt.ImageSpace(path_MNI)
-        mni_asl_grid = mni_spc.resize_voxels(perfusion_spc.vox_size / mni_spc.vox_size)
-        nb.save(rt.Registration.identity().apply_to_image(path_MNI, mni_asl_grid), path_to_lowres_MNI)
-    else:
-        print("ASL-grid MNI-space MNI image already exists")
-    
-    # Warp ASL variable to newly prepared ASL-gridded MNI-space
-    print("Transforming ASL Variable to ASL-gridded MNI-space ASL")
-    the_warp = rt.NonLinearRegistration.from_fnirt(path_warp, path_T1, path_MNI)
-    asl_mni_mniaslgrid = the_warp.apply_to_image(path_to_T1_space_ASL_variable, path_to_lowres_MNI)
-    nb.save(asl_mni_mniaslgrid, path_to_MNI_space_ASL_variable)
+    print("Transforming ASL Variables to ASL-gridded MNI-space ASL")
+    results_to_mni(args.warp, args.inputs, args.t1, args.mni,
+                   args.asl_grid_mni, args.outputs, cores=args.cores)
 
 if __name__ == "__main__":
     main()
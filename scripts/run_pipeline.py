@@ -16,7 +16,9 @@ from hcpasl.distortion_correction import gradunwarp_and_topup
 from hcpasl.m0_mt_correction import correct_M0
 from hcpasl.asl_correction import hcp_asl_moco
 from hcpasl.asl_differencing import tag_control_differencing
-from hcpasl.asl_perfusion import run_fabber_asl, run_oxford_asl
+from hcpasl.asl_perfusion import run_fabber_asl, run_oxford_asl, run_quick_perfusion
+from hcpasl.bias_estimation import sebased_bias_correct
+from hcpasl.cifti_processing import perfusion_cifti_processing
 # from hcpasl.projection import project_to_surface
 from pathlib import Path
 import subprocess
@@ -27,7 +29,8 @@ import nibabel as nb
 def process_subject(studydir, subid, mt_factors, mbpcasl, structural, surfaces, 
                     fmaps, gradients, wmparc, ribbon, wbdevdir, use_t1=False, 
                     pvcorr=False, cores=cpu_count(), interpolation=3,
-                    nobandingcorr=False, outdir="hcp_asl"):
+                    nobandingcorr=False, outdir="hcp_asl", chain_calib1=False,
+                    debug=False, quick_perfusion=False):
     """
     Run the hcp-asl pipeline for a given subject.
 
@@ -86,6 +89,18 @@ def process_subject(studydir, subid, mt_factors, mbpcasl, structural, surfaces,
         banding corrections are applied by default).
     outdir : str, optional
         Name of the main results directory. Default is 'hcp_asl'.
+    chain_calib1 : bool, optional
+        If this is True, calib1's registration to the structural 
+        image is obtained from a rigid registration to calib0 rather 
+        than a second run of bbregister. Default is False.
+    debug : bool, optional
+        If True, the intermediate images from the SE-based bias 
+        estimation are saved. Default is False.
+    quick_perfusion : bool, optional
+        If True, perfusion and arrival are estimated with the fast 
+        lookup-table fit in `run_quick_perfusion()` rather than 
+        oxford_asl, for QC. `pvcorr` is then ignored, as the quick 
+        fit has no partial volume correction. Default is False.
     """
     subject_dir = (studydir / subid).resolve(strict=True)
     names = initial_processing(subject_dir, 
@@ -106,7 +121,8 @@ def process_subject(studydir, subid, mt_factors, mbpcasl, structural, surfaces,
     hcppipedir = Path(os.environ["HCPPIPEDIR"])
     corticallut = hcppipedir/'global/config/FreeSurferCorticalLabelTableLut.txt'
     subcorticallut = hcppipedir/'global/config/FreeSurferSubcorticalLabelTableLut.txt'
-    correct_M0(subject_dir, mt_factors, wmparc, ribbon, corticallut, subcorticallut, interpolation, nobandingcorr, outdir=outdir)
+    correct_M0(subject_dir, mt_factors, wmparc, ribbon, corticallut, subcorticallut, interpolation, nobandingcorr, outdir=outdir,
+               chain_calib1=chain_calib1, debug=debug, cores=cores)
     
     # correct ASL series for motion and banding
     print("Estimating ASL motion.")
@@ -151,20 +167,18 @@ def process_subject(studydir, subid, mt_factors, mbpcasl, structural, surfaces,
             hcppipedir = Path(os.environ["HCPPIPEDIR"])
             corticallut = hcppipedir/'global/config/FreeSurferCorticalLabelTableLut.txt'
             subcorticallut = hcppipedir/'global/config/FreeSurferSubcorticalLabelTableLut.txt'
-            sebased_cmd = [
-                'get_sebased_bias',
-                '-i', calib_name,
-                '--asl', asl_name,
-                '-f', fmapmag_name,
-                '-m', mask_name,
-                '--wmparc', wmparc,
-                '--ribbon', ribbon,
-                '--corticallut', corticallut,
-                '--subcorticallut', subcorticallut,
-                '-o', out_dir,
-                '--debug'
-            ]
-            subprocess.run(sebased_cmd, check=True)
+            sebased_bias_correct(calib_name=calib_name,
+                                 fmapmag_name=fmapmag_name,
+                                 mask_name=mask_name,
+                                 outdir=out_dir,
+                                 asl_name=asl_name,
+                                 wmparc=wmparc,
+                                 ribbon=ribbon,
+                                 corticallut=corticallut,
+                                 subcorticallut=subcorticallut,
+                                 debug=debug,
+                                 cores=cores,
+                                 cache_dir=subject_dir/outdir/'cache')
             # reapply banding corrections now that the series has been bias corrected
             series = nb.load(subject_dir/outdir/'ASLT1w/TIs/BiasCorr/tis_secorr.nii.gz')
             scaling_factors = nb.load(subject_dir/outdir/'ASLT1w/TIs/DistCorr/combined_scaling_factors.nii.gz')
@@ -188,14 +202,24 @@ def process_subject(studydir, subid, mt_factors, mbpcasl, structural, surfaces,
         tag_control_differencing(series, subject_dir, target=target, nobandingcorr=nobandingcorr, outdir=outdir)
         
         # estimate perfusion
-        run_oxford_asl(subject_dir, target=target, use_t1=use_t1, pvcorr=pvcorr, outdir=outdir)
+        if quick_perfusion:
+            run_quick_perfusion(subject_dir, target=target, outdir=outdir)
+        else:
+            # the structural distcorr registers the ASL-space perfusion 
+            # image, so each run has to finish before moving on; a failed 
+            # run raises a CalledProcessError
+            oxford_run = run_oxford_asl(subject_dir, target=target, use_t1=use_t1, pvcorr=pvcorr, outdir=outdir)
+            oxford_run.wait(check=True)
 
-        # project perfusion results
+        # project perfusion results; the quick fit has no partial volume 
+        # corrected results, so only the uncorrected ones are projected
         if target == 'structural':
-            project_to_surface(studydir, subid, outdir=outdir, wbdevdir=wbdevdir)
+            project_to_surface(studydir, subid, outdir=outdir, wbdevdir=wbdevdir, 
+                               pvcorr=pvcorr and not quick_perfusion, cores=cores)
 
 def project_to_surface(studydir, subid, outdir, wbdevdir, lowresmesh="32", FinalASLRes="2.5", 
-                       SmoothingFWHM="2", GreyOrdsRes="2", RegName="MSMSulc"):
+                       SmoothingFWHM="2", GreyOrdsRes="2", RegName="MSMSulc", 
+                       pvcorr=False, cores=cpu_count()):
     """
     Project perfusion results to the cortical surface and generate
     CIFTI representation which includes both low res mesh surfaces
@@ -208,23 +232,16 @@ def project_to_surface(studydir, subid, outdir, wbdevdir, lowresmesh="32", Final
         Path to the study's base directory.
     subid : str
         Subject id for the subject of interest.
+    pvcorr : bool, optional
+        Whether oxford_asl was run with partial volume correction, 
+        in which case the partial volume corrected results are 
+        projected too. Default is False.
     """
-    # Projection scripts path:
-    script         = "PerfusionCIFTIProcessingPipeline.sh"
-    wb_path        = str(Path(wbdevdir).resolve(strict=True))
-
-    ASLVariable    = ["perfusion_calib", "arrival"]
-    ASLVariableVar = ["perfusion_var_calib", "arrival_var"]
-
-    for idx in range(2):
-        non_pvcorr_cmd = [script, studydir, subid, ASLVariable[idx], ASLVariableVar[idx], lowresmesh,
-                FinalASLRes, SmoothingFWHM, GreyOrdsRes, RegName, wb_path, "false", outdir]
-
-        pvcorr_cmd = [script, studydir, subid, ASLVariable[idx], ASLVariableVar[idx], lowresmesh,
-                FinalASLRes, SmoothingFWHM, GreyOrdsRes, RegName, wb_path, "true", outdir]
-        
-        subprocess.run(non_pvcorr_cmd)
-        subprocess.run(pvcorr_cmd)
+    perfusion_cifti_processing(studydir, subid, outdir, wbdevdir, 
+                               pvcorr=(False, True) if pvcorr else (False,),
+                               lowresmesh=lowresmesh, FinalASLRes=FinalASLRes, 
+                               SmoothingFWHM=SmoothingFWHM, GreyOrdsRes=GreyOrdsRes, 
+                               RegName=RegName, cores=cores)
 
 def main():
     """
@@ -380,6 +397,26 @@ def main():
             +"our banding corrections make.",
         action="store_true"
     )
+    parser.add_argument(
+        "--chain_calib1",
+        help="If this option is provided, calib1 will be registered to the "
+            +"structural image via a fast rigid registration to calib0 "
+            +"rather than a second run of bbregister.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--debug",
+        help="If this option is provided, the intermediate images from the "
+            +"SE-based bias estimation will be saved.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--quick_perfusion",
+        help="If this option is provided, perfusion will be estimated with "
+            +"a fast lookup-table fit of the Buxton model rather than "
+            +"oxford_asl. This is intended for quick QC of many sessions.",
+        action="store_true"
+    )
     parser.add_argument(
         "--fabberdir",
         help="User Fabber executable in <fabberdir>/bin/ for users"
@@ -465,7 +502,10 @@ def main():
                     ribbon=args.ribbon,
                     nobandingcorr=args.nobandingcorr,
                     outdir=args.outdir,
-                    wbdevdir=args.wbdevdir
+                    wbdevdir=args.wbdevdir,
+                    chain_calib1=args.chain_calib1,
+                    debug=args.debug,
+                    quick_perfusion=args.quick_perfusion
                     )
 
 if __name__ == '__main__':
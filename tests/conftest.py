@@ -0,0 +1,40 @@
+"""
+Fixtures shared between the tests.
+"""
+
+import numpy as np
+import pytest
+
+def _icosphere(subdivisions):
+    t = (1 + 5**0.5) / 2
+    coords = [(-1, t, 0), (1, t, 0), (-1, -t, 0), (1, -t, 0),
+              (0, -1, t), (0, 1, t), (0, -1, -t), (0, 1, -t),
+              (t, 0, -1), (t, 0, 1), (-t, 0, -1), (-t, 0, 1)]
+    triangles = [(0, 11, 5), (0, 5, 1), (0, 1, 7), (0, 7, 10), (0, 10, 11),
+                 (1, 5, 9), (5, 11, 4), (11, 10, 2), (10, 7, 6), (7, 1, 8),
+                 (3, 9, 4), (3, 4, 2), (3, 2, 6), (3, 6, 8), (3, 8, 9),
+                 (4, 9, 5), (2, 4, 11), (6, 2, 10), (8, 6, 7), (9, 8, 1)]
+    coords = [np.array(c, dtype=float) for c in coords]
+    for _ in range(subdivisions):
+        midpoints, new_triangles = {}, []
+        def midpoint(a, b):
+            key = (min(a, b), max(a, b))
+            if key not in midpoints:
+                midpoints[key] = len(coords)
+                coords.append((coords[a] + coords[b]) / 2)
+            return midpoints[key]
+        for a, b, c in triangles:
+            ab, bc, ca = midpoint(a, b), midpoint(b, c), midpoint(c, a)
+            new_triangles += [(a, ab, ca), (b, bc, ab), (c, ca, bc), (ab, bc, ca)]
+        triangles = new_triangles
+    coords = np.array(coords)
+    return coords / np.linalg.norm(coords, axis=1, keepdims=True), np.array(triangles)
+
+@pytest.fixture(scope="session")
+def icosphere():
+    """
+    Unit sphere meshes made by subdividing an icosahedron: call with 
+    the number of subdivisions to get the vertex coordinates and 
+    triangles.
+    """
+    return _icosphere
@@ -0,0 +1,23 @@
+"""
+Tests of the GLM tag-control differencing.
+"""
+
+import numpy as np
+
+from hcpasl.asl_differencing import difference_pairs, signal_mask
+
+def test_masked_differencing_matches_all_voxels():
+    rng = np.random.default_rng(0)
+    series = rng.random((6, 5, 4, 20)).astype(np.float32)
+    scaling = 1 + rng.random(series.shape).astype(np.float32)
+    # signal only after the first pair, as at the edge of the FoV
+    # after motion correction, and no signal at all
+    series[0, 0, 0, :2] = 0
+    series[1, 1, 1] = 0
+
+    mask = signal_mask(series, chunk_volumes=3)
+    assert mask[0, 0, 0] and not mask[1, 1, 1]
+    masked = difference_pairs(series, scaling, mask=mask, return_variance=True)
+    full = difference_pairs(series, scaling, return_variance=True)
+    for result, expected in zip(masked, full):
+        np.testing.assert_array_equal(result, expected)
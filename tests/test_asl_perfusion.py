@@ -0,0 +1,152 @@
+"""
+Tests of the perfusion estimation: the quick Buxton fit, and the 
+chunked fabber runs with a fake Fabber standing in for pyfab.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import nibabel as nb
+import pytest
+
+from hcpasl import asl_perfusion
+from hcpasl.asl_perfusion import (REPEATS, buxton_pcasl, fit_buxton_lut,
+                                  run_fabber_asl, run_quick_perfusion)
+
+TIS = np.array([1.7, 2.2, 2.7, 3.2, 3.7])
+
+def _signal(perfusion, arrival, ti):
+    # voxelwise TIs, each repeated as in the series
+    return perfusion[:, None] * buxton_pcasl(np.repeat(ti, REPEATS, axis=1),
+                                             arrival[:, None])
+
+@pytest.mark.filterwarnings("error")
+def test_fit_buxton_lut_recovers_parameters():
+    rng = np.random.default_rng(0)
+    n_vox = 200
+    # two slice timings, arrival times on the search grid and some
+    # voxels without signal, as outside the brain
+    ti = TIS + np.where(rng.random(n_vox) < 0.5, 0., 0.05)[:, None]
+    perfusion = rng.uniform(20, 80, n_vox)
+    arrival = rng.integers(50, 200, n_vox) / 100
+    perfusion[:10] = 0
+    data = _signal(perfusion, arrival, ti)
+
+    fitted, att, fitted_var, att_var = fit_buxton_lut(data, ti, chunk_size=64)
+    np.testing.assert_allclose(fitted, perfusion, atol=1e-6)
+    np.testing.assert_allclose(att[10:], arrival[10:])
+    assert np.all(np.isfinite(fitted_var)) and np.all(np.isfinite(att_var))
+
+    noisy = data + rng.normal(0, 1, data.shape)
+    fitted, att, fitted_var, att_var = fit_buxton_lut(noisy, ti)
+    assert np.median(np.abs(fitted[10:] - perfusion[10:])) < 2
+    assert np.median(np.abs(att[10:] - arrival[10:])) < 0.1
+    assert np.all(fitted_var > 0) and np.all(att_var > 0)
+
+def test_run_quick_perfusion_saves_calibrated_results(tmp_path):
+    rng = np.random.default_rng(0)
+    shape = (4, 3, 2)
+    subject_dir, outdir = tmp_path/"subject", "hcp_asl"
+    structasl_dir = subject_dir/outdir/"ASLT1w"
+    for sub_dir in ("ASL", "ASLT1w/reg", "ASLT1w/Calib/Calib0/DistCorr"):
+        (subject_dir/outdir/sub_dir).mkdir(parents=True)
+    affine = np.diag([2., 2., 2., 1.])
+    def save(data, name):
+        nb.save(nb.Nifti1Image(np.asarray(data, np.float32), affine),
+                str(structasl_dir/name))
+        return str(structasl_dir/name)
+
+    mask = np.ones(shape, dtype=bool)
+    mask[0] = False
+    perfusion = rng.uniform(20, 80, shape)
+    arrival = rng.integers(50, 200, shape) / 100
+    ti = np.broadcast_to(TIS, (*shape, len(TIS)))
+    beta_perf = _signal(perfusion.ravel(), arrival.ravel(),
+                        ti.reshape(-1, len(TIS))).reshape(*shape, -1)
+    m0 = rng.uniform(500, 1000, shape)
+    json_name = subject_dir/outdir/"ASL/ASL.json"
+    json_dict = {"json_name": str(json_name), "structasl": str(structasl_dir),
+                 "beta_perf": save(beta_perf, "beta_perf.nii.gz")}
+    json_name.write_text(json.dumps(json_dict))
+    save(mask, "reg/ASL_grid_T1w_acpc_dc_restore_brain_mask.nii.gz")
+    save(ti, "timing_img.nii.gz")
+    save(m0, "Calib/Calib0/DistCorr/calib0_dcorr.nii.gz")
+
+    run_quick_perfusion(subject_dir, target='structural', outdir=outdir)
+
+    native_dir = structasl_dir/"TIs/OxfordASL/native_space"
+    def load(name):
+        return nb.load(str(native_dir/f"{name}.nii.gz")).get_fdata()
+    np.testing.assert_allclose(load("perfusion")[mask], perfusion[mask], rtol=1e-5)
+    np.testing.assert_allclose(load("arrival")[mask], arrival[mask], rtol=1e-5)
+    calib = perfusion[mask] * 6000 * 0.9 / (0.85 * m0[mask])
+    np.testing.assert_allclose(load("perfusion_calib")[mask], calib, rtol=1e-5)
+    for name in ("perfusion", "arrival", "perfusion_var", "arrival_var",
+                 "perfusion_calib", "perfusion_var_calib"):
+        assert not load(name)[~mask].any()
+    updated = json.loads(json_name.read_text())
+    assert updated["oxford_asl"] == str(structasl_dir/"TIs/OxfordASL")
+
+class FakeFabber:
+    """
+    Voxelwise stand-in for pyfab's Fabber, whose outputs depend on the 
+    data, TIs, options and MVN it is continued from, and are zero 
+    outside the mask.
+    """
+    calls = []
+
+    def run(self, options):
+        self.calls.append(options)
+        mask = options["mask"] > 0
+        ftiss = options["data"].mean(-1) + options["tiimg"].mean(-1) - 5
+        if "inferart" in options:
+            ftiss = ftiss + 1
+        if "continue-from-mvn" in options:
+            ftiss = ftiss + 0.5 * options["continue-from-mvn"][..., 0]
+        mvn = np.stack([ftiss, options["data"][..., 0]], -1)
+        data = {"mean_ftiss": np.where(mask, ftiss, 0),
+                "mean_delttiss": np.where(mask, options["data"].std(-1), 0),
+                "finalMVN": np.where(mask[..., None], mvn, 0)}
+        return SimpleNamespace(data=data, log="fake fabber")
+
+def test_chunked_fabber_matches_serial(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    shape = (6, 4, 3)
+    structasl_dir = tmp_path/"ASLT1w"
+    for sub_dir in ("ASL", "ASLT1w/reg", "ASLT1w/TIs/Betas"):
+        (tmp_path/sub_dir).mkdir(parents=True)
+    json_name = tmp_path/"ASL/ASL.json"
+    json_name.write_text(json.dumps({"json_name": str(json_name),
+                                     "structasl": str(structasl_dir)}))
+    for name, data in (
+        ("reg/ASL_grid_T1w_acpc_dc_restore_brain_mask.nii.gz", rng.random(shape) < 0.6),
+        ("timing_img.nii.gz", TIS + rng.random((*shape, 1))),
+        ("TIs/Betas/beta_perf.nii.gz", rng.normal(5, 3, (*shape, sum(REPEATS)))),
+    ):
+        nb.save(nb.Nifti1Image(data.astype(np.float32), np.eye(4)),
+                str(structasl_dir/name))
+    monkeypatch.setattr(asl_perfusion, "Fabber", FakeFabber)
+    # threads rather than processes, so that the workers see the fake
+    monkeypatch.setattr(asl_perfusion, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(FakeFabber, "calls", [])
+
+    out_dir = structasl_dir/"TIs/Betas/fabber_3"
+    outputs = {}
+    for cores in (1, 3):
+        run_fabber_asl(tmp_path, cores=cores)
+        outputs[cores] = {name.name: nb.load(str(name)).get_fdata()
+                          for name in sorted(out_dir.glob("*.nii.gz"))}
+    assert sorted(outputs[1]) == ["finalMVN.nii.gz", "mean_delttiss.nii.gz",
+                                  "mean_ftiss.nii.gz"]
+    # negative perfusion is thresholded after the chunks are merged
+    assert outputs[1]["mean_ftiss.nii.gz"].min() == 0
+    for name, expected in outputs[1].items():
+        np.testing.assert_allclose(outputs[3][name], expected, rtol=1e-6)
+    # four iterations serially, then four for each of three chunks 
+    # with only their slab of the images
+    chunk_calls = FakeFabber.calls[4:]
+    assert len(chunk_calls) == 12
+    assert all(call["data"].shape[0] < shape[0] for call in chunk_calls)
+    assert json.loads(json_name.read_text())["oxford_asl"] == str(out_dir)
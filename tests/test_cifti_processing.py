@@ -0,0 +1,171 @@
+"""
+Tests of the CIFTI processing stage on a tiny synthetic subject, with
+the wb_command chains recorded rather than run: each command only
+writes the outputs that the in-process steps go on to read.
+"""
+
+import numpy as np
+import nibabel as nb
+from nibabel import cifti2
+import pytest
+
+from hcpasl import cifti_processing
+from scripts import results_to_mni
+from scripts.run_pipeline import project_to_surface
+
+SUBID = "HCA0000000"
+SUBJECT = f"{SUBID}_V1_MR"
+OUTDIR = "hcp_asl"
+VARIABLES = ("perfusion_calib", "perfusion_var_calib", "arrival", "arrival_var")
+
+def _plane(n=5):
+    # flat n x n grid of vertices, two triangles per square
+    ij = np.stack(np.meshgrid(np.arange(n), np.arange(n), indexing='ij'), -1)
+    coords = np.concatenate([ij.reshape(-1, 2), np.zeros((n * n, 1))], 1)
+    idx = np.arange(n * n).reshape(n, n)
+    a, b, c, d = idx[:-1, :-1], idx[1:, :-1], idx[:-1, 1:], idx[1:, 1:]
+    triangles = np.concatenate([np.stack([a, b, c], -1).reshape(-1, 3),
+                                np.stack([b, d, c], -1).reshape(-1, 3)])
+    return coords.astype(np.float32), triangles.astype(np.int32)
+
+def _save_gifti(arrays, name, intents=("NIFTI_INTENT_NONE",)):
+    gii = nb.gifti.GiftiImage()
+    for array, intent in zip(arrays, intents):
+        gii.add_gifti_data_array(nb.gifti.GiftiDataArray(array, intent=intent))
+    nb.save(gii, str(name))
+
+def _subcortical_models():
+    mask = np.zeros((4, 4, 4), dtype=bool)
+    mask[1:3, 1:3, 1:3] = True
+    return cifti2.BrainModelAxis.from_mask(mask, name="ThalamusLeft",
+                                           affine=np.eye(4))
+
+def _save_dscalar(models, name):
+    header = cifti2.Cifti2Header.from_axes((cifti2.ScalarAxis(["x"]), models))
+    nb.save(cifti2.Cifti2Image(np.ones((1, len(models)), np.float32), header),
+            str(name))
+
+@pytest.fixture
+def subject(tmp_path, monkeypatch):
+    """
+    A study directory with the structural files read in-process and
+    only the non-partial volume corrected oxford_asl results.
+    """
+    studydir = tmp_path/"study"
+    struct_dir = studydir/SUBID/f"{SUBJECT}/resources/Structural_preproc/files/{SUBJECT}"
+    downsample_dir = struct_dir/"MNINonLinear/fsaverage_LR32k"
+    downsample_dir.mkdir(parents=True)
+    coords, triangles = _plane()
+    for side in ("L", "R"):
+        _save_gifti([coords, triangles],
+                    downsample_dir/f"{SUBJECT}.{side}.midthickness.32k_fs_LR.surf.gii",
+                    intents=("NIFTI_INTENT_POINTSET", "NIFTI_INTENT_TRIANGLE"))
+        _save_gifti([np.ones(len(coords), np.float32)],
+                    downsample_dir/f"{SUBJECT}.{side}.atlasroi.32k_fs_LR.shape.gii")
+
+    results_dir = studydir/SUBID/OUTDIR/"ASLT1w/TIs/OxfordASL/native_space"
+    results_dir.mkdir(parents=True)
+    for variable in VARIABLES:
+        nb.save(nb.Nifti1Image(np.ones((4, 4, 4), np.float32), np.eye(4)),
+                str(results_dir/f"{variable}.nii.gz"))
+    # present so that it isn't created from the MNI template
+    atlas_results_dir = studydir/SUBID/OUTDIR/"ASLMNI/Results/OutputtoCIFTI"
+    atlas_results_dir.mkdir(parents=True)
+    (atlas_results_dir/"asl_grid_mni.nii.gz").touch()
+
+    wbdevdir = tmp_path/"workbench"
+    wbdevdir.mkdir()
+    monkeypatch.setenv("FSLDIR", str(tmp_path/"fsl"))
+    monkeypatch.setenv("HCPASL_CACHE_DIR", str(tmp_path/"cache"))
+
+    commands, mni_inputs = [], []
+    n_vertices = len(coords)
+    def fake_chain(cmds, env):
+        for cmd in cmds:
+            cmd = [str(c) for c in cmd]
+            commands.append(cmd)
+            if cmd[1] == "-cifti-create-label":
+                _save_dscalar(_subcortical_models(), cmd[2])
+            elif cmd[1] == "-metric-mask":
+                _save_gifti([np.ones(n_vertices, np.float32)], cmd[-1])
+            elif cmd[1] == "-metric-smoothing":
+                _save_gifti([np.ones(n_vertices, np.float32)], cmd[5])
+            elif cmd[1] == "-cifti-resample":
+                _save_dscalar(_subcortical_models(), cmd[8])
+    def fake_results_to_mni(warp_name, asl_names, *args, **kwargs):
+        mni_inputs.extend(asl_names)
+    monkeypatch.setattr(cifti_processing, "_run_chain", fake_chain)
+    monkeypatch.setattr(cifti_processing, "results_to_mni", fake_results_to_mni)
+    return studydir, wbdevdir, commands, mni_inputs
+
+def test_projection_without_pvcorr_results(subject):
+    studydir, wbdevdir, commands, mni_inputs = subject
+    project_to_surface(studydir, SUBID, outdir=OUTDIR, wbdevdir=wbdevdir,
+                       pvcorr=False, cores=2)
+
+    # the temporary directory's name includes the test's name
+    args = [str(arg).replace(str(studydir.parent), "") 
+            for arg in [*mni_inputs, *(a for cmd in commands for a in cmd)]]
+    assert commands and mni_inputs
+    assert not any("pvcorr" in arg for arg in args)
+    atlas_results_dir = studydir/SUBID/OUTDIR/"ASLMNI/Results/OutputtoCIFTI"
+    for variable in ("perfusion_calib", "arrival"):
+        dscalar = nb.load(str(atlas_results_dir/f"{variable}_Atlas.dscalar.nii"))
+        assert dscalar.shape == (1, 2 * 25 + 8)
+    assert not list(atlas_results_dir.glob("*pvcorr*"))
+
+def test_missing_pvcorr_results_fail_before_processing(subject):
+    studydir, wbdevdir, commands, mni_inputs = subject
+    with pytest.raises(FileNotFoundError, match="pvcorr"):
+        cifti_processing.perfusion_cifti_processing(
+            studydir, SUBID, OUTDIR, wbdevdir, pvcorr=(False, True), cores=2
+        )
+    assert not commands and not mni_inputs
+
+def test_inprocess_smoothing_replaces_metric_smoothing(subject):
+    studydir, wbdevdir, commands, mni_inputs = subject
+    cifti_processing.perfusion_cifti_processing(
+        studydir, SUBID, OUTDIR, wbdevdir, pvcorr=(False,), cores=2, 
+        inprocess_smoothing=True
+    )
+    assert not any(cmd[1] == "-metric-smoothing" for cmd in commands)
+    atlas_results_dir = studydir/SUBID/OUTDIR/"ASLMNI/Results/OutputtoCIFTI"
+    dscalar = nb.load(str(atlas_results_dir/"perfusion_calib_Atlas.dscalar.nii"))
+    assert dscalar.shape == (1, 2 * 25 + 8)
+
+def test_cores_are_shared_with_the_warp_to_mni(subject, monkeypatch):
+    studydir, wbdevdir, commands, mni_inputs = subject
+    threads, mni_cores = set(), []
+    run_chain = cifti_processing._run_chain
+    def recording_chain(cmds, env):
+        threads.add(int(env["OMP_NUM_THREADS"]))
+        run_chain(cmds, env)
+    monkeypatch.setattr(cifti_processing, "_run_chain", recording_chain)
+    monkeypatch.setattr(cifti_processing, "results_to_mni",
+                        lambda *args, cores: mni_cores.append(cores))
+    cifti_processing.perfusion_cifti_processing(
+        studydir, SUBID, OUTDIR, wbdevdir, pvcorr=(False,), cores=16
+    )
+    # 6 workers of 2 threads, one of them warping with the other 6 cores
+    assert threads == {2}
+    assert mni_cores == [6]
+
+def test_missing_fsldir_fails_before_processing(subject, monkeypatch):
+    studydir, wbdevdir, commands, mni_inputs = subject
+    monkeypatch.delenv("FSLDIR")
+    with pytest.raises(RuntimeError, match="FSLDIR"):
+        cifti_processing.perfusion_cifti_processing(
+            studydir, SUBID, OUTDIR, wbdevdir, pvcorr=(False,), cores=2
+        )
+    assert not commands and not mni_inputs
+
+@pytest.mark.parametrize("argv", [
+    ["warp", "asl", "t1", "mni", "grid", "out"],
+    ["warp", "t1", "mni", "grid", "-i", "asl", "-o", "out"],
+])
+def test_results_to_mni_accepts_the_positional_form(argv, monkeypatch):
+    calls = []
+    monkeypatch.setattr(results_to_mni, "results_to_mni",
+                        lambda *args, **kwargs: calls.append(args))
+    results_to_mni.main(argv)
+    assert calls == [("warp", ["asl"], "t1", "mni", "grid", ["out"])]
@@ -0,0 +1,85 @@
+"""
+Tests of the in-process fslmaths filters, against fslmaths itself 
+where FSL is available.
+"""
+
+import os
+import subprocess
+from pathlib import Path
+
+import numpy as np
+import nibabel as nb
+import pytest
+
+from hcpasl.filters import dilall, dilM
+
+requires_fsl = pytest.mark.skipif("FSLDIR" not in os.environ,
+                                  reason="FSLDIR is not set")
+
+def _fslmaths(data, args, tmp_path):
+    in_name, out_name = tmp_path/"in.nii.gz", tmp_path/"out.nii.gz"
+    nb.save(nb.Nifti1Image(data.astype(np.float32), np.eye(4)), str(in_name))
+    fslmaths = Path(os.environ["FSLDIR"])/"bin/fslmaths"
+    subprocess.run([str(fslmaths), str(in_name), *args, str(out_name)], check=True)
+    return nb.load(str(out_name)).get_fdata()
+
+def _sparse_volume(shape, fraction, seed):
+    rng = np.random.default_rng(seed)
+    data = rng.uniform(1, 10, shape)
+    data[rng.random(shape) > fraction] = 0
+    return data.astype(np.float32)
+
+def _blob_volume(shape, seed):
+    # smooth positive values inside a sphere, as for a bias field
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing='ij'), -1)
+    centre = (np.array(shape) - 1) / 2
+    inside = np.linalg.norm(grid - centre, axis=-1) < min(shape) / 3
+    data = 1 + 0.1 * np.sin(grid.sum(-1) / 5) + 0.01 * rng.random(shape)
+    return np.where(inside, data, 0).astype(np.float32)
+
+def _layers(data):
+    # number of -dilM passes needed to fill every voxel
+    layers = 0
+    while np.any(data == 0):
+        data = dilM(data)
+        layers += 1
+    return layers
+
+VOLUMES = [
+    _sparse_volume((9, 11, 7), 0.15, 0),
+    _sparse_volume((20, 16, 12), 0.02, 1),
+    _blob_volume((30, 34, 26), 2),
+]
+
+@pytest.mark.parametrize("data", VOLUMES)
+def test_dilall_is_repeated_dilM(data):
+    np.testing.assert_allclose(dilall(data), dilM(data, _layers(data)), 
+                               rtol=1e-12, atol=1e-12)
+
+# fslmaths works in float32, so only float32 rounding differences are
+# expected
+@requires_fsl
+@pytest.mark.parametrize("data", VOLUMES)
+def test_dilall_matches_repeated_fslmaths_dilM(data, tmp_path):
+    expected = _fslmaths(data, ["-dilM"] * _layers(data), tmp_path)
+    np.testing.assert_allclose(dilall(data), expected, rtol=1e-5, atol=1e-5)
+
+# fslmaths -dilall fills each layer sequentially, so the filled values 
+# only agree approximately; the non-zero voxels are unchanged by both
+@requires_fsl
+def test_dilall_close_to_fslmaths_dilall(tmp_path):
+    data = _blob_volume((30, 34, 26), 2)
+    expected = _fslmaths(data, ["-dilall"], tmp_path)
+    filled = dilall(data)
+    inside = data != 0
+    np.testing.assert_allclose(filled[inside], expected[inside], rtol=1e-6)
+    rel = np.abs(filled[~inside] - expected[~inside]) / np.abs(expected[~inside])
+    assert np.median(rel) < 0.05
+    assert rel.max() < 0.25
+
+def test_dilall_fills_every_voxel():
+    data = _sparse_volume((9, 11, 7), 0.1, 3)
+    filled = dilall(data)
+    assert np.all(filled != 0)
+    np.testing.assert_array_equal(filled[data != 0], data[data != 0])
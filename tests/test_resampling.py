@@ -0,0 +1,50 @@
+"""
+Tests of `hcpasl.resampling` against regtricks.
+"""
+
+import numpy as np
+import nibabel as nb
+import pytest
+import regtricks as rt
+
+from hcpasl.resampling import LabelResampler, apply_registration
+
+@pytest.mark.parametrize("order", [0, 1])
+def test_apply_registration_matches_regtricks(order, tmp_path):
+    # a shifted and rotated src, so that part of the ref grid falls 
+    # outside the src field of view
+    # mixed-sign values with a zero background
+    rng = np.random.default_rng(0)
+    data = np.zeros((12, 10, 8), dtype=np.float32)
+    data[2:10, 2:8, 2:6] = rng.uniform(-1, 1, (8, 6, 4))
+    src = nb.Nifti1Image(data, np.diag([2., 2., 2., 1.]))
+    ref = rt.ImageSpace(src).resize_voxels(0.5)
+    mat = np.eye(4)
+    mat[:3, :3] = np.array([[0.98, -0.2, 0.], [0.2, 0.98, 0.], [0., 0., 1.]])
+    mat[:3, 3] = [3., -2., 1.5]
+    reg = rt.Registration(mat)
+
+    expected = reg.apply_to_image(src, ref, order=order).get_fdata()
+    result = apply_registration(reg, src, ref, order=order, 
+                                cache_dir=tmp_path).get_fdata()
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-5)
+
+def test_truncated_caches_are_rebuilt(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 4, (12, 10, 8)).astype(np.float32)
+    src = nb.Nifti1Image(data, np.diag([1., 1., 1., 1.]))
+    ref = rt.ImageSpace(src).resize_voxels(2.)
+    reg = rt.Registration.identity()
+
+    expected = (apply_registration(reg, src, ref, order=0, cache_dir=tmp_path).get_fdata(),
+                LabelResampler(src, ref, cache_dir=tmp_path).majority())
+    names = sorted(tmp_path.glob("*.npz"))
+    assert len(names) == 2
+    # an interrupted write is a cache miss rather than an error
+    for name in names:
+        name.write_bytes(name.read_bytes()[:100])
+    result = (apply_registration(reg, src, ref, order=0, cache_dir=tmp_path).get_fdata(),
+              LabelResampler(src, ref, cache_dir=tmp_path).majority())
+    for r, e in zip(result, expected):
+        np.testing.assert_array_equal(r, e)
+    assert not list(tmp_path.glob("tmp*"))
@@ -0,0 +1,96 @@
+"""
+Tests of the ribbon-constrained mapping in `hcpasl.surface_mapping`
+against `wb_command -volume-to-surface-mapping -ribbon-constrained`.
+
+RibbonMapper's vertex cells (barycentric-dual regions of the prisms
+between the white and pial triangles) approximate wb_command's
+ribbon polyhedra, so the results are compared with tolerances rather
+than exactly, on concentric spheres filled with a smooth field:
+
+- the correlation across vertices is at least 0.99;
+- the median absolute difference is below 2% of the spread (standard
+  deviation) of wb_command's values, and the 99th percentile below 10%;
+- no more than 1% of vertices differ in whether they are bad (have
+  no valid voxels).
+"""
+
+import shutil
+import subprocess
+
+import numpy as np
+import nibabel as nb
+import pytest
+
+from hcpasl.surface_mapping import RibbonMapper, save_metric
+
+WB_COMMAND = shutil.which("wb_command")
+requires_wb = pytest.mark.skipif(WB_COMMAND is None,
+                                 reason="wb_command is not available")
+
+def _save_surface(coords, triangles, name):
+    meta = nb.gifti.GiftiMetaData.from_dict({"AnatomicalStructurePrimary": "CortexLeft"})
+    arrays = [nb.gifti.GiftiDataArray(coords.astype(np.float32),
+                                      intent="NIFTI_INTENT_POINTSET"),
+              nb.gifti.GiftiDataArray(triangles.astype(np.int32),
+                                      intent="NIFTI_INTENT_TRIANGLE")]
+    nb.save(nb.gifti.GiftiImage(meta=meta, darrays=arrays), str(name))
+
+@pytest.fixture(scope="module")
+def ribbon(tmp_path_factory, icosphere):
+    """
+    White, midthickness and pial spheres 3 mm apart in a 2 mm grid,
+    with a smooth field, a precision image and a ROI.
+    """
+    tmp_path = tmp_path_factory.mktemp("ribbon")
+    unit, triangles = icosphere(4)
+    names = {}
+    for surface, radius in (("white", 40.), ("midthickness", 41.5), ("pial", 43.)):
+        names[surface] = tmp_path/f"{surface}.surf.gii"
+        _save_surface(unit * radius, triangles, names[surface])
+
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = -49
+    ijk = np.stack(np.meshgrid(*3 * [np.arange(50)], indexing='ij'), -1)
+    xyz = ijk @ affine[:3, :3].T + affine[:3, 3]
+    field = 50 + 0.3 * xyz[..., 0] - 0.2 * xyz[..., 1] + 5 * np.sin(xyz[..., 2] / 15)
+    precision = 1 / (1 + 0.01 * np.linalg.norm(xyz, axis=-1))
+    roi = (xyz[..., 0] > -30).astype(np.float32)
+    for name, data in (("data", field), ("precision", precision), ("roi", roi)):
+        names[name] = tmp_path/f"{name}.nii.gz"
+        nb.save(nb.Nifti1Image(data.astype(np.float32), affine), str(names[name]))
+    return tmp_path, names
+
+def _wb_mapping(names, out_name, roi=None, weighted=False):
+    cmd = [WB_COMMAND, "-volume-to-surface-mapping", names["data"],
+           names["midthickness"], out_name, "-ribbon-constrained",
+           names["white"], names["pial"]]
+    if roi is not None:
+        cmd += ["-volume-roi", names[roi]]
+        if weighted:
+            cmd.append("-weighted")
+    subprocess.run([str(c) for c in cmd], check=True)
+    return nb.load(str(out_name)).agg_data()
+
+@requires_wb
+@pytest.mark.parametrize("roi, weighted", [
+    (None, False), ("roi", False), ("precision", True)
+])
+def test_ribbon_mapping_matches_wb_command(ribbon, roi, weighted):
+    tmp_path, names = ribbon
+    expected = _wb_mapping(names, tmp_path/f"wb_{roi}.func.gii", roi, weighted)
+
+    mapper = RibbonMapper(names["white"], names["pial"], names["data"],
+                          cache_dir=False)
+    roi_data = None if roi is None else nb.load(str(names[roi])).get_fdata()
+    values, bad = mapper.map(nb.load(str(names["data"])).get_fdata(),
+                             roi=roi_data, weighted=weighted)
+    save_metric(values, tmp_path/f"hcpasl_{roi}.func.gii")
+
+    wb_bad = expected == 0
+    assert np.mean(wb_bad != (bad > 0)) <= 0.01
+    good = ~wb_bad & (bad == 0)
+    diff = np.abs(values[good] - expected[good])
+    spread = expected[good].std()
+    assert np.corrcoef(values[good], expected[good])[0, 1] >= 0.99
+    assert np.median(diff) < 0.02 * spread
+    assert np.percentile(diff, 99) < 0.1 * spread
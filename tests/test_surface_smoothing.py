@@ -0,0 +1,103 @@
+"""
+Tests of the geodesic smoothing in `hcpasl.surface_smoothing` against
+`wb_command -metric-smoothing` (GEO_GAUSS_AREA).
+
+SurfaceSmoother's geodesic distances are shortest paths through the
+mesh's edges and across adjacent triangles, which approximate
+wb_command's geodesics, so the results are compared with tolerances
+rather than exactly, on a sphere with a smooth field plus noise:
+
+- the correlation across vertices is at least 0.99;
+- the median absolute difference is below 2% of the spread (standard
+  deviation) of wb_command's values, and the 99th percentile below 10%.
+
+Until this passes, `perfusion_cifti_processing` smooths with
+wb_command unless `inprocess_smoothing` is set.
+"""
+
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nb
+import pytest
+
+from hcpasl.surface_mapping import save_metric
+from hcpasl.surface_smoothing import SurfaceSmoother, fwhm_to_sigma
+
+WB_COMMAND = shutil.which("wb_command")
+requires_wb = pytest.mark.skipif(WB_COMMAND is None,
+                                 reason="wb_command is not available")
+
+def _save_surface(coords, triangles, name):
+    meta = nb.gifti.GiftiMetaData.from_dict({"AnatomicalStructurePrimary": "CortexLeft"})
+    arrays = [nb.gifti.GiftiDataArray(coords.astype(np.float32),
+                                      intent="NIFTI_INTENT_POINTSET"),
+              nb.gifti.GiftiDataArray(triangles.astype(np.int32),
+                                      intent="NIFTI_INTENT_TRIANGLE")]
+    nb.save(nb.gifti.GiftiImage(meta=meta, darrays=arrays), str(name))
+
+@pytest.fixture(scope="module")
+def sphere(tmp_path_factory, icosphere):
+    """
+    A 50 mm sphere with about 2 mm between vertices, a field to smooth
+    and a ROI leaving out a cap.
+    """
+    tmp_path = tmp_path_factory.mktemp("sphere")
+    unit, triangles = icosphere(5)
+    coords = 50 * unit
+    names = {"surface": tmp_path/"sphere.surf.gii",
+             "data": tmp_path/"data.func.gii", "roi": tmp_path/"roi.shape.gii"}
+    _save_surface(coords, triangles, names["surface"])
+    rng = np.random.default_rng(0)
+    data = (np.sin(coords[:, 0] / 7) + np.cos(coords[:, 1] / 5)
+            + 0.5 * rng.standard_normal(len(coords)))
+    save_metric(data, names["data"])
+    save_metric((coords[:, 2] > -30).astype(np.float32), names["roi"])
+    return tmp_path, names
+
+@requires_wb
+@pytest.mark.parametrize("fwhm, roi", [
+    (4., None), (8., None), (4., "roi")
+])
+def test_smoothing_matches_wb_command(sphere, fwhm, roi):
+    tmp_path, names = sphere
+    out_name = tmp_path/f"wb_{fwhm}_{roi}.func.gii"
+    cmd = [WB_COMMAND, "-metric-smoothing", names["surface"], names["data"],
+           fwhm_to_sigma(fwhm), out_name]
+    if roi is not None:
+        cmd += ["-roi", names[roi]]
+    subprocess.run([str(c) for c in cmd], check=True)
+    expected = nb.load(str(out_name)).agg_data()
+
+    smoother = SurfaceSmoother(names["surface"], fwhm, cache_dir=False)
+    roi_data = None if roi is None else nb.load(str(names[roi])).agg_data()
+    values = smoother.smooth(nb.load(str(names["data"])).agg_data(), roi=roi_data)
+
+    good = slice(None) if roi is None else roi_data > 0
+    diff = np.abs(values[good] - expected[good])
+    spread = expected[good].std()
+    assert np.corrcoef(values[good], expected[good])[0, 1] >= 0.99
+    assert np.median(diff) < 0.02 * spread
+    assert np.percentile(diff, 99) < 0.1 * spread
+
+def test_kernel_cache_is_safe_to_share(sphere, tmp_path):
+    _, names = sphere
+    cache_dir = tmp_path/"cache"
+    # several workers building the same kernel at once, as the two 
+    # hemispheres of identical meshes or two subjects would
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        kernels = list(executor.map(
+            lambda _: SurfaceSmoother(names["surface"], 4., cache_dir=cache_dir).kernel,
+            range(4)
+        ))
+    for kernel in kernels[1:]:
+        assert (kernel != kernels[0]).nnz == 0
+    assert not list(cache_dir.glob("tmp*"))
+
+    # an interrupted write is a cache miss rather than an error
+    cache_name, = cache_dir.glob("geo_smooth_*.npz")
+    cache_name.write_bytes(cache_name.read_bytes()[:100])
+    kernel = SurfaceSmoother(names["surface"], 4., cache_dir=cache_dir).kernel
+    assert (kernel != kernels[0]).nnz == 0